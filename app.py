@@ -47,20 +47,34 @@ logging.info("Initializing application...")
 
 try:
     import time
-    import zipfile
-    import io
-    import webbrowser
+    import inspect
+    import json
+    import multiprocessing
     import socket
-    from threading import Timer
+    import sqlite3
+    from threading import Lock, Thread, Timer
     
     logging.info("Standard libraries imported.")
     
-    from flask import Flask, render_template, request, send_from_directory, jsonify, send_file
+    from flask import Flask, Response, g, render_template, request, send_file, send_from_directory, jsonify
+    from werkzeug.security import safe_join
+    from werkzeug.wsgi import wrap_file
     from werkzeug.utils import secure_filename
     
     logging.info("Flask and Werkzeug imported.")
     
-    from converter import Converter
+    from concurrent.futures import as_completed
+    import backends
+    import metrics
+    from jobs import ConversionPool, Job, JobQueue, QueueFullError
+    from cache import ConversionCache, save_with_hash
+    from zipstream import ZipStream
+    import outputs
+    import postprocess
+    from search import BackgroundIndexer, SearchIndex
+    from uploads import SNIFF_BYTES, PrefixedStream, UploadError, UploadStore, matches_extension
+    from converter import PREVIEW_CHARS, Converter, preview_file
+    from workers import IsolatedConverter, WorkerPool
     logging.info("Converter module imported.")
 
 except Exception as e:
@@ -89,8 +103,10 @@ try:
 
     # Configure storage paths
     # For cloud deployments (Render, Vercel), we must use /tmp as other directories are read-only
-    # For local EXE/Script, we use the app directory
-    if os.environ.get('VERCEL') or os.environ.get('RENDER'):
+    # For local EXE/Script, we use the app directory; STORAGE_DIR overrides both
+    if os.environ.get('STORAGE_DIR'):
+        STORAGE_DIR = os.environ['STORAGE_DIR']
+    elif os.environ.get('VERCEL') or os.environ.get('RENDER'):
         STORAGE_DIR = tempfile.gettempdir()
     else:
         STORAGE_DIR = BASE_DIR
@@ -98,13 +114,105 @@ try:
     app.config['UPLOAD_FOLDER'] = os.path.join(STORAGE_DIR, 'uploads')
     app.config['DOWNLOAD_FOLDER'] = os.path.join(STORAGE_DIR, 'downloads')
     app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB limit
+    # Chunked uploads (/uploads): files up to MAX_UPLOAD_MB sent in UPLOAD_CHUNK_MB pieces,
+    # resumable until UPLOAD_MAX_HOURS pass without a chunk
+    app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('MAX_UPLOAD_MB', 50)) * 1024 * 1024
+    app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_MB', 4)) * 1024 * 1024
+    app.config['UPLOAD_MAX_AGE'] = int(os.environ.get('UPLOAD_MAX_HOURS', 24)) * 3600
+    # Conversions run in the background; beyond JOB_QUEUE_LIMIT waiting jobs uploads get 429
+    app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+    app.config['JOB_QUEUE_LIMIT'] = int(os.environ.get('JOB_QUEUE_LIMIT', 32))
+    # Batch uploads convert on a process pool; 0 means one process per CPU
+    app.config['BATCH_WORKERS'] = int(os.environ.get('BATCH_WORKERS', 0))
+    app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', 100))
+    # Batches that would take more than BATCH_QUEUE_LIMIT queued or running conversions get 429
+    app.config['BATCH_QUEUE_LIMIT'] = int(os.environ.get('BATCH_QUEUE_LIMIT', 200))
+    # Conversions run in worker processes that may use CONVERT_MEMORY_MB and run for
+    # CONVERT_TIMEOUT seconds; a worker is replaced after WORKER_MAX_JOBS jobs or once it
+    # holds more than WORKER_MAX_RSS_MB.  ISOLATE_CONVERSIONS=0 runs jobs in this process.
+    app.config['ISOLATE_CONVERSIONS'] = os.environ.get('ISOLATE_CONVERSIONS', '1') != '0'
+    app.config['CONVERT_MEMORY_LIMIT'] = int(os.environ.get('CONVERT_MEMORY_MB', 1024)) * 1024 * 1024
+    app.config['CONVERT_TIMEOUT'] = int(os.environ.get('CONVERT_TIMEOUT', 600))
+    app.config['WORKER_MAX_JOBS'] = int(os.environ.get('WORKER_MAX_JOBS', 50))
+    app.config['WORKER_MAX_RSS'] = int(os.environ.get('WORKER_MAX_RSS_MB', 512)) * 1024 * 1024
+    # WARM_UP=1 imports the format backends in the background right after start,
+    # so the first conversion of a long-running worker does not pay for it
+    app.config['WARM_UP'] = os.environ.get('WARM_UP') == '1'
+    # Converted outputs are cached by upload content; least recently used entries go first
+    app.config['CACHE_FOLDER'] = os.path.join(STORAGE_DIR, 'cache')
+    app.config['CACHE_MAX_BYTES'] = int(os.environ.get('CACHE_MAX_MB', 1024)) * 1024 * 1024
+    app.config['CACHE_MAX_AGE'] = int(os.environ.get('CACHE_MAX_DAYS', 30)) * 24 * 3600
+    # Entries compressed at the same time while a batch ZIP streams out
+    app.config['ZIP_THREADS'] = int(os.environ.get('ZIP_THREADS', 4))
+    # OUTPUT_COMPRESSION=gzip|zstd stores converted text compressed (book.txt.gz);
+    # downloads send it as is to clients that accept the encoding
+    app.config['OUTPUT_COMPRESSION'] = outputs.parse_compression(os.environ.get('OUTPUT_COMPRESSION'))
+    if app.config['OUTPUT_COMPRESSION'] == 'zstd' and not backends.available('zstandard'):
+        log_err("zstandard is not installed, storing outputs with gzip instead")
+        app.config['OUTPUT_COMPRESSION'] = 'gzip'
+    # TEXT_NORMALIZE=width,nfc adds full-width to half-width and/or NFC normalization
+    # to the clean-up every output gets (trailing whitespace, repeated blank lines)
+    app.config['TEXT_NORMALIZE'] = postprocess.parse_normalize(os.environ.get('TEXT_NORMALIZE'))
 
     # Ensure directories exist
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
     log_msg("Directories ensured.")
 
-    ALLOWED_EXTENSIONS = {'epub', 'mobi'}
+    # Converted books are indexed for /search and leave the index when the cache evicts them
+    app.config['SEARCH_DB'] = os.path.join(app.config['CACHE_FOLDER'], 'search.db')
+    try:
+        search_index = SearchIndex(app.config['SEARCH_DB'])
+        search_indexer = BackgroundIndexer(search_index)
+    except sqlite3.Error as e:
+        log_err(f"Full-text search disabled (SQLite without FTS5?): {e}")
+        search_index = search_indexer = None
+
+    conversion_cache = ConversionCache(app.config['CACHE_FOLDER'], max_bytes=app.config['CACHE_MAX_BYTES'],
+                                       max_age=app.config['CACHE_MAX_AGE'],
+                                       on_remove=search_indexer.remove if search_indexer else None)
+
+    # Unfinished chunked uploads live under the upload folder so finishing one is a rename
+    upload_store = UploadStore(os.path.join(app.config['UPLOAD_FOLDER'], 'sessions'),
+                               max_size=app.config['MAX_UPLOAD_SIZE'], chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+                               max_age=app.config['UPLOAD_MAX_AGE'])
+
+    def cache_output(job):
+        if job.cache_key:
+            conversion_cache.store(job.cache_key, job.output_path)
+            if search_indexer:
+                search_indexer.add_output(job.cache_key, job.filename, job.output_path)
+
+    worker_limits = dict(memory_limit=app.config['CONVERT_MEMORY_LIMIT'], timeout=app.config['CONVERT_TIMEOUT'],
+                         max_jobs=app.config['WORKER_MAX_JOBS'], max_rss=app.config['WORKER_MAX_RSS'])
+    # Worker processes start with the first job
+    job_workers = WorkerPool(app.config['JOB_WORKERS'], **worker_limits)
+
+    def new_converter():
+        if app.config['ISOLATE_CONVERSIONS']:
+            return IsolatedConverter(job_workers, normalize=app.config['TEXT_NORMALIZE'])
+        return Converter(normalize=app.config['TEXT_NORMALIZE'])
+
+    job_queue = JobQueue(workers=app.config['JOB_WORKERS'], max_pending=app.config['JOB_QUEUE_LIMIT'],
+                         converter_factory=new_converter, on_success=cache_output)
+    conversion_pool = ConversionPool(workers=app.config['BATCH_WORKERS'] or None,
+                                     normalize=app.config['TEXT_NORMALIZE'],
+                                     max_pending=app.config['BATCH_QUEUE_LIMIT'], **worker_limits)
+
+    def warm_up():
+        start = time.perf_counter()
+        available = backends.warm_up()
+        log_msg(f"Backends warmed up in {time.perf_counter() - start:.3f}s: {available}")
+
+    if app.config['WARM_UP']:
+        Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+    # Seconds between keep-alive comments on an idle progress stream
+    SSE_KEEPALIVE = 15
+
+    JOB_ACTIONS = {'cancel': '取消', 'pause': '暂停', 'resume': '继续'}
+
+    ALLOWED_EXTENSIONS = {'epub', 'mobi', 'azw3'}
 
     def allowed_file(filename):
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -113,6 +221,10 @@ try:
     def index():
         return render_template('index.html', version=time.time())
 
+    @app.route('/healthz')
+    def healthz():
+        return jsonify({'status': 'ok', 'backends': backends.loaded()})
+
     @app.route('/upload', methods=['POST'])
     def upload_file():
         if 'file' not in request.files:
@@ -123,34 +235,488 @@ try:
             return jsonify({'error': '未选择文件'}), 400
             
         if file and allowed_file(file.filename):
-            # 使用原始文件名，但要注意安全（这是一个本地工具，所以相对安全）
-            # 替换掉路径分隔符以防止目录遍历
-            filename = file.filename.replace('/', '_').replace('\\', '_')
-            
-            upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(upload_path)
-            
-            # Start conversion immediately
-            converter = Converter()
-            output_filename = os.path.splitext(filename)[0] + ".txt"
-            output_path = os.path.join(app.config['DOWNLOAD_FOLDER'], output_filename)
-            
-            success, msg = converter.convert_file(upload_path, output_path)
-            
-            if success:
-                return jsonify({
-                    'success': True,
-                    'filename': output_filename,
-                    'download_url': f'/download/{output_filename}'
-                })
-            else:
-                return jsonify({'error': f'转换失败: {msg}'}), 500
+            try:
+                result, task = save_upload(file)
+            except UploadError as e:
+                return jsonify({'error': str(e)}), e.status
+            return start_conversion(result, task)
         else:
             return jsonify({'error': '不支持的文件格式'}), 400
 
-    @app.route('/download/<filename>')
+    def start_conversion(result, task):
+        if result:
+            return jsonify(dict(result, success=True))
+
+        # Queue the conversion and return immediately
+        try:
+            job, _, _ = begin_conversion(task, lambda: job_queue.submit(*task[1:]))
+        except QueueFullError:
+            return jsonify({'error': '服务器繁忙，请稍后重试'}), 429, {'Retry-After': '5'}
+        if not isinstance(job, Job):
+            # The same book is converting in a batch; it is cached by the time the client retries
+            return jsonify({'error': '同一本书正在转换，请稍后重试'}), 429, {'Retry-After': '5'}
+
+        return jsonify(dict(job_status(job), success=True)), 202
+
+    @app.route('/uploads', methods=['POST'])
+    def create_upload():
+        """Start a chunked upload: JSON {filename, size}; answers with the chunk size to use."""
+        data = request.get_json(silent=True) or {}
+        filename = str(data.get('filename') or '')
+        if not allowed_file(filename):
+            return jsonify({'error': '不支持的文件格式'}), 400
+        try:
+            upload = upload_store.create(filename, data.get('size'))
+        except UploadError as e:
+            return jsonify({'error': str(e)}), e.status
+        return jsonify(upload_status(upload)), 201
+
+    @app.route('/uploads/<upload_id>', methods=['GET'])
+    def get_upload(upload_id):
+        """Progress of a chunked upload; a client resumes from next_chunk."""
+        try:
+            return jsonify(upload_status(upload_store.get(upload_id)))
+        except UploadError as e:
+            return jsonify({'error': str(e)}), e.status
+
+    @app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+    def put_upload_chunk(upload_id, index):
+        """Chunk `index` of the file as the raw request body."""
+        try:
+            upload = upload_store.get(upload_id)
+            upload_store.write_chunk(upload, index, request.stream, request.content_length)
+        except UploadError as e:
+            if e.status == 415:
+                # Not a book: nothing later can make this upload succeed
+                upload_store.cancel(upload)
+            body = {'error': str(e)}
+            if e.upload:
+                body.update(upload_status(e.upload))
+            return jsonify(body), e.status
+        return jsonify(upload_status(upload))
+
+    @app.route('/uploads/<upload_id>/complete', methods=['POST'])
+    def complete_upload(upload_id):
+        """Finish a fully sent upload and start converting it, as /upload does."""
+        try:
+            upload = upload_store.get(upload_id)
+            data_path, digest = upload_store.finish(upload)
+        except UploadError as e:
+            body = {'error': str(e)}
+            if e.upload:
+                body.update(upload_status(e.upload))
+            return jsonify(body), e.status
+        return start_conversion(*register_upload(data_path, digest, upload.filename))
+
+    @app.route('/uploads/<upload_id>', methods=['DELETE'])
+    def cancel_upload(upload_id):
+        try:
+            upload_store.cancel(upload_store.get(upload_id))
+        except UploadError as e:
+            return jsonify({'error': str(e)}), e.status
+        return jsonify({'success': True})
+
+    def upload_status(upload):
+        status = upload.to_dict()
+        status['chunk_url'] = f'/uploads/{upload.id}/chunks/{{index}}'
+        status['complete_url'] = f'/uploads/{upload.id}/complete'
+        return status
+
+    def save_upload(file):
+        """
+        Save an uploaded book under its content hash.
+
+        Returns (result, None) when the conversion is already cached, otherwise
+        (None, (temp_path, upload_path, output_path, output_filename, cache_key))
+        for begin_conversion().
+        """
+        ext = os.path.splitext(file.filename)[1].lower()
+        # Reject a file that is not what its name says before saving any of it
+        head = file.stream.read(SNIFF_BYTES)
+        if not matches_extension(head, ext):
+            raise UploadError('文件内容与扩展名不符，不是有效的电子书', 415)
+
+        # Hash while saving; the file is stored under its content hash so
+        # repeated uploads neither pile up nor overwrite other books
+        temp_path, digest = save_with_hash(PrefixedStream(head, file.stream), app.config['UPLOAD_FOLDER'], ext)
+        return register_upload(temp_path, digest, file.filename)
+
+    def register_upload(temp_path, digest, filename):
+        """
+        Take over a saved upload (a temporary file and its SHA-256): reuse a
+        cached conversion or work out where converting it goes.
+        Returns what save_upload() does.
+        """
+        # 使用原始文件名，但要注意安全（这是一个本地工具，所以相对安全）
+        # 替换掉路径分隔符以防止目录遍历
+        filename = filename.replace('/', '_').replace('\\', '_')
+        stem, ext = os.path.splitext(filename)
+        ext = ext.lower()
+
+        # Outputs live in a per-content folder: downloads/<hash prefix>/<name>.txt
+        content_id = digest[:16]
+        output_filename = f"{content_id}/{stem}.txt"
+        compression = app.config['OUTPUT_COMPRESSION']
+        output_path = outputs.stored_path(os.path.join(app.config['DOWNLOAD_FOLDER'], content_id, stem + ".txt"),
+                                          compression)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        options = {}
+        if compression:
+            options['compression'] = compression
+        if app.config['TEXT_NORMALIZE']:
+            options['normalize'] = ','.join(app.config['TEXT_NORMALIZE'])
+        cache_key = ConversionCache.make_key(digest, ext, options or None)
+        # The download is a link the cache owns, so evicting the entry frees its bytes
+        if conversion_cache.lookup(cache_key) and conversion_cache.link(cache_key, output_path):
+            os.remove(temp_path)
+            return dict(finished_result(output_filename), cached=True), None
+
+        upload_path = os.path.join(app.config['UPLOAD_FOLDER'], digest + ext)
+        return None, (temp_path, upload_path, output_path, output_filename, cache_key)
+
+    # Conversions in progress by cache key, with the name of their output.  Two
+    # uploads of the same book would write the same input, output and checkpoint
+    # files, so the second one joins the conversion of the first.
+    in_flight = {}
+    in_flight_lock = Lock()
+
+    def begin_conversion(task, submit):
+        """
+        Move an upload registered by register_upload() into place and start
+        converting it with submit(), which returns a Job or a ConversionPool
+        future.  If the same book is converting already, the upload is dropped
+        and that conversion is used instead.
+
+        Returns (Job or future, output filename it writes, whether it was started here).
+        """
+        temp_path, upload_path, _, output_filename, cache_key = task
+        with in_flight_lock:
+            if cache_key in in_flight:
+                remove_upload(temp_path)
+                return in_flight[cache_key] + (False,)
+            os.replace(temp_path, upload_path)
+            try:
+                conversion = submit()
+            except Exception:
+                remove_upload(upload_path)
+                raise
+            in_flight[cache_key] = (conversion, output_filename)
+        future = conversion.future if isinstance(conversion, Job) else conversion
+        future.add_done_callback(lambda f: end_conversion(cache_key, conversion, upload_path))
+        return conversion, output_filename, True
+
+    def end_conversion(cache_key, conversion, upload_path):
+        # Uploads are only kept while they are being converted
+        with in_flight_lock:
+            if in_flight.get(cache_key, (None,))[0] is conversion:
+                del in_flight[cache_key]
+            remove_upload(upload_path)
+
+    def remove_upload(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def finished_result(output_filename):
+        return {
+            'status': 'done',
+            'progress': 100,
+            'filename': output_filename,
+            'display_name': os.path.basename(output_filename),
+            'download_url': f'/download/{output_filename}',
+        }
+
+    # Upper bound for the chars parameter of the preview endpoints
+    PREVIEW_MAX_CHARS = 50000
+
+    def preview_chars():
+        try:
+            chars = int(request.values.get('chars', PREVIEW_CHARS))
+        except ValueError:
+            chars = PREVIEW_CHARS
+        return max(1, min(chars, PREVIEW_MAX_CHARS))
+
+    def preview_response(input_path, ext=None):
+        try:
+            return jsonify(preview_file(input_path, preview_chars(), ext, app.config['TEXT_NORMALIZE']))
+        except Exception as e:
+            log_err(f"Preview failed: {e}")
+            return jsonify({'error': f'预览失败: {e}'}), 422
+
+    @app.route('/preview', methods=['POST'])
+    def preview_upload():
+        """Text of the first pages of an uploaded book, without converting all of it."""
+        file = request.files.get('file')
+        if not file or file.filename == '':
+            return jsonify({'error': '没有文件被上传'}), 400
+        if not allowed_file(file.filename):
+            return jsonify({'error': '不支持的文件格式'}), 400
+
+        ext = os.path.splitext(file.filename)[1].lower()
+        temp_path, _ = save_with_hash(file.stream, app.config['UPLOAD_FOLDER'], ext)
+        try:
+            return preview_response(temp_path, ext)
+        finally:
+            os.remove(temp_path)
+
+    @app.route('/jobs/<job_id>/preview')
+    def preview_job(job_id):
+        job, error = get_job_or_404(job_id)
+        if error:
+            return error
+        if os.path.exists(job.input_path):
+            return preview_response(job.input_path)
+        # The upload is gone once the job has ended; a converted book is previewed from its text
+        if job.status == 'done' and os.path.exists(job.output_path):
+            return jsonify(preview_output(job.output_path, preview_chars()))
+        return jsonify({'error': '文件不存在'}), 404
+
+    def preview_output(output_path, chars):
+        with outputs.open_plain(output_path, outputs.compression_of(output_path)) as f:
+            # At most four UTF-8 bytes per character, and one more to tell whether there is more
+            text = f.read(chars * 4 + 1).decode('utf-8', errors='ignore')
+        return {'text': text[:chars], 'truncated': len(text) > chars, 'format': 'txt', 'encoding': 'utf-8'}
+
+    @app.route('/upload_batch', methods=['POST'])
+    def upload_batch():
+        files = [file for file in request.files.getlist('files') if file.filename]
+        if not files:
+            return jsonify({'error': '没有文件被上传'}), 400
+        if len(files) > app.config['BATCH_MAX_FILES']:
+            return jsonify({'error': f'每批最多 {app.config["BATCH_MAX_FILES"]} 个文件'}), 400
+
+        # Turn the batch away before saving anything if the pool cannot take it;
+        # slots of files that turn out cached or rejected are given back
+        try:
+            conversion_pool.reserve(len(files))
+        except QueueFullError:
+            return jsonify({'error': '服务器繁忙，请稍后重试'}), 429, {'Retry-After': '5'}
+
+        # Save everything before streaming; cached and rejected files are reported first
+        results = []
+        # future -> the files it converts
+        pending = {}
+        submitted = 0
+        try:
+            for index, file in enumerate(files):
+                base = {'index': index, 'name': file.filename}
+                if not allowed_file(file.filename):
+                    results.append(dict(base, status='failed', error='不支持的文件格式'))
+                    continue
+                try:
+                    result, task = save_upload(file)
+                except UploadError as e:
+                    results.append(dict(base, status='failed', error=str(e)))
+                    continue
+                if result:
+                    results.append(dict(base, **result))
+                    continue
+                conversion, output_filename, started = begin_conversion(
+                    task, lambda task=task: submit_batch_conversion(*task[1:]))
+                submitted += started
+                # A book that is converting already is reported when that conversion ends
+                future = conversion.future if isinstance(conversion, Job) else conversion
+                pending.setdefault(future, []).append(dict(base, filename=output_filename))
+        finally:
+            conversion_pool.release(len(files) - submitted)
+
+        def stream():
+            for result in results:
+                yield json.dumps(result, ensure_ascii=False) + '\n'
+            for future in as_completed(pending):
+                try:
+                    success, message, _ = future.result()
+                except Exception as e:
+                    success, message = False, str(e)
+                for base in pending[future]:
+                    if success:
+                        result = dict(base, **finished_result(base['filename']), message=message)
+                    else:
+                        result = dict(base, status='failed', error=f'转换失败: {message}')
+                    yield json.dumps(result, ensure_ascii=False) + '\n'
+
+        return Response(stream(), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    def submit_batch_conversion(upload_path, output_path, output_filename, cache_key):
+        future = conversion_pool.submit(upload_path, output_path)
+        future.add_done_callback(observe_batch_conversion)
+        # Cache from the callback so results count even if the client goes away
+        future.add_done_callback(lambda f: cache_batch_output(f, cache_key, output_path, output_filename))
+        return future
+
+    def observe_batch_conversion(future):
+        if not future.cancelled() and future.exception() is None:
+            metrics.observe_conversion(future.result()[2])
+
+    def cache_batch_output(future, cache_key, output_path, output_filename):
+        try:
+            success, _, _ = future.result()
+            if success:
+                conversion_cache.store(cache_key, output_path)
+                if search_indexer:
+                    search_indexer.add_output(cache_key, output_filename, output_path)
+        except Exception as e:
+            log_err(f"Caching batch result failed: {e}")
+
+    def job_status(job):
+        status = job.to_dict()
+        status['job_id'] = job.id
+        status['display_name'] = os.path.basename(job.filename)
+        status['status_url'] = f'/jobs/{job.id}'
+        status['events_url'] = f'/jobs/{job.id}/events'
+        if job.status == 'done':
+            status['download_url'] = f'/download/{job.filename}'
+        elif job.status == 'failed':
+            status['error'] = f'转换失败: {job.message}'
+        return status
+
+    def get_job_or_404(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return None, (jsonify({'error': '任务不存在'}), 404)
+        return job, None
+
+    @app.route('/jobs/<job_id>')
+    def get_job(job_id):
+        job, error = get_job_or_404(job_id)
+        if error:
+            return error
+        return jsonify(job_status(job))
+
+    @app.route('/jobs/<job_id>/events')
+    def job_events(job_id):
+        job, error = get_job_or_404(job_id)
+        if error:
+            return error
+
+        def stream():
+            version = None
+            while True:
+                if version != job.version:
+                    version = job.version
+                    yield f"data: {json.dumps(job_status(job), ensure_ascii=False)}\n\n"
+                    if job.finished:
+                        return
+                elif job.wait_for_change(version, SSE_KEEPALIVE) == version:
+                    yield ": keep-alive\n\n"
+
+        return Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @app.route('/jobs/<job_id>/<action>', methods=['POST'])
+    def control_job(job_id, action):
+        job, error = get_job_or_404(job_id)
+        if error:
+            return error
+        if action not in JOB_ACTIONS:
+            return jsonify({'error': '未知操作'}), 404
+
+        if not getattr(job, action)():
+            return jsonify(dict(job_status(job), error=f'当前状态无法{JOB_ACTIONS[action]}')), 409
+        return jsonify(job_status(job))
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        if metrics.enabled and 'request_start' in g:
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+            metrics.http_seconds.observe(time.perf_counter() - g.request_start, endpoint=endpoint,
+                                         method=request.method)
+        return response
+
+    def service_metrics():
+        jobs = job_queue.stats()
+        cache = conversion_cache.stats()
+        return [
+            ('ebook_jobs_pending', 'gauge', 'Jobs waiting for a worker', jobs['pending']),
+            ('ebook_jobs_running', 'gauge', 'Jobs converting now', jobs['running']),
+            ('ebook_batch_conversions_pending', 'gauge', 'Batch conversions queued or running',
+             conversion_pool.stats()['pending']),
+            ('ebook_cache_hits_total', 'counter', 'Conversion cache hits', cache['hits']),
+            ('ebook_cache_misses_total', 'counter', 'Conversion cache misses', cache['misses']),
+            ('ebook_cache_evictions_total', 'counter', 'Conversion cache evictions', cache['evictions']),
+            ('ebook_cache_bytes', 'gauge', 'Size of the conversion cache', cache['bytes']),
+        ]
+
+    metrics.registry.collectors.append(service_metrics)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/search')
+    def search():
+        """Books containing every word of ?q=, best first, each with a snippet of its best passage."""
+        if search_index is None:
+            return jsonify({'error': '全文搜索不可用'}), 503
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': '请输入搜索词'}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        except ValueError:
+            limit = 20
+
+        start = time.perf_counter()
+        results = search_index.search(query, limit)
+        for result in results:
+            result['display_name'] = os.path.basename(result['filename'])
+            result['download_url'] = f'/download/{result["filename"]}'
+        return jsonify({'query': query, 'results': results,
+                        'took_ms': round((time.perf_counter() - start) * 1000, 2)})
+
+    @app.route('/cache/stats')
+    def cache_stats():
+        return jsonify(conversion_cache.stats())
+
+    @app.route('/download/<path:filename>')
     def download_file(filename):
-        return send_from_directory(app.config['DOWNLOAD_FOLDER'], filename, as_attachment=True)
+        path = safe_join(app.config['DOWNLOAD_FOLDER'], filename)
+        found = outputs.find_output(path) if path else None
+        if found is None:
+            return jsonify({'error': '文件不存在'}), 404
+        stored, compression = found
+        if compression is None:
+            return send_from_directory(app.config['DOWNLOAD_FOLDER'], filename, as_attachment=True)
+
+        name = os.path.basename(path)
+        encoding = outputs.CONTENT_ENCODINGS[compression]
+        if request.accept_encodings[encoding]:
+            # The stored bytes are the response body; ranges refer to them
+            kwargs = {
+                'mimetype': 'text/plain; charset=utf-8',
+                'as_attachment': True,
+                'conditional': True
+            }
+
+            # Compatibility for Flask >= 2.0 (flask.__version__ is going away, so look at send_file itself)
+            if 'download_name' in inspect.signature(send_file).parameters:
+                kwargs['download_name'] = name
+            else:
+                kwargs['attachment_filename'] = name
+
+            response = send_file(stored, **kwargs)
+            response.headers['Content-Encoding'] = encoding
+        else:
+            # Decompress on the fly; ranges are served by skipping ahead in the stream
+            stat = os.stat(stored)
+            response = Response(wrap_file(request.environ, outputs.open_plain(stored, compression)),
+                                mimetype='text/plain; charset=utf-8', direct_passthrough=True)
+            response.headers.set('Content-Disposition', 'attachment', filename=name)
+            size = outputs.plain_size(stored, compression)
+            response.content_length = size
+            response.last_modified = stat.st_mtime
+            response.set_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}-identity')
+            response.make_conditional(request, accept_ranges=True, complete_length=size)
+        response.vary.add('Accept-Encoding')
+        return response
 
     @app.route('/download_batch', methods=['POST'])
     def download_batch():
@@ -162,29 +728,33 @@ try:
         if not filenames:
              return jsonify({'error': '文件名列表为空'}), 400
 
-        # Create in-memory zip
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for fname in filenames:
-                file_path = os.path.join(app.config['DOWNLOAD_FOLDER'], fname)
-                if os.path.exists(file_path):
-                    zf.write(file_path, fname)
-        
-        memory_file.seek(0)
-        
-        # Compatibility for Flask >= 2.0
-        import flask
-        kwargs = {
-            'mimetype': 'application/zip',
-            'as_attachment': True
-        }
-        
-        if int(flask.__version__.split('.')[0]) >= 2:
-            kwargs['download_name'] = 'converted_ebooks.zip'
-        else:
-            kwargs['attachment_filename'] = 'converted_ebooks.zip'
+        # Only files inside DOWNLOAD_FOLDER can be zipped; missing ones are skipped
+        files = []
+        arcnames = set()
+        for fname in filenames:
+            file_path = safe_join(app.config['DOWNLOAD_FOLDER'], fname) if isinstance(fname, str) else None
+            if file_path is None:
+                return jsonify({'error': f'无效的文件名: {fname}'}), 400
+            if outputs.find_output(file_path) is None:
+                continue
+            # Outputs sit in per-content folders; keep names in the archive unique
+            stem, ext = os.path.splitext(os.path.basename(file_path))
+            arcname, n = stem + ext, 1
+            while arcname in arcnames:
+                n += 1
+                arcname = f'{stem} ({n}){ext}'
+            arcnames.add(arcname)
+            files.append((arcname, file_path))
+
+        if not files:
+            return jsonify({'error': '没有可下载的文件'}), 404
 
-        return send_file(memory_file, **kwargs)
+        archive = ZipStream(files, threads=app.config['ZIP_THREADS'])
+        headers = {'Content-Disposition': 'attachment; filename=converted_ebooks.zip'}
+        length = archive.content_length()
+        if length is not None:
+            headers['Content-Length'] = str(length)
+        return Response(iter(archive), mimetype='application/zip', headers=headers)
 
     def find_free_port():
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -194,9 +764,12 @@ try:
     def open_browser(port):
         url = f'http://localhost:{port}/'
         log_msg(f"Opening browser at {url}")
+        import webbrowser
         webbrowser.open_new(url)
 
     if __name__ == '__main__':
+        # Worker processes of the packaged exe start by running the exe again
+        multiprocessing.freeze_support()
         try:
             port = 5000
             # Try to use port 5000, if occupied, find a free one
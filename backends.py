@@ -0,0 +1,96 @@
+"""
+Lazily loaded format backends.
+
+Each backend names the module (and optionally the attribute) that does the
+work for a format.  Nothing is imported until the first conversion asks for
+it, so the web app can start and answer the index page and health checks
+without loading the parsers or the optional `mobi` package.  warm_up()
+loads everything ahead of time for long-running workers.
+"""
+import importlib
+import threading
+
+
+class Backend:
+    def __init__(self, name, module, attribute=None, optional=False):
+        """optional: a missing module makes the backend unavailable instead of raising ImportError."""
+        self.name = name
+        self.module = module
+        self.attribute = attribute
+        self.optional = optional
+        self.error = None
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self):
+        """Import the backend on first use; returns None if an optional backend is missing."""
+        if self._loaded:
+            return self._value
+        with self._lock:
+            if not self._loaded:
+                try:
+                    value = importlib.import_module(self.module)
+                    if self.attribute:
+                        value = getattr(value, self.attribute)
+                except ImportError as e:
+                    if not self.optional:
+                        raise
+                    value, self.error = None, e
+                self._value = value
+                self._loaded = True
+        return self._value
+
+
+_backends = {}
+
+# Backends each input format may use, in the order they are tried
+FORMATS = {
+    '.epub': ('epub_reader', 'html_text'),
+    '.mobi': ('mobi_reader', 'html_text', 'mobi'),
+    '.azw3': ('mobi_reader', 'html_text', 'mobi'),
+}
+
+
+def register(name, module, attribute=None, optional=False):
+    _backends[name] = Backend(name, module, attribute, optional)
+    return _backends[name]
+
+
+def get(name):
+    """Return the loaded backend object (module, class or function), or None if unavailable."""
+    return _backends[name].load()
+
+
+def available(name):
+    return get(name) is not None
+
+
+def loaded():
+    """Names of the backends imported so far."""
+    return sorted(name for name, backend in _backends.items() if backend.loaded)
+
+
+def warm_up(formats=None):
+    """
+    Import the backends for the given formats (default: all of them) now.
+
+    Returns {backend name: available}.
+    """
+    names = []
+    for extension in formats or FORMATS:
+        names += [name for name in FORMATS[extension] if name not in names]
+    return {name: available(name) for name in names}
+
+
+register('epub_reader', 'epub_reader', 'EpubReader')
+register('html_text', 'html_text')
+register('mobi_reader', 'mobi_reader', 'MobiReader')
+# pip install mobi (a KindleUnpack wrapper); only tried when the built-in reader fails
+register('mobi', 'mobi', optional=True)
+# pip install zstandard; only needed for zstd-compressed outputs
+register('zstandard', 'zstandard', optional=True)
@@ -0,0 +1,450 @@
+"""
+Benchmarks for the conversion pipeline.
+
+Usage: python benchmarks.py [size_mb] [--only NAME ...] [--json results.json]
+                            [--baseline baseline.json] [--threshold 0.15] [--micro] [--startup]
+
+The suite runs each benchmark in a fresh process on synthetic books from
+corpus.py and reports throughput and the peak RSS of that process.  Results
+can be saved as JSON and compared with an earlier run; a benchmark that got
+slower or bigger than the threshold is flagged and the exit status is 1.
+--micro runs the older side-by-side comparisons instead.  --startup also
+measures the web app's cold start: import time (with a -X importtime
+breakdown), the first /healthz response and backend warm-up.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from converter import Converter
+from corpus import (build_mobi, compress_huffcdic, compress_palmdoc, reference_decompress_palmdoc, split_records,
+                    synthetic_book, synthetic_chapters)
+from html_text import html_to_text
+from huffcdic import HuffCdicDecoder
+from mobi_reader import MobiReader, decompress_palmdoc
+from postprocess import NORMALIZE_STEPS, build_pipeline
+from search import SearchIndex
+
+try:
+    import resource
+except ImportError:
+    # Windows: peak RSS is not reported
+    resource = None
+
+SAMPLE_TEXT = (
+    "第一章 天下大势，分久必合，合久必分。周末七国分争，并入于秦。"
+    "It was the best of times, it was the worst of times. <p>Chapter One</p>\n"
+)
+
+
+def make_text(size_mb, encoding='utf-8'):
+    raw = SAMPLE_TEXT.encode(encoding)
+    return (raw * (int(size_mb * 1024 * 1024) // len(raw) + 1))[:int(size_mb * 1024 * 1024)]
+
+
+def make_records(size_mb, encoding='utf-8'):
+    return [compress_palmdoc(chunk) for chunk in split_records(make_text(size_mb, encoding))]
+
+
+def time_decompress(func, records, repeat=3):
+    """Return (best seconds, output bytes) for decompressing all records."""
+    best = None
+    total = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        total = 0
+        for record in records:
+            total += len(func(record))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, total
+
+
+def bench_palmdoc(size_mb=4):
+    records = make_records(size_mb)
+    results = {}
+    for name, func in (('reference', reference_decompress_palmdoc), ('fast', decompress_palmdoc)):
+        seconds, total = time_decompress(func, records)
+        results[name] = total / seconds / (1024 * 1024)
+        print(f"palmdoc {name:<10} {total / 1024 / 1024:8.2f} MB  {seconds:8.3f} s  {results[name]:8.2f} MB/s")
+    print(f"palmdoc speedup    {results['fast'] / results['reference']:.1f}x")
+    return results
+
+
+def bench_huffcdic(size_mb=4):
+    huff, cdics, records = compress_huffcdic(split_records(make_text(size_mb)))
+    decoder = HuffCdicDecoder(huff, cdics)
+    seconds, total = time_decompress(decoder.decompress, records)
+    speed = total / seconds / (1024 * 1024)
+    print(f"huffcdic           {total / 1024 / 1024:8.2f} MB  {seconds:8.3f} s  {speed:8.2f} MB/s")
+    return {'huffcdic': speed}
+
+
+def bench_parallel_mobi(size_mb=4, workers=None):
+    """Compare serial and process-pool decompression of a whole MOBI file."""
+    text = make_text(size_mb)
+    fd, path = tempfile.mkstemp(suffix='.mobi')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(build_mobi(text))
+
+    workers = workers or os.cpu_count() or 1
+    results = {}
+    try:
+        for name, count in (('serial', 1), (f'{workers} workers', workers)):
+            reader = MobiReader(path, workers=count, parallel_threshold=1)
+            start = time.perf_counter()
+            total = sum(len(chunk) for chunk in reader.iter_text())
+            seconds = time.perf_counter() - start
+            results[name] = len(text) / seconds / (1024 * 1024)
+            print(f"mobi {name:<13} {total:10d} chars  {seconds:8.3f} s  {results[name]:8.2f} MB/s")
+    finally:
+        os.remove(path)
+    return results
+
+
+def make_html(size_mb):
+    paragraph = (
+        '<p class="text">　　滚滚长江东逝水，<span class="emph">浪花淘尽英雄</span>。'
+        'It was the <i>best</i> of times &amp; the <b>worst</b> of times.</p>\n'
+    )
+    body = paragraph * (int(size_mb * 1024 * 1024) // len(paragraph.encode('utf-8')) + 1)
+    return f'<html><head><style>p {{ margin: 0 }}</style></head><body><h2>第一章</h2>{body}</body></html>'
+
+
+def bench_html_text(size_mb=4):
+    """Compare the streaming extractor with BeautifulSoup's html.parser tree."""
+    html = make_html(size_mb)
+    size = len(html.encode('utf-8')) / (1024 * 1024)
+    extractors = [('streaming', html_to_text)]
+    try:
+        from bs4 import BeautifulSoup
+        extractors.insert(0, ('bs4', lambda content: BeautifulSoup(content, 'html.parser').get_text(separator='\n\n')))
+    except ImportError:
+        pass
+
+    results = {}
+    for name, extract in extractors:
+        start = time.perf_counter()
+        extract(html)
+        seconds = time.perf_counter() - start
+        results[name] = size / seconds
+        print(f"html {name:<13} {size:8.2f} MB  {seconds:8.3f} s  {results[name]:8.2f} MB/s")
+    return results
+
+
+def write_book(workdir, kind, size_mb, encoding='utf-8', chapters=20, seed=0):
+    path = os.path.join(workdir, f'{kind}-{encoding}-{seed}.{kind}')
+    with open(path, 'wb') as f:
+        f.write(synthetic_book(kind, int(size_mb * 1024 * 1024), chapters, encoding, seed))
+    return path
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def case_palmdoc(size_mb, workdir, repeat):
+    records = make_records(size_mb)
+    reader = MobiReader(os.devnull)
+    seconds, total = time_decompress(reader.decompress_palmdoc, records, repeat)
+    return {'bytes': total, 'seconds': seconds}
+
+
+def case_extract_text(encoding):
+    def case(size_mb, workdir, repeat):
+        path = write_book(workdir, 'mobi', size_mb, encoding)
+        seconds = best_time(lambda: MobiReader(path).extract_text(), repeat)
+        return {'bytes': int(size_mb * 1024 * 1024), 'seconds': seconds}
+    return case
+
+
+def case_convert(kind, encoding):
+    def case(size_mb, workdir, repeat):
+        path = write_book(workdir, kind, size_mb, encoding)
+        output_path = os.path.join(workdir, 'out.txt')
+        convert = Converter()._convert_epub if kind == 'epub' else Converter()._convert_mobi
+
+        def run():
+            success, message = convert(path, output_path, lambda progress, message: None)
+            if not success:
+                raise RuntimeError(message)
+        seconds = best_time(run, repeat)
+        return {'bytes': int(size_mb * 1024 * 1024), 'seconds': seconds}
+    return case
+
+
+def case_postprocess(size_mb, workdir, repeat):
+    """The text clean-up pipeline with every step on, fed 64 KB at a time."""
+    line = '　　滚滚长江东逝水，浪花淘尽英雄。Ｉｔ ｗａｓ the best of times, café.  \n\n\xa0\n\n\n'
+    size = int(size_mb * 1024 * 1024)
+    text = line * (size // len(line.encode('utf-8')) + 1)
+    chunks = [text[i:i + 64 * 1024] for i in range(0, len(text), 64 * 1024)]
+
+    def run():
+        pipeline = build_pipeline(NORMALIZE_STEPS)
+        for chunk in chunks:
+            pipeline.feed(chunk)
+        pipeline.close()
+    seconds = best_time(run, repeat)
+    return {'bytes': len(text.encode('utf-8')), 'seconds': seconds}
+
+
+def case_search(size_mb, workdir, repeat):
+    """Index size_mb of text as 20 books, then time a few queries (query_ms is the slowest best-of-repeat)."""
+    books = []
+    for seed in range(20):
+        chapters = synthetic_chapters(int(size_mb * 1024 * 1024) // 20, 10, 'utf-8', seed)
+        books.append('\n\n'.join(title + '\n\n' + '\n\n'.join(paragraphs) for title, paragraphs in chapters))
+    runs = iter(range(repeat))
+
+    def run():
+        index = SearchIndex(os.path.join(workdir, f'search-{next(runs)}.db'))
+        for number, text in enumerate(books):
+            index.add_book(str(number), f'{number}.txt', str(number), [text])
+        return index
+    seconds = best_time(run, repeat)
+
+    index = SearchIndex(os.path.join(workdir, 'search-0.db'))
+    query_ms = max(best_time(lambda: index.search(query), repeat) * 1000
+                   for query in ('天下大势', '长江 英雄', 'worst times', '夕阳'))
+    return {'bytes': sum(len(text.encode('utf-8')) for text in books), 'seconds': seconds,
+            'query_ms': round(query_ms, 2)}
+
+
+def case_upload(size_mb, workdir, repeat):
+    """POST /upload through the Flask test client and wait for the background job."""
+    if 'app' in sys.modules:
+        raise RuntimeError("the upload benchmark needs a process that has not imported the app yet")
+    # The app places its uploads, downloads, cache and search index under STORAGE_DIR when imported
+    os.environ['STORAGE_DIR'] = workdir
+    import app as web  # note: importing the app sends stdout to its log file
+    client = web.app.test_client()
+
+    best = None
+    for run in range(repeat):
+        # A different book every run so the conversion cache never answers
+        data = synthetic_book('epub', int(size_mb * 1024 * 1024), 20, 'utf-8', seed=run)
+        start = time.perf_counter()
+        r = client.post('/upload', data={'file': (io.BytesIO(data), 'bench.epub')}, content_type='multipart/form-data')
+        job = web.job_queue.get(r.get_json()['job_id'])
+        version = job.version
+        while not job.finished:
+            version = job.wait_for_change(version, 1)
+        if job.status != 'done':
+            raise RuntimeError(job.message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'bytes': int(size_mb * 1024 * 1024), 'seconds': best}
+
+
+SUITE = {
+    'palmdoc': case_palmdoc,
+    'extract_text[utf-8]': case_extract_text('utf-8'),
+    'extract_text[gb18030]': case_extract_text('gb18030'),
+    'extract_text[cp1252]': case_extract_text('cp1252'),
+    'convert_epub[utf-8]': case_convert('epub', 'utf-8'),
+    'convert_epub[gb18030]': case_convert('epub', 'gb18030'),
+    'convert_mobi[utf-8]': case_convert('mobi', 'utf-8'),
+    'convert_mobi[cp1252]': case_convert('mobi', 'cp1252'),
+    'convert_azw3[utf-8]': case_convert('azw3', 'utf-8'),
+    'postprocess': case_postprocess,
+    'search': case_search,
+    'upload': case_upload,
+}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _run_case(name, size_mb, repeat):
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        result = SUITE[name](size_mb, workdir, repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result['mb_per_s'] = round(result['bytes'] / result['seconds'] / (1024 * 1024), 2)
+    result['seconds'] = round(result['seconds'], 4)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_suite(names=None, size_mb=4, repeat=3):
+    """Run benchmarks, each in its own process so peak RSS belongs to that benchmark alone."""
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    results = {}
+    for name in names or SUITE:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[name] = result = pool.submit(_run_case, name, size_mb, repeat).result()
+        rss = '-' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.1f}"
+        query = f"  query {result['query_ms']:.2f} ms" if 'query_ms' in result else ''
+        print(f"{name:<24} {result['seconds']:8.3f} s  {result['mb_per_s']:8.2f} MB/s  peak RSS {rss:>7} MB{query}")
+    return results
+
+
+# Runs in a fresh interpreter; the app sends stdout to its log, so results go to sys.__stdout__
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/healthz')
+answered = time.perf_counter()
+import backends
+loaded_before_warm_up = backends.loaded()
+backends.warm_up()
+warmed = time.perf_counter()
+sys.__stdout__.write(json.dumps({
+    'import_s': imported - start,
+    'first_response_s': answered - imported,
+    'warm_up_s': warmed - answered,
+    'backends_at_start': loaded_before_warm_up,
+}))
+'''
+
+
+def parse_importtime(stderr):
+    """Return {module: (self us, cumulative us)} from -X importtime output."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def bench_startup(runs=5, top=8):
+    """Cold-start the web app in fresh interpreters; the best run counts."""
+    best = None
+    # Keep the started app's storage out of the repo, like the load test does
+    storage_dir = tempfile.mkdtemp(prefix='bench-startup-')
+    env = dict(os.environ, STORAGE_DIR=storage_dir)
+    try:
+        for _ in range(runs):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT],
+                                  capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+            wall = time.perf_counter() - start
+            if proc.returncode:
+                raise RuntimeError(proc.stderr[-2000:])
+            result = json.loads(proc.stdout)
+            result['process_s'] = wall
+            result['seconds'] = result['import_s'] + result['first_response_s']
+            if best is None or result['seconds'] < best['seconds']:
+                best, modules = result, parse_importtime(proc.stderr)
+    finally:
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    heaviest = sorted(modules.items(), key=lambda item: -item[1][0])[:top]
+    best['heaviest_imports'] = {name: round(self_us / 1e6, 4) for name, (self_us, _) in heaviest}
+    for key in ('import_s', 'first_response_s', 'warm_up_s', 'process_s', 'seconds'):
+        best[key] = round(best[key], 4)
+
+    print(f"startup: import {best['import_s']:.3f} s, first /healthz {best['first_response_s']:.3f} s, "
+          f"warm-up {best['warm_up_s']:.3f} s, whole process {best['process_s']:.3f} s")
+    print(f"backends loaded at start: {best['backends_at_start'] or 'none'}")
+    for name, seconds in best['heaviest_imports'].items():
+        print(f"  {name:<32} {seconds * 1000:8.1f} ms")
+    return best
+
+
+def compare(results, baseline, threshold=0.15):
+    """
+    Compare results with a baseline run and print the changes.
+
+    Returns the names of benchmarks whose throughput dropped (or, for timings
+    without a throughput such as startup, whose time grew), or whose peak RSS
+    grew, by more than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        flags = []
+        if 'mb_per_s' not in result:
+            change = result['seconds'] / old['seconds'] - 1
+            if change > threshold:
+                flags.append('slower')
+            print(f"{name:<24} {old['seconds']:8.3f} -> {result['seconds']:8.3f} s    ({change:+.0%})"
+                  f"{'  REGRESSION: ' + ', '.join(flags) if flags else ''}")
+            if flags:
+                regressions.append(name)
+            continue
+        speed = result['mb_per_s'] / old['mb_per_s'] - 1
+        if speed < -threshold:
+            flags.append('slower')
+        if result.get('peak_rss_mb') and old.get('peak_rss_mb') and \
+                result['peak_rss_mb'] > old['peak_rss_mb'] * (1 + threshold):
+            flags.append('more memory')
+        if flags:
+            regressions.append(name)
+        print(f"{name:<24} {old['mb_per_s']:8.2f} -> {result['mb_per_s']:8.2f} MB/s ({speed:+.0%})"
+              f"{'  REGRESSION: ' + ', '.join(flags) if flags else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversion pipeline benchmarks")
+    parser.add_argument('size_mb', type=float, nargs='?', default=4, help="text size of each synthetic book")
+    parser.add_argument('--only', nargs='+', choices=list(SUITE), help="run only these benchmarks")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark; the best one counts")
+    parser.add_argument('--json', help="save results to this file")
+    parser.add_argument('--baseline', help="compare with results saved earlier")
+    parser.add_argument('--threshold', type=float, default=0.15, help="allowed slowdown before flagging, 0.15 = 15%%")
+    parser.add_argument('--micro', action='store_true', help="run the side-by-side micro-benchmarks instead")
+    parser.add_argument('--startup', action='store_true', help="also measure the web app's cold start")
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        bench_palmdoc(args.size_mb)
+        bench_huffcdic(args.size_mb)
+        bench_parallel_mobi(args.size_mb)
+        bench_html_text(args.size_mb)
+        return 0
+
+    results = run_suite(args.only, args.size_mb, args.repeat)
+    if args.startup:
+        results['startup'] = bench_startup()
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created': time.time(),
+                'size_mb': args.size_mb,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'results': results,
+            }, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('size_mb') != args.size_mb:
+            print(f"warning: baseline was run with {baseline.get('size_mb')} MB books")
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
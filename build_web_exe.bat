@@ -18,7 +18,8 @@ echo.
 echo Building Web App...
 echo This may take a while...
 
-pyinstaller --noconfirm --onefile --windowed --add-data "templates;templates" --add-data "static;static" --name "EbookConverterWeb" --hidden-import=ebooklib --hidden-import=bs4 --clean app.py
+rem Format backends are imported on first use, so PyInstaller has to be told about them
+pyinstaller --noconfirm --onefile --windowed --add-data "templates;templates" --add-data "static;static" --hidden-import epub_reader --hidden-import mobi_reader --hidden-import html_text --hidden-import mobi --name "EbookConverterWeb" --clean app.py
 
 echo.
 if exist dist\EbookConverterWeb.exe (
@@ -0,0 +1,238 @@
+"""
+Convert whole directories of EPUB/MOBI/AZW3 files from the command line.
+
+Usage: python bulk_convert.py INPUT [INPUT ...] [-o OUTPUT_DIR] [-w WORKERS]
+                              [--check mtime|hash] [--manifest PATH] [--force]
+                              [--compress gzip|zstd] [--normalize width nfc]
+
+Every result is appended to a JSONL manifest as soon as it is known, and
+the converter writes each output under a temporary name and renames it when
+complete, so an interrupted run can simply be started again: finished books
+are skipped, books that were cut off carry on from their last checkpoint and
+the rest are converted.
+
+Outputs are named after the input without its extension (book.epub ->
+book.txt); books that differ only in extension keep it (book.epub.txt,
+book.mobi.txt) so they do not overwrite each other.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import backends
+import outputs
+import postprocess
+from converter import Converter
+
+EXTENSIONS = ('.epub', '.mobi', '.azw3')
+MANIFEST_NAME = 'convert_manifest.jsonl'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def find_books(inputs):
+    """Yield every EPUB/MOBI/AZW3 path under the given files and directories, sorted per directory."""
+    for path in inputs:
+        if os.path.isfile(path):
+            yield path, os.path.dirname(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(EXTENSIONS):
+                    yield os.path.join(root, name), path
+
+
+def output_path_for(input_path, base, output_dir, compression=None, keep_extension=False):
+    """Mirror the input tree under output_dir, or write next to the input; book.epub -> book.txt (book.epub.txt)."""
+    stem = input_path if keep_extension else os.path.splitext(input_path)[0]
+    if output_dir is not None:
+        stem = os.path.join(output_dir, os.path.relpath(stem, base))
+    return outputs.stored_path(stem + '.txt', compression)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    """Return the last manifest record for each input path."""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A run killed mid-write leaves a partial last line
+                continue
+            records[record['input']] = record
+    return records
+
+
+def is_up_to_date(input_path, output_path):
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+    except OSError:
+        return False
+
+
+def convert_one(input_path, output_path, known_hash=None, normalize=()):
+    """
+    Process pool task: convert one book and return its manifest record.
+
+    With known_hash (hash mode) the input is hashed first and skipped if it
+    matches the hash of the last successful conversion.
+    """
+    start = time.perf_counter()
+    record = {'input': input_path, 'output': output_path, 'size': os.path.getsize(input_path)}
+    if known_hash is not None:
+        record['sha256'] = file_hash(input_path)
+        if record['sha256'] == known_hash and os.path.exists(output_path):
+            return dict(record, status='skipped', seconds=round(time.perf_counter() - start, 3))
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    # The converter writes <output>.part and renames it, resuming it if an earlier run was cut off
+    converter = Converter(compression=outputs.compression_of(output_path), normalize=normalize)
+    try:
+        success, message = converter.convert_file(input_path, output_path)
+    except Exception as e:
+        success, message = False, str(e)
+    timings = converter.timings.to_dict()
+    if timings:
+        record['stages'] = timings['stages']
+
+    return dict(record, status='done' if success else 'failed', message=message,
+                seconds=round(time.perf_counter() - start, 3))
+
+
+def plan(inputs, output_dir, manifest, check, force, compression=None, normalize=()):
+    """Split the books into (tasks, skipped records)."""
+    books = {}
+    for input_path, base in find_books(inputs):
+        # A book named twice (a directory and a file in it) is converted once
+        books.setdefault(os.path.realpath(input_path), (input_path, base))
+    books = list(books.values())
+    # Books that differ only in their extension (a.epub, a.mobi) would write the
+    # same a.txt at the same time: each of them keeps its extension (a.epub.txt)
+    names = Counter(os.path.normcase(output_path_for(input_path, base, output_dir)) for input_path, base in books)
+
+    tasks = []
+    skipped = []
+    for input_path, base in books:
+        collides = names[os.path.normcase(output_path_for(input_path, base, output_dir))] > 1
+        output_path = output_path_for(input_path, base, output_dir, compression, keep_extension=collides)
+        previous = manifest.get(input_path)
+        known_hash = None
+        if not force and check == 'mtime' and is_up_to_date(input_path, output_path):
+            skipped.append({'input': input_path, 'output': output_path, 'status': 'skipped'})
+            continue
+        if not force and check == 'hash':
+            # Hashing happens in the workers; an unknown hash never matches
+            known_hash = previous.get('sha256', '') if previous and previous['status'] in ('done', 'skipped') else ''
+        tasks.append((input_path, output_path, known_hash, normalize))
+    return tasks, skipped
+
+
+def run(tasks, workers, manifest_file, results, report=None):
+    """Convert tasks on a process pool, appending each record to results and the manifest."""
+    todo = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        try:
+            while True:
+                # Keep a bounded number of tasks queued rather than all of them
+                while len(pending) < workers * 4:
+                    task = next(todo, None)
+                    if task is None:
+                        break
+                    pending.add(pool.submit(convert_one, *task))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record = future.result()
+                    record['finished'] = time.time()
+                    manifest_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    manifest_file.flush()
+                    results.append(record)
+                    if report:
+                        report(record)
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            raise
+
+
+def summarize(results, skipped, elapsed):
+    done = [r for r in results if r['status'] == 'done']
+    failed = [r for r in results if r['status'] == 'failed']
+    skipped_count = len(skipped) + sum(1 for r in results if r['status'] == 'skipped')
+    size_mb = sum(r['size'] for r in done) / (1024 * 1024)
+    elapsed = max(elapsed, 1e-9)
+    print(f"完成 {len(done)}  跳过 {skipped_count}  失败 {len(failed)}  用时 {elapsed:.1f} s")
+    print(f"吞吐量 {len(done) / elapsed:.2f} 文件/s  {size_mb / elapsed:.2f} MB/s")
+    for record in failed:
+        print(f"失败: {record['input']}: {record.get('message', '')}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量将 EPUB/MOBI 转换为 TXT")
+    parser.add_argument('inputs', nargs='+', help="输入文件或目录")
+    parser.add_argument('-o', '--output-dir', help="输出目录（默认写在输入文件旁边）")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help="并行进程数")
+    parser.add_argument('--check', choices=('mtime', 'hash'), default='mtime',
+                        help="判断输出是否最新：比较修改时间，或比较上次成功转换时记录的哈希")
+    parser.add_argument('--manifest', help=f"JSONL 清单路径（默认 <输出目录>/{MANIFEST_NAME}）")
+    parser.add_argument('--force', action='store_true', help="忽略已有输出，全部重新转换")
+    parser.add_argument('--compress', choices=('none', 'gzip', 'zstd'), default='none',
+                        help="以压缩格式保存输出（.txt.gz / .txt.zst）")
+    parser.add_argument('--normalize', nargs='+', choices=postprocess.NORMALIZE_STEPS, default=(),
+                        help="额外的文本规范化：width 全角字母数字转半角，nfc Unicode NFC 规范化")
+    parser.add_argument('-q', '--quiet', action='store_true', help="不逐个打印结果")
+    args = parser.parse_args(argv)
+    compression = outputs.parse_compression(args.compress)
+    if compression == 'zstd' and not backends.available('zstandard'):
+        parser.error("--compress zstd 需要安装 zstandard 库 (pip install zstandard)")
+
+    manifest_path = args.manifest or os.path.join(args.output_dir or '.', MANIFEST_NAME)
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    manifest = load_manifest(manifest_path)
+    tasks, skipped = plan(args.inputs, args.output_dir, manifest, args.check, args.force, compression,
+                          postprocess.parse_normalize(args.normalize))
+    print(f"待转换 {len(tasks)} 个文件，已是最新 {len(skipped)} 个，使用 {args.workers} 个进程")
+
+    count = [0]
+
+    def report(record):
+        count[0] += 1
+        if not args.quiet:
+            print(f"[{count[0]}/{len(tasks)}] {record['status']:<7} {record['input']} ({record['seconds']:.2f} s)")
+
+    start = time.perf_counter()
+    results = []
+    interrupted = False
+    with open(manifest_path, 'a', encoding='utf-8') as manifest_file:
+        try:
+            run(tasks, max(1, args.workers), manifest_file, results, report)
+        except KeyboardInterrupt:
+            interrupted = True
+            print("已中断，再次运行即可从清单继续")
+    summarize(results, skipped, time.perf_counter() - start)
+
+    if interrupted:
+        return 130
+    return 1 if any(r['status'] == 'failed' for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Content-addressed cache of converted outputs.
+
+Entries are keyed by the SHA-256 of the uploaded bytes together with the
+converter version and options, so a repeated upload of the same book can
+reuse the earlier .txt.  The index is a SQLite database shared by every
+process that uses the same directory; files are written to a temporary name
+and renamed into place so readers never see a partial entry.  Entries are
+evicted least-recently-used first once the total size passes max_bytes, and
+entries unused for longer than max_age seconds are dropped.  on_remove is
+told the keys of entries that went away, e.g. to drop them from the search
+index.
+
+The cache owns the bytes of every output it holds: the file an entry was
+stored from and each copy handed out with link() are hard links to the
+entry's object, recorded in the index and deleted along with it (with their
+directory, once empty).  So max_bytes bounds the disk used by converted
+books, not just by the objects directory.  Where hard links are not
+supported the copies are counted in the entry's size.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import outputs
+from converter import CONVERTER_VERSION
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS links (
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (key, path)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def save_with_hash(stream, directory, suffix=''):
+    """
+    Copy a binary stream to a new temporary file in directory while hashing it.
+
+    Returns (temporary path, sha256 hex digest); the caller renames the file.
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(suffix=suffix + '.part', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return temp_path, digest.hexdigest()
+
+
+def link_or_copy(source, destination):
+    """Hard-link source to destination (replacing it), copying if links are not supported."""
+    directory = os.path.dirname(destination)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.part', dir=directory)
+    os.close(fd)
+    os.remove(temp_path)
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+class ConversionCache:
+    def __init__(self, directory, max_bytes=1024 ** 3, max_age=30 * 24 * 3600, on_remove=None):
+        """on_remove: called with a list of keys after entries are evicted, expire or are removed."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.on_remove = on_remove
+        self.objects_dir = os.path.join(directory, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.db_path = os.path.join(directory, 'index.db')
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        # A short-lived connection per operation is safe across threads and processes
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        return _Connection(db)
+
+    @staticmethod
+    def make_key(content_hash, extension, options=None):
+        """Cache key for an upload: content hash, input format, converter version and options."""
+        material = json.dumps([content_hash, extension.lower(), CONVERTER_VERSION, options or {}], sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _object_path(self, key, compression=None):
+        return os.path.join(self.objects_dir, key[:2], outputs.stored_path(key + '.txt', compression))
+
+    def lookup(self, key):
+        """Return the cached output path for key, or None; counts a hit or a miss."""
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute('SELECT path, last_used FROM entries WHERE key = ?', (key,)).fetchone()
+            if row and now - row[1] <= self.max_age and os.path.exists(row[0]):
+                db.execute('UPDATE entries SET last_used = ? WHERE key = ?', (now, key))
+                self._count(db, 'hits')
+                return row[0]
+            paths = []
+            if row:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                paths = self._unlink(db, [key])
+                db.execute('COMMIT')
+            self._count(db, 'misses')
+        if row:
+            _remove_files([row[0]] + paths)
+            self._removed([key])
+        return None
+
+    def store(self, key, source_path):
+        """
+        Add a converted file under key and evict old entries; returns the cached path.
+
+        source_path becomes one of the entry's links and is deleted with it.
+        """
+        path = self._object_path(key, outputs.compression_of(source_path))
+        link_or_copy(source_path, path)
+        size = os.path.getsize(path) + _copy_size(path, source_path)
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT OR REPLACE INTO entries (key, path, size, created, last_used) VALUES (?, ?, ?, ?, ?)',
+                       (key, path, size, now, now))
+            db.execute('INSERT OR IGNORE INTO links (key, path) VALUES (?, ?)', (key, source_path))
+            self._count(db, 'stores')
+            db.execute('COMMIT')
+        self.evict()
+        return path
+
+    def link(self, key, destination):
+        """
+        Hard-link the output cached under key to destination, which is then
+        deleted with the entry; returns False if the entry is gone.
+        """
+        with self._connect() as db:
+            # Holding the write lock keeps the entry from being evicted meanwhile
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+            if not row:
+                db.execute('ROLLBACK')
+                return False
+            try:
+                link_or_copy(row[0], destination)
+            except OSError:
+                db.execute('ROLLBACK')
+                return False
+            if db.execute('INSERT OR IGNORE INTO links (key, path) VALUES (?, ?)', (key, destination)).rowcount:
+                db.execute('UPDATE entries SET size = size + ? WHERE key = ?', (_copy_size(row[0], destination), key))
+            db.execute('COMMIT')
+        return True
+
+    def remove(self, key):
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+            db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            paths = self._unlink(db, [key])
+            db.execute('COMMIT')
+        if row:
+            _remove_files([row[0]] + paths)
+            self._removed([key])
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under max_bytes."""
+        removed = []
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            cutoff = time.time() - self.max_age
+            removed += db.execute('SELECT key, path FROM entries WHERE last_used < ?', (cutoff,)).fetchall()
+            db.execute('DELETE FROM entries WHERE last_used < ?', (cutoff,))
+
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total > self.max_bytes:
+                for key, path, size in db.execute('SELECT key, path, size FROM entries ORDER BY last_used').fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    removed.append((key, path))
+                    total -= size
+            keys = [key for key, path in removed]
+            paths = [path for key, path in removed] + self._unlink(db, keys)
+            if removed:
+                self._count(db, 'evictions', len(removed))
+            db.execute('COMMIT')
+
+        _remove_files(paths)
+        if keys:
+            self._removed(keys)
+        return keys
+
+    @staticmethod
+    def _unlink(db, keys):
+        """Forget the links of keys; returns those no other entry still uses."""
+        paths = set()
+        for key in keys:
+            paths.update(path for path, in db.execute('SELECT path FROM links WHERE key = ?', (key,)))
+            db.execute('DELETE FROM links WHERE key = ?', (key,))
+        return [path for path in paths
+                if not db.execute('SELECT 1 FROM links WHERE path = ?', (path,)).fetchone()]
+
+    def _removed(self, keys):
+        if self.on_remove:
+            self.on_remove(keys)
+
+    def stats(self):
+        with self._connect() as db:
+            counters = dict(db.execute('SELECT name, value FROM counters').fetchall())
+            entries, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'stores': counters.get('stores', 0),
+            'evictions': counters.get('evictions', 0),
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+        }
+
+    @staticmethod
+    def _count(db, name, amount=1):
+        db.execute('INSERT INTO counters (name, value) VALUES (?, ?) '
+                   'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, amount))
+
+
+class _Connection:
+    """Closes the SQLite connection when the with block ends."""
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+        self.db.close()
+
+
+def _copy_size(path, other):
+    """Size of other if it is a copy of path rather than a hard link to it."""
+    try:
+        return 0 if os.path.samefile(path, other) else os.path.getsize(other)
+    except OSError:
+        return 0
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        # Per-book download folders go once their last file does
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
@@ -0,0 +1,95 @@
+"""
+Checkpoints that let an interrupted conversion carry on where it stopped.
+
+A conversion writes to <output>.part and renames it to <output> only once it
+has finished, so a half-written book is never mistaken for a converted one.
+Every so often, between two chapters or text records, the converter flushes
+the output to disk and saves a checkpoint in <output>.checkpoint: how many
+chapters or records are done, the output offset (plus the gzip CRC and
+length) and the state of the decoder, HTML extractor and text pipeline.
+The sidecar is JSON, replaced atomically and written after the output it
+describes is on disk, so it never points past data that was lost.
+
+When a conversion of the same input with the same options starts again it
+cuts <output>.part back to the checkpointed offset and continues from there.
+A checkpoint for another input (size or modification time changed), other
+options or another converter version is thrown away.
+"""
+import json
+import os
+import time
+
+PARTIAL_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.checkpoint'
+# Seconds between checkpoints; stopping or pausing always saves one
+DEFAULT_INTERVAL = 5.0
+
+
+class Checkpoint:
+    def __init__(self, output_path, input_path, options, interval=DEFAULT_INTERVAL):
+        """
+        options: everything besides the input that the output depends on
+        (converter version, compression, normalization); must be JSON-compatible.
+        interval: seconds between checkpoints, 0 for one at every chance.
+        """
+        self.output_path = output_path
+        self.temp_path = output_path + PARTIAL_SUFFIX
+        self.path = output_path + CHECKPOINT_SUFFIX
+        self.interval = interval
+        stat = os.stat(input_path)
+        self.identity = {'input': os.path.abspath(input_path), 'size': stat.st_size,
+                         'mtime_ns': stat.st_mtime_ns, 'options': options}
+        self._saved_at = time.monotonic()
+
+    def load(self):
+        """Return the saved state if it belongs to this conversion, else None (and forget any stale one)."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        if saved and saved.get('identity') == self.identity and os.path.exists(self.temp_path):
+            # A partial output shorter than its checkpoint lost data the checkpoint relies on
+            if os.path.getsize(self.temp_path) >= saved['state']['output']['offset']:
+                return saved['state']
+        self.discard()
+        return None
+
+    def due(self):
+        return time.monotonic() - self._saved_at >= self.interval
+
+    def save(self, writer, **position):
+        """
+        Flush the output writer and record the position in the input.
+
+        Returns False if the output cannot be resumed (zstd).
+        """
+        state = writer.checkpoint()
+        if state is None:
+            return False
+        state.update(position)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'identity': self.identity, 'state': state}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._saved_at = time.monotonic()
+        return True
+
+    def finish(self):
+        """Move the finished output into place and drop the checkpoint."""
+        os.replace(self.temp_path, self.output_path)
+        _remove_file(self.path)
+
+    def discard(self):
+        """Remove the partial output and the checkpoint."""
+        _remove_file(self.temp_path)
+        _remove_file(self.path)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,14 @@
+import os
+import shutil
+import tempfile
+
+
+def pytest_configure(config):
+    # The app reads STORAGE_DIR when it is imported, which may happen while
+    # tests are collected: keep its uploads, downloads and cache out of the repo
+    config.storage_dir = tempfile.mkdtemp(prefix='ebook-converter-tests-')
+    os.environ['STORAGE_DIR'] = config.storage_dir
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(config.storage_dir, ignore_errors=True)
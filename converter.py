@@ -1,190 +1,452 @@
 import os
+import queue
+import shutil
 import threading
 import time
+from collections import deque
 from pathlib import Path
 
-# 尝试导入库，优雅地处理缺失的情况
-try:
-    import ebooklib
-    from ebooklib import epub
-    from bs4 import BeautifulSoup
-    HAS_EPUB_LIB = True
-except ImportError:
-    HAS_EPUB_LIB = False
-    print("警告: 未找到 ebooklib 或 beautifulsoup4。")
-
-try:
-    import mobi
-    HAS_MOBI_LIB = True
-except ImportError:
-    HAS_MOBI_LIB = False
-    # 尝试使用内置的简单 MobiReader
-    try:
-        from mobi_reader import MobiReader
-        HAS_INTERNAL_MOBI = True
-    except ImportError:
-        HAS_INTERNAL_MOBI = False
-    print("警告: 未找到 mobi 库，将尝试使用内置读取器。")
+import backends
+import metrics
+import outputs
+import postprocess
+from checkpoint import DEFAULT_INTERVAL, Checkpoint
+
+# 各格式的解析模块（epub_reader、mobi_reader、html_text 以及可选的 mobi 库）
+# 由 backends 在第一次转换该格式时才导入，启动时不加载
+
+# 转换输出格式的版本号；输出内容发生变化时递增，使旧的缓存结果失效
+CONVERTER_VERSION = 3
+
+# 从 mobi 库解出的 HTML 文件每次读取的字符数
+HTML_CHUNK_SIZE = 64 * 1024
+
+CHAPTER_SEPARATOR = '\n\n' + '-'*20 + '\n\n'
+
+# 由内置读取器处理的 Kindle 格式（MOBI 6 与 KF8/AZW3）
+MOBI_EXTENSIONS = ('.mobi', '.azw3')
+
+# 章节数少于此值的 EPUB 始终单进程处理
+PARALLEL_MIN_CHAPTERS = 8
+# 并行模式下每个进程最多领先写入位置的章节数（乱序完成时的重排窗口）
+REORDER_WINDOW_PER_WORKER = 4
+
+# 子进程中缓存打开的 EPUB，同一本书的后续章节不必重新读取目录
+_worker_book = None
+
+def _extract_chapter(input_path, name):
+    """进程池任务：在子进程中自行打开 EPUB 并提取一章的文本。"""
+    global _worker_book
+    if _worker_book is None or _worker_book.filename != input_path:
+        if _worker_book is not None:
+            _worker_book.close()
+        _worker_book = backends.get('epub_reader')(input_path)
+    with _worker_book.open(name) as stream:
+        return ''.join(backends.get('html_text').iter_html_text(stream))
+
+# 预览默认返回的字符数
+PREVIEW_CHARS = 4000
+
+def preview_file(input_path, max_chars=PREVIEW_CHARS, file_ext=None, normalize=()):
+    """
+    提取书籍开头最多 max_chars 个字符的文本，只读取、解压所需的记录或章节。
+    file_ext 默认取自文件名，normalize 与 Converter 相同。
+    返回 {'text', 'truncated', 'format', 'encoding'}。
+    """
+    file_ext = (file_ext or os.path.splitext(input_path)[1]).lower()
+    html_text = backends.get('html_text')
+    extractor = html_text.HTMLTextExtractor()
+    pipeline = postprocess.build_pipeline(normalize)
+    parts, length = [], 0
+    encoding = None
+
+    if file_ext in MOBI_EXTENSIONS:
+        reader = backends.get('mobi_reader')(input_path)
+        chunks = reader.iter_text()
+        for chunk in chunks:
+            text = pipeline.feed(extractor.feed(chunk))
+            parts.append(text)
+            length += len(text)
+            if length > max_chars:
+                break
+        else:
+            parts.append(pipeline.feed(extractor.close()) + pipeline.close())
+        chunks.close()
+        encoding = reader.encoding
+    elif file_ext == '.epub':
+        with backends.get('epub_reader')(input_path) as book:
+            for name in book.documents():
+                with book.open(name) as stream:
+                    for text in html_text.iter_html_text(stream):
+                        text = pipeline.feed(text)
+                        parts.append(text)
+                        length += len(text)
+                        if length > max_chars:
+                            break
+                if length > max_chars:
+                    break
+                text = pipeline.feed(CHAPTER_SEPARATOR)
+                parts.append(text)
+                length += len(text)
+    else:
+        raise ValueError(f"不支持的格式: {file_ext}")
+
+    text = ''.join(parts)
+    return {
+        'text': text[:max_chars],
+        'truncated': len(text) > max_chars,
+        'format': file_ext.lstrip('.'),
+        'encoding': encoding,
+    }
+
+def _error_text(e):
+    # MemoryError 没有消息文本；在限制了内存的工作进程中它意味着触及上限
+    if isinstance(e, MemoryError):
+        return "转换所需内存超出限制"
+    return str(e)
 
 class Converter:
-    def __init__(self):
+    def __init__(self, workers=1, compression=None, normalize=(), checkpoint_interval=DEFAULT_INTERVAL):
+        """
+        workers: 用于解压大型 MOBI 和提取 EPUB 章节的进程数，1 表示单进程，None 表示使用全部 CPU。
+        compression: 输出的压缩方式（'gzip'、'zstd'），None 表示按输出文件的后缀（.gz/.zst）决定。
+        normalize: 写出前额外做的文本规范化（'width' 全角字母数字转半角，'nfc' Unicode NFC），
+        见 postprocess.py；去除行尾空白、合并连续空行总是进行。
+        checkpoint_interval: 保存检查点的间隔秒数（见 checkpoint.py），0 表示每章/每条记录都保存。
+        """
+        self.workers = workers
+        self.compression = compression
+        self.normalize = postprocess.parse_normalize(normalize)
+        self.checkpoint_interval = checkpoint_interval
         self.stop_event = threading.Event()
         self.pause_event = threading.Event()
         self.pause_event.set() # 设置为 True 表示“未暂停”（运行中）
+        # 停止后是否保留半成品和检查点以便继续（取消时不保留）
+        self.keep_checkpoint = True
+        # 最近一次转换的分阶段耗时（metrics 关闭时为 NULL_TIMINGS）
+        self.timings = metrics.NULL_TIMINGS
 
     def convert_file(self, input_path, output_path=None, update_callback=None):
         """
         转换单个文件。
         update_callback(progress, status_message)
+
+        输出先写入 <输出>.part，成功后再原子地重命名为输出文件。转换过程中定期保存检查点，
+        停止、暂停时也会保存；进程被杀死或停止后，以相同参数再次转换同一文件时从检查点继续。
+        以 stop(keep_checkpoint=False) 取消时半成品和检查点一并删除。
         """
         if not os.path.exists(input_path):
             return False, "文件未找到"
 
         file_ext = os.path.splitext(input_path)[1].lower()
         if output_path is None:
-            output_path = os.path.splitext(input_path)[0] + ".txt"
+            output_path = outputs.stored_path(os.path.splitext(input_path)[0] + ".txt", self.compression)
         
         # 确保输出目录存在
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
+        self.timings = metrics.new_timings(format=file_ext.lstrip('.'))
+        checkpoint = None
         try:
             if file_ext == '.epub':
-                return self._convert_epub(input_path, output_path, update_callback)
-            elif file_ext == '.mobi':
-                return self._convert_mobi(input_path, output_path, update_callback)
+                checkpoint = self._new_checkpoint(input_path, output_path)
+                result = self._convert_epub(input_path, output_path, update_callback, checkpoint)
+            elif file_ext in MOBI_EXTENSIONS:
+                checkpoint = self._new_checkpoint(input_path, output_path)
+                result = self._convert_mobi(input_path, output_path, update_callback, checkpoint)
             else:
-                return False, f"不支持的格式: {file_ext}"
+                result = False, f"不支持的格式: {file_ext}"
         except Exception as e:
-            return False, str(e)
+            result = False, _error_text(e)
 
-    def _convert_epub(self, input_path, output_path, callback):
-        if not HAS_EPUB_LIB:
-            return False, "缺少库 'ebooklib' 或 'bs4'。"
-            
+        if checkpoint is not None:
+            if result[0]:
+                checkpoint.finish()
+            elif not (self.stop_event.is_set() and self.keep_checkpoint and os.path.exists(checkpoint.path)):
+                # 失败、取消（或停止时无法保存检查点）则不保留半成品
+                checkpoint.discard()
+
+        if self.timings.enabled:
+            self.timings.bytes_in = os.path.getsize(input_path)
+            if os.path.exists(output_path):
+                self.timings.bytes_out = os.path.getsize(output_path)
+            self.timings.finish(status='success' if result[0] else 'failure')
+        return result
+
+    def _new_checkpoint(self, input_path, output_path):
+        # 输出取决于转换器版本、压缩方式和规范化选项，任一变化则旧检查点作废
+        options = {'version': CONVERTER_VERSION, 'normalize': list(self.normalize),
+                   'compression': self.compression or outputs.compression_of(output_path)}
+        return Checkpoint(output_path, input_path, options, self.checkpoint_interval)
+
+    def _save_checkpoint(self, checkpoint, f, **position):
+        if checkpoint is not None:
+            with self.timings.stage('checkpoint'):
+                checkpoint.save(f, **position)
+
+    def _convert_epub(self, input_path, output_path, callback, checkpoint=None):
         try:
-            book = epub.read_epub(input_path)
-            items = list(book.get_items_of_type(ebooklib.ITEM_DOCUMENT))
-            total_items = len(items)
+            # 只解析 container.xml 和 OPF，按书脊（阅读）顺序逐章流式读取，
+            # 不会解压图片和字体
+            with backends.get('epub_reader')(input_path) as book:
+                documents = book.documents()
+                total_items = len(documents)
+                # 从检查点继续时跳过已写出的章节（章节之间不需要保存 HTML 解析状态）
+                resume = checkpoint.load() if checkpoint is not None else None
+                start = resume['chapters'] if resume else 0
+                if resume:
+                    self.timings.labels['resumed'] = True
+
+                with self._open_output(output_path, checkpoint, resume) as f:
+                    workers = self._worker_count()
+                    if workers > 1 and total_items - start >= PARALLEL_MIN_CHAPTERS:
+                        self.timings.labels['path'] = 'epub_parallel'
+                        completed = self._write_chapters_parallel(input_path, documents, f, callback, workers,
+                                                                  checkpoint, start)
+                    else:
+                        self.timings.labels['path'] = 'epub'
+                        completed = self._write_chapters(book, documents, f, callback, checkpoint, start)
+
+            if not completed:
+                return False, "用户已停止"
+            return True, "成功"
+        except Exception as e:
+            return False, f"EPUB 错误: {_error_text(e)}"
+
+    def _write_chapters(self, book, documents, f, callback, checkpoint=None, start=0):
+        total_items = len(documents)
+        timings = self.timings
+        iter_html_text = backends.get('html_text').iter_html_text
+        for i in range(start, total_items):
+            name = documents[i]
+            # 检查控制标志；暂停或停止前保存检查点
+            if self._wait_if_paused(lambda: self._save_checkpoint(checkpoint, f, chapters=i)):
+                return False
+
+            # 提取文本（块级标签之间以空行分隔）
+            with book.open(name) as stream:
+                texts = iter_html_text(stream)
+                while True:
+                    with timings.stage('html_to_text'):
+                        text = next(texts, None)
+                    if text is None:
+                        break
+                    f.write(text)
             
-            with open(output_path, 'w', encoding='utf-8') as f:
-                for i, item in enumerate(items):
-                    # 检查控制标志
-                    if self.stop_event.is_set():
-                        return False, "用户已停止"
-                    
-                    while not self.pause_event.is_set():
-                        time.sleep(0.1)
-                        if self.stop_event.is_set():
-                             return False, "用户已停止"
-
-                    # 提取文本
-                    content = item.get_content()
-                    soup = BeautifulSoup(content, 'html.parser')
-                    
-                    # 获取标题（如果可能）（有时标题在 h1/h2 中）
-                    # 简单的文本提取，保留换行符
-                    text = soup.get_text(separator='\n\n')
-                    
+            f.write(CHAPTER_SEPARATOR) # 章节分隔符
+            if checkpoint is not None and checkpoint.due():
+                self._save_checkpoint(checkpoint, f, chapters=i + 1)
+
+            if callback:
+                progress = (i + 1) / total_items * 100
+                callback(progress, f"正在处理章节 {i+1}/{total_items}")
+        return True
+
+    def _write_chapters_parallel(self, input_path, documents, f, callback, workers, checkpoint=None, start=0):
+        """
+        在进程池中提取章节文本，由一个写入线程按书脊顺序写出。
+        已提交但尚未写出的章节不超过重排窗口，乱序完成时内存也有上限。
+        检查点只由写入线程保存；停止时等写入线程写完已取得的章节后再保存。
+        """
+        total_items = len(documents)
+        window = workers * REORDER_WINDOW_PER_WORKER
+        texts = queue.Queue(maxsize=window)
+        write_errors = []
+        # 已写出的章节数
+        written = [start]
+
+        def writer():
+            for i in range(start, total_items):
+                text = texts.get()
+                if text is None:
+                    return
+                if write_errors:
+                    continue  # 继续取出队列，避免提交方阻塞
+                try:
                     f.write(text)
-                    f.write('\n\n' + '-'*20 + '\n\n') # 章节分隔符
-                    
+                    f.write(CHAPTER_SEPARATOR) # 章节分隔符
+                    written[0] = i + 1
+                    if checkpoint is not None and checkpoint.due():
+                        self._save_checkpoint(checkpoint, f, chapters=i + 1)
                     if callback:
                         progress = (i + 1) / total_items * 100
                         callback(progress, f"正在处理章节 {i+1}/{total_items}")
-            
+                except Exception as e:
+                    write_errors.append(e)
+
+        # 只有并行转换才需要进程池模块
+        from concurrent.futures import ProcessPoolExecutor
+
+        writer_thread = threading.Thread(target=writer, daemon=True)
+        writer_thread.start()
+        pending = deque()
+        stopped = False
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                next_index = start
+                while (next_index < total_items or pending) and not stopped:
+                    while next_index < total_items and len(pending) < window:
+                        if self._wait_if_paused():
+                            stopped = True
+                            break
+                        pending.append(pool.submit(_extract_chapter, input_path, documents[next_index]))
+                        next_index += 1
+                    if stopped:
+                        break
+
+                    # 等待子进程的时间计入文本提取阶段
+                    with self.timings.stage('html_to_text'):
+                        text = pending.popleft().result()
+                    if write_errors:
+                        raise write_errors[0]
+                    if self.stop_event.is_set():
+                        stopped = True
+                        break
+                    texts.put(text)
+        finally:
+            for future in pending:
+                future.cancel()
+            texts.put(None)
+            writer_thread.join()
+
+        if write_errors:
+            raise write_errors[0]
+        if stopped:
+            self._save_checkpoint(checkpoint, f, chapters=written[0])
+            return False
+        return True
+
+    def _open_output(self, output_path, checkpoint=None, resume=None):
+        # 输出阶段直接写入压缩文件，不先写出未压缩的 TXT；
+        # 写入的文本先经过 postprocess 流水线（合并空行、可选的规范化），
+        # 其耗时分别计入 postprocess 和 write 阶段。
+        # 有检查点时写入 <输出>.part，resume 为检查点时截回检查点处继续写
+        compression = self.compression or outputs.compression_of(output_path)
+        path = checkpoint.temp_path if checkpoint is not None else output_path
+        f = outputs.open_text(path, compression, resume['output'] if resume else None)
+        writer = postprocess.TextWriter(f, postprocess.build_pipeline(self.normalize), self.timings)
+        if resume:
+            writer.pipeline.set_state(resume['pipeline'])
+        return writer
+
+    def _worker_count(self):
+        return self.workers if self.workers is not None else (os.cpu_count() or 1)
+
+    def _convert_mobi(self, input_path, output_path, callback, checkpoint=None):
+        # 优先使用内置读取器：在进程内流式处理 MOBI 6 和 KF8，不产生临时文件
+        result = self._convert_mobi_builtin(input_path, output_path, callback, checkpoint)
+        if result[0] or result[1] == "用户已停止":
+            return result
+
+        # 内置读取器失败时，如果安装了 mobi 库则用它重试（从头转换，不保存检查点）
+        mobi = backends.get('mobi')
+        if mobi is None:
+            return result
+        print(f"内置读取器失败: {result[1]}，尝试 mobi 库...")
+        self.timings.labels['fallback'] = 'mobi_lib'
+        if checkpoint is not None:
+            checkpoint.discard()
+        return self._convert_mobi_lib(mobi, input_path, output_path, callback, checkpoint)
+
+    def _convert_mobi_lib(self, mobi, input_path, output_path, callback, checkpoint=None):
+        temp_dir = None
+        try:
+            # mobi 库（KindleUnpack 的包装）会把整本书连同图片解压到一个临时目录，
+            # 返回 (临时目录, 主 HTML 文件路径)
+            if callback: callback(10, "正在提取 MOBI 内容...")
+
+            with self.timings.stage('mobi_extract'):
+                temp_dir, filepath = mobi.extract(input_path)
+
+            if callback: callback(50, "正在解析提取的内容...")
+            if not os.path.exists(filepath):
+                return False, "MOBI 提取失败（无输出文件）"
+
+            # 分块读取 HTML 并流式提取文本，不把整本书读入内存
+            self.timings.labels['path'] = 'mobi_lib'
+            timings = self.timings
+            extractor = backends.get('html_text').HTMLTextExtractor()
+            with open(filepath, 'r', encoding='utf-8', errors='ignore') as html_file, \
+                    self._open_output(output_path, checkpoint) as f:
+                while True:
+                    with timings.stage('read'):
+                        content = html_file.read(HTML_CHUNK_SIZE)
+                    if not content:
+                        break
+                    with timings.stage('html_to_text'):
+                        text = extractor.feed(content)
+                    f.write(text)
+                f.write(extractor.close())
             return True, "成功"
         except Exception as e:
-            return False, f"EPUB 错误: {str(e)}"
+            return False, f"MOBI 错误: {_error_text(e)}"
+        finally:
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
 
-    def _convert_mobi(self, input_path, output_path, callback):
-        if not HAS_MOBI_LIB and not HAS_INTERNAL_MOBI:
-             return False, "缺少库 'mobi' 且内置读取器不可用。"
-        
-        # 优先尝试标准库 mobi
-        if HAS_MOBI_LIB:
-            try:
-                # 'mobi' 库通常会解压到一个临时目录
-                # 但我们可以尝试用它来获取内容。
-                # 实际上，'mobi' python 包 (pip install mobi) 是 KindleUnpack 的包装器
-                # 或者类似的工具，或者一个纯 python 阅读器。
-                # 假设标准用法: mobi.extract(path)
-                
-                if callback: callback(10, "正在提取 MOBI 内容...")
-                
-                temp_dir, filepath = mobi.extract(input_path)
-                
-                # 结果通常是一个 HTML 文件或 OPF
-                if callback: callback(50, "正在解析提取的内容...")
-                
-                # 现在我们需要读取提取的 html 文件并转换为 txt
-                # filepath 通常指向 html 文件
-                
-                if os.path.exists(filepath):
-                    with open(filepath, 'r', encoding='utf-8', errors='ignore') as html_file:
-                        content = html_file.read()
-                        
-                    if HAS_EPUB_LIB: # 使用 BS4
-                        soup = BeautifulSoup(content, 'html.parser')
-                        text = soup.get_text(separator='\n\n')
-                    else:
-                        # 如果缺少 bs4，则使用回退的粗略正则表达式（如果存在 mobi，则不太可能缺少）
-                        import re
-                        text = re.sub('<[^<]+?>', '', content)
-                    
-                    with open(output_path, 'w', encoding='utf-8') as f:
-                        f.write(text)
-                        
-                    return True, "成功"
-                else:
-                    return False, "MOBI 提取失败（无输出文件）"
-                    
-            except Exception as e:
-                # 如果标准库失败，尝试使用内置读取器
-                print(f"标准 mobi 库失败: {e}，尝试内置读取器...")
-                pass
-
-        # 使用内置读取器作为回退或首选
-        if HAS_INTERNAL_MOBI:
-            try:
-                if callback: callback(10, "正在使用内置读取器解析...")
-                reader = MobiReader(input_path)
-                content = reader.extract_text()
-                
-                if not content:
-                    return False, "提取内容为空 (可能是加密文件或不支持的压缩格式)"
-                
-                # Clean HTML tags
-                if callback: callback(50, "正在清理 HTML 标签...")
-                
-                if HAS_EPUB_LIB:
-                    try:
-                        # Try to parse with BeautifulSoup
-                        # Some MOBI content might be partial HTML, BS4 handles it well
-                        soup = BeautifulSoup(content, 'html.parser')
-                        
-                        # Remove style and script tags
-                        for script in soup(["script", "style"]):
-                            script.decompose()
-                            
-                        text = soup.get_text(separator='\n\n')
-                    except Exception as bs_e:
-                         print(f"BS4 parsing failed: {bs_e}, falling back to regex")
-                         import re
-                         text = re.sub(r'<[^>]+>', '', content)
-                else:
-                    import re
-                    # Basic regex to strip HTML tags
-                    text = re.sub(r'<[^>]+>', '', content)
-
-                with open(output_path, 'w', encoding='utf-8') as f:
+    def _convert_mobi_builtin(self, input_path, output_path, callback, checkpoint=None):
+        try:
+            if callback: callback(10, "正在使用内置读取器解析...")
+            self.timings.labels['path'] = 'builtin'
+            reader = backends.get('mobi_reader')(input_path, workers=self.workers, timings=self.timings)
+            timings = self.timings
+
+            # 逐条记录解压、解码并去除 HTML 标签，直接写入输出文件，
+            # 内存占用与书籍大小无关
+            extractor = backends.get('html_text').HTMLTextExtractor()
+            has_content = False
+            # 从检查点继续：跳过已处理的记录（KF8 为文件），恢复解码器、HTML 解析器的状态
+            resume = checkpoint.load() if checkpoint is not None else None
+            start = 0
+            if resume:
+                start, has_content = resume['chunks'], resume['has_content']
+                extractor.set_state(resume['extractor'])
+                self.timings.labels['resumed'] = True
+
+            def save(done):
+                self._save_checkpoint(checkpoint, f, chunks=done, has_content=has_content, encoding=reader.encoding,
+                                      decoder=reader.decoder_state(), extractor=extractor.get_state())
+
+            with self._open_output(output_path, checkpoint, resume) as f:
+                chunks = reader.iter_text(resume['encoding'], start, resume['decoder']) if resume else reader.iter_text()
+                for i, chunk in enumerate(chunks, start):
+                    has_content = has_content or bool(chunk)
+                    with timings.stage('html_to_text'):
+                        text = extractor.feed(chunk)
                     f.write(text)
-                return True, "成功 (内置模式)"
-            except Exception as e:
-                return False, f"MOBI 错误: {str(e)}"
-        
-        return False, "无法转换此 MOBI 文件"
 
-    def stop(self):
+                    # 解码器已读入第 i 条记录，因此在处理完这一条之后才检查控制标志
+                    if self._wait_if_paused(lambda: save(i + 1)):
+                        return False, "用户已停止"
+                    if checkpoint is not None and checkpoint.due():
+                        save(i + 1)
+
+                    total = reader.chunk_count
+                    if callback and total:
+                        progress = 10 + min(i + 1, total) / total * 90
+                        unit = "文件" if reader.kf8 else "记录"
+                        callback(progress, f"正在处理{unit} {i+1}/{total}")
+                f.write(extractor.close())
+
+            if not has_content:
+                return False, "提取内容为空 (可能是加密文件或不支持的压缩格式)"
+            return True, "成功 (内置模式)"
+        except Exception as e:
+            return False, f"MOBI 错误: {_error_text(e)}"
+
+    def _wait_if_paused(self, save=None):
+        """阻塞直到恢复运行；如果已停止则返回 True。save 在暂停或停止时先被调用（保存检查点）。"""
+        if save and (self.stop_event.is_set() or not self.pause_event.is_set()):
+            save()
+        while not self.pause_event.is_set():
+            time.sleep(0.1)
+            if self.stop_event.is_set():
+                return True
+        return self.stop_event.is_set()
+
+    def stop(self, keep_checkpoint=True):
+        """停止转换；keep_checkpoint 为 False 时（取消）不保留半成品和检查点。"""
+        self.keep_checkpoint = keep_checkpoint
         self.stop_event.set()
 
     def pause(self):
@@ -0,0 +1,529 @@
+"""
+Synthetic MOBI and EPUB fixtures for tests and benchmarks.
+
+Provides PalmDOC and HUFF/CDIC compressors, the original byte-at-a-time
+PalmDOC decompressor (kept as a reference implementation) and writers for
+minimal but valid MOBI, KF8 (AZW3) and EPUB files, plus a generator for
+whole books of a chosen size, chapter count and encoding.
+
+Usage: python corpus.py OUTPUT_DIR [--sizes 1 8] [--chapters 20] [--encodings utf-8 gb18030 cp1252]
+"""
+import argparse
+import io
+import os
+import random
+import struct
+import tempfile
+import zipfile
+from collections import Counter
+from html import escape
+
+from huffcdic import CDIC_MAGIC, HUFF_MAGIC
+
+PALMDOC_RECORD_SIZE = 4096
+# Trailing entries appended to every text record when build_mobi(trailing_entries=True):
+# a one byte multibyte-overlap entry followed by a three byte indexing entry
+TRAILING_ENTRIES = b'\x00' + b'\xaa\xbb\x83'
+TRAILING_FLAGS = 0b11
+
+
+def compress_palmdoc(data):
+    """Compress one record (at most 4096 bytes) with PalmDOC LZ77."""
+    data = bytes(data)
+    out = bytearray()
+    length = len(data)
+    i = 0
+
+    while i < length:
+        # LZ77: look for the nearest match of at least 3 bytes in the last 2047 bytes
+        if i + 3 <= length:
+            window_start = max(0, i - 2047)
+            pos = data.rfind(data[i:i + 3], window_start, i + 2)
+            if 0 <= pos < i:
+                size = 3
+                while size < 10 and i + size < length and data[pos + size] == data[i + size]:
+                    size += 1
+                dist = i - pos
+                pair = 0x8000 | (dist << 3) | (size - 3)
+                out += struct.pack('>H', pair)
+                i += size
+                continue
+
+        byte = data[i]
+        if byte == 0x20 and i + 1 < length and 0x40 <= data[i + 1] <= 0x7F:
+            out.append(data[i + 1] ^ 0x80)
+            i += 2
+        elif byte == 0x00 or 0x09 <= byte <= 0x7F:
+            out.append(byte)
+            i += 1
+        else:
+            # Escape a run of up to 8 bytes that cannot be stored as literals
+            end = i + 1
+            while end < length and end - i < 8 and (data[end] >= 0x80 or 0x01 <= data[end] <= 0x08):
+                end += 1
+            out.append(end - i)
+            out += data[i:end]
+            i = end
+
+    return bytes(out)
+
+
+def reference_decompress_palmdoc(data):
+    """The original byte-at-a-time decompressor from MobiReader."""
+    output = bytearray()
+    i = 0
+    length = len(data)
+
+    while i < length:
+        byte = data[i]
+        i += 1
+
+        if byte == 0x00:
+            output.append(byte)
+        elif 0x01 <= byte <= 0x08:
+            count = byte
+            if i + count > length:
+                count = length - i
+            output.extend(data[i:i+count])
+            i += count
+        elif 0x09 <= byte <= 0x7F:
+            output.append(byte)
+        elif 0xC0 <= byte <= 0xFF:
+            output.append(0x20)
+            output.append(byte ^ 0x80)
+        else:
+            if i >= length:
+                break
+            next_byte = data[i]
+            i += 1
+
+            pair = (byte << 8) | next_byte
+            dist = (pair >> 3) & 0x07FF
+            count = (pair & 0x0007) + 3
+
+            for _ in range(count):
+                if dist > len(output):
+                    output.append(0)
+                else:
+                    output.append(output[-dist])
+
+    return output
+
+
+def _pack_codes(codes, code_length):
+    value, bits = 0, 0
+    for code in codes:
+        value = (value << code_length) | code
+        bits += code_length
+    padding = -bits % 8
+    return (value << padding).to_bytes((bits + padding) // 8, 'big')
+
+
+def _common_phrases(data, limit):
+    counts = Counter()
+    sample = data[:256 * 1024]
+    for size in (2, 3, 4, 6):
+        counts.update(sample[i:i + size] for i in range(0, len(sample) - size, size // 2 or 1))
+    return [phrase for phrase, count in counts.most_common(limit) if count > 1]
+
+
+def compress_huffcdic(chunks, phrase_limit=300):
+    """
+    Compress text records with HUFF/CDIC.
+
+    Every phrase gets a code of the same length, which keeps the encoder
+    simple while still exercising the decoder's lookup tables.  Some phrases
+    are stored compressed so the nested-phrase path is covered as well.
+    Returns (huff_record, cdic_records, compressed_chunks).
+    """
+    phrases = [(bytes((b,)), True) for b in range(256)]
+    common = _common_phrases(b''.join(chunks), phrase_limit)
+    phrases += [(phrase, True) for phrase in common]
+    # Pairs of common phrases stored as compressed phrases
+    nested = [(common[i], common[i + 1]) for i in range(0, min(len(common), 40) - 1, 2)]
+
+    total = len(phrases) + len(nested)
+    code_length = max(9, (total - 1).bit_length())
+    max_code = total - 1
+    index_of = {phrase: index for index, (phrase, _) in enumerate(phrases)}
+
+    def encode_symbols(indexes):
+        return _pack_codes([max_code - index for index in indexes], code_length)
+
+    for first, second in nested:
+        index_of[first + second] = len(phrases)
+        phrases.append((encode_symbols([index_of[first], index_of[second]]), False))
+
+    longest = max(len(phrase) for phrase in index_of)
+    compressed = []
+    for chunk in chunks:
+        indexes = []
+        i = 0
+        while i < len(chunk):
+            for size in range(min(longest, len(chunk) - i), 0, -1):
+                index = index_of.get(chunk[i:i + size])
+                if index is not None:
+                    indexes.append(index)
+                    i += size
+                    break
+        compressed.append(encode_symbols(indexes))
+
+    # HUFF: one non-terminal entry per leading byte, all codes have the same length
+    table = [code_length | (max_code << 8) if code_length > 8 else code_length | 0x80 | (max_code << 8)] * 256
+    limits = [0] * 64
+    limits[2 * (code_length - 1) + 1] = max_code
+    huff = HUFF_MAGIC + struct.pack('>LLQ', 24, 24 + 1024, 0) + struct.pack('>256L', *table) + struct.pack('>64L', *limits)
+
+    cdics = []
+    bits = 8
+    for start in range(0, len(phrases), 1 << bits):
+        group = phrases[start:start + (1 << bits)]
+        offsets, body = [], bytearray()
+        for phrase, literal in group:
+            offsets.append(2 * len(group) + len(body))
+            body += struct.pack('>H', len(phrase) | (0x8000 if literal else 0)) + phrase
+        cdics.append(CDIC_MAGIC + struct.pack('>LL', len(phrases), bits) +
+                     struct.pack('>%dH' % len(group), *offsets) + bytes(body))
+
+    return huff, cdics, compressed
+
+
+def split_records(data, record_size=PALMDOC_RECORD_SIZE):
+    return [data[i:i + record_size] for i in range(0, len(data), record_size)]
+
+
+def build_mobi(text, encoding='utf-8', compression=2, title='Synthetic Book', trailing_entries=False,
+               code_page=None):
+    """
+    Build a MOBI file from text (str or bytes) and return its bytes.
+
+    compression is 1 (none), 2 (PalmDOC) or 17480 (HUFF/CDIC).  code_page
+    overrides the text encoding stored in the MOBI header.
+    """
+    if isinstance(text, str):
+        text = text.encode(encoding)
+    if code_page is None:
+        code_page = {'utf-8': 65001, 'cp1252': 1252}.get(encoding.lower(), 0)
+
+    chunks = split_records(text)
+    huff_records = []
+    if compression == 2:
+        records = [compress_palmdoc(chunk) for chunk in chunks]
+    elif compression == 17480:
+        huff, cdics, records = compress_huffcdic(chunks)
+        huff_records = [huff] + cdics
+    else:
+        records = list(chunks)
+    if trailing_entries:
+        records = [record + TRAILING_ENTRIES for record in records]
+
+    huff = (len(records) + 1, len(huff_records)) if huff_records else None
+    record0 = mobi_record0(len(text), len(records), compression, code_page, title, huff=huff,
+                           extra_flags=TRAILING_FLAGS if trailing_entries else 0)
+
+    all_records = [record0] + records + huff_records + [b'\xe9\x8e\r\n']  # EOF record
+    return build_pdb(all_records, title)
+
+
+def mobi_record0(text_length, record_count, compression, code_page, title, version=6, header_length=0xE8,
+                 huff=None, extra_flags=0, exth=None, fields=()):
+    """
+    Build record 0: the PalmDOC header, the MOBI header, an optional EXTH
+    block ({type: bytes}) and the full title.  fields are extra
+    (offset in record 0, value) pairs written as 32-bit integers.
+    """
+    title_bytes = title.encode('utf-8')
+    exth_data = b''
+    if exth:
+        body = b''.join(struct.pack('>LL', kind, len(value) + 8) + value for kind, value in exth.items())
+        exth_data = b'EXTH' + struct.pack('>LL', len(body) + 12, len(exth)) + body
+        exth_data += b'\0' * (-len(exth_data) % 4)
+
+    palmdoc_header = struct.pack('>HHLHHHH', compression, 0, text_length, record_count, PALMDOC_RECORD_SIZE, 0, 0)
+    mobi_header = bytearray(header_length)
+    mobi_header[0:4] = b'MOBI'
+    struct.pack_into('>LLLL', mobi_header, 4, header_length, 2, code_page, 0)
+    struct.pack_into('>L', mobi_header, 20, version)  # file version
+    struct.pack_into('>L', mobi_header, 64, record_count + 1)  # first non-book record
+    struct.pack_into('>LL', mobi_header, 68, 16 + header_length + len(exth_data), len(title_bytes))
+    struct.pack_into('>L', mobi_header, 92, 0xFFFFFFFF)  # first image record
+    if huff:
+        struct.pack_into('>LL', mobi_header, 96, *huff)
+    if exth:
+        struct.pack_into('>L', mobi_header, 0x70, 0x40)
+    if extra_flags:
+        struct.pack_into('>H', mobi_header, 0xE2, extra_flags)
+    for offset, value in fields:
+        struct.pack_into('>L', mobi_header, offset - 16, value)
+    return palmdoc_header + bytes(mobi_header) + exth_data + title_bytes + b'\0' * 4
+
+
+def _varint(value):
+    """Forward-encoded variable width value; the last byte has the high bit set."""
+    data = [value & 0x7F | 0x80]
+    value >>= 7
+    while value:
+        data.insert(0, value & 0x7F)
+        value >>= 7
+    return bytes(data)
+
+
+def build_index(entries, tags):
+    """
+    Build the INDX records of a KF8 index: a header record with the TAGX
+    table and one record of entries.
+
+    entries: [(name bytes, {tag: [values]}), ...]; tags: [(tag, values per entry), ...].
+    Every tag gets a one-bit mask in a single control byte.
+    """
+    header_length = 0xC0
+    tagx = b''.join(bytes((tag, per_entry, 1 << bit, 0)) for bit, (tag, per_entry) in enumerate(tags))
+    tagx += bytes((0, 0, 0, 1))
+    tagx = b'TAGX' + struct.pack('>LL', 12 + len(tagx), 1) + tagx
+
+    def indx(start, count, total=0):
+        header = bytearray(header_length)
+        header[0:4] = b'INDX'
+        struct.pack_into('>13L', header, 4, header_length, 0, 0, 0, start, count, 65001, 0xFFFFFFFF, total,
+                         0, 0, 0, 0)
+        return header
+
+    primary = bytes(indx(0, 1, len(entries))) + tagx
+
+    body = bytearray()
+    positions = []
+    for name, values in entries:
+        positions.append(header_length + len(body))
+        control = sum(1 << bit for bit, (tag, _) in enumerate(tags) if tag in values)
+        body += bytes((len(name),)) + name + bytes((control,))
+        for tag, _ in tags:
+            body += b''.join(_varint(value) for value in values.get(tag, ()))
+    body += b'\0' * (-len(body) % 4)
+    idxt = b'IDXT' + struct.pack('>%dH' % len(positions), *positions)
+    data = bytes(indx(header_length + len(body), len(entries))) + bytes(body) + idxt
+    return [primary, data + b'\0' * (-len(data) % 4)]
+
+
+def build_kf8(files, title='Synthetic Book', compression=2, css='p { margin: 0 }', mobi6_text=None):
+    """
+    Build a KF8 (AZW3) book from complete XHTML files (str) and return its bytes.
+
+    Each file is stored the way KF8 does: its skeleton (the markup with the
+    body cut out) followed by the body split into two fragments, with a CSS
+    flow after the XHTML flow.  With mobi6_text the book is a combined
+    MOBI 6/KF8 file whose MOBI 6 copy holds that text.
+    """
+    text = bytearray()
+    skeletons, fragments = [], []
+    for number, html in enumerate(files):
+        data = html.encode('utf-8')
+        body_start = data.index(b'<body>') + len(b'<body>')
+        body_end = data.rindex(b'</body>')
+        body = data[body_start:body_end]
+        split = body.find(b'<', len(body) // 2)
+        if split == -1:
+            split = len(body)
+        pieces = (body[:split], body[split:])
+
+        start = len(text)
+        skeleton = data[:body_start] + data[body_end:]
+        text += skeleton + b''.join(pieces)
+        skeletons.append((b'SKEL%010d' % number, {1: [len(pieces)], 6: [start, len(skeleton)]}))
+        insert = start + body_start
+        for sequence, piece in enumerate(pieces):
+            fragments.append((str(insert).encode(), {2: [0], 3: [number], 4: [2 * number + sequence],
+                                                    6: [insert - start, len(piece)]}))
+            insert += len(piece)
+    flow_end = len(text)
+    text += css.encode('utf-8')
+
+    chunks = split_records(bytes(text))
+    records = [compress_palmdoc(chunk) for chunk in chunks] if compression == 2 else list(chunks)
+    fdst = b'FDST' + struct.pack('>LL', 12, 2) + struct.pack('>4L', 0, flow_end, flow_end, len(text))
+    skeleton_index = build_index(skeletons, [(1, 1), (6, 2)])
+    fragment_index = build_index(fragments, [(2, 1), (3, 1), (4, 1), (6, 2)])
+
+    first = len(records) + 1
+    fields = [(0xC0, first), (0xC4, 2), (0xF4, 0xFFFFFFFF), (0xF8, first + 3), (0xFC, first + 1),
+              (0x104, 0xFFFFFFFF)]
+    record0 = mobi_record0(len(text), len(records), compression, 65001, title, version=8, header_length=0x108,
+                           fields=fields)
+    kf8_records = [record0] + records + [fdst] + skeleton_index + fragment_index
+
+    if mobi6_text is None:
+        return build_pdb(kf8_records + [b'\xe9\x8e\r\n'], title)
+
+    mobi6 = mobi6_text.encode('utf-8')
+    mobi6_records = [compress_palmdoc(chunk) for chunk in split_records(mobi6)]
+    boundary = len(mobi6_records) + 2
+    mobi6_record0 = mobi_record0(len(mobi6), len(mobi6_records), 2, 65001, title,
+                                 exth={121: struct.pack('>L', boundary)})
+    return build_pdb([mobi6_record0] + mobi6_records + [b'BOUNDARY'] + kf8_records + [b'\xe9\x8e\r\n'], title)
+
+
+def build_pdb(records, name='Synthetic Book'):
+    """Wrap records in a PDB container of type BOOK/MOBI."""
+    header_size = 78 + 8 * len(records) + 2
+    pdb_name = name.encode('ascii', 'replace')[:31].ljust(32, b'\0')
+    header = bytearray(pdb_name)
+    header += struct.pack('>HHLLLLLL', 0, 0, 0, 0, 0, 0, 0, 0)
+    header += b'BOOKMOBI'
+    header += struct.pack('>LLH', 2 * len(records), 0, len(records))
+
+    offset = header_size
+    for index, record in enumerate(records):
+        header += struct.pack('>LL', offset, 2 * index)
+        offset += len(record)
+    header += b'\0\0'
+
+    return bytes(header) + b''.join(records)
+
+
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+def build_chapter(title, paragraphs, encoding='utf-8'):
+    body = ''.join(f'<p>{escape(paragraph)}</p>\n' for paragraph in paragraphs)
+    return (f'<?xml version="1.0" encoding="{encoding}"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head><title></title></head>\n'
+            f'<body><h2>{escape(title)}</h2>\n{body}</body></html>\n').encode(encoding)
+
+
+def build_epub(chapters, title='Synthetic Book', encoding='utf-8', images=0, image_size=64 * 1024):
+    """
+    Build an EPUB from [(chapter title, [paragraph, ...]), ...] and return its bytes.
+
+    The manifest lists chapters in reverse, so only the spine gives the
+    reading order.  images adds that many incompressible image entries.
+    """
+    manifest, spine = [], []
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+        zf.writestr('META-INF/container.xml', CONTAINER_XML)
+
+        for index, (chapter_title, paragraphs) in enumerate(chapters):
+            name = f'Text/chapter{index:04d}.xhtml'
+            zf.writestr('OEBPS/' + name, build_chapter(chapter_title, paragraphs, encoding))
+            manifest.insert(0, f'<item id="c{index}" href="{name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="c{index}"/>')
+
+        for index in range(images):
+            name = f'Images/image{index:04d}.jpg'
+            # Deterministic, incompressible bytes
+            data = bytes((i * 7919 + index * 104729) % 251 for i in range(image_size))
+            zf.writestr('OEBPS/' + name, data)
+            manifest.append(f'<item id="img{index}" href="{name}" media-type="image/jpeg"/>')
+
+        opf = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">\n'
+               '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+               f'<dc:title>{escape(title)}</dc:title><dc:identifier id="uid">synthetic</dc:identifier></metadata>\n'
+               f'<manifest>{"".join(manifest)}</manifest>\n'
+               f'<spine>{"".join(spine)}</spine>\n'
+               '</package>\n')
+        zf.writestr('OEBPS/content.opf', opf)
+    return buffer.getvalue()
+
+
+# Paragraph material per encoding; every character can be encoded in it
+SAMPLE_PARAGRAPHS = {
+    'utf-8': [
+        '　　天下大势，分久必合，合久必分。周末七国分争，并入于秦。',
+        'It was the best of times, it was the worst of times — “quoted” & <escaped>.',
+        '　　滚滚长江东逝水，浪花淘尽英雄。是非成败转头空，青山依旧在，几度夕阳红。',
+    ],
+    'gb18030': [
+        '　　天下大势，分久必合，合久必分。周末七国分争，并入于秦。',
+        '　　滚滚长江东逝水，浪花淘尽英雄。是非成败转头空，青山依旧在，几度夕阳红。',
+        '　　白发渔樵江渚上，惯看秋月春风。一壶浊酒喜相逢，古今多少事，都付笑谈中。',
+    ],
+    'cp1252': [
+        'Café society met at the façade of the old théâtre — “déjà vu”, they said.',
+        'It was the best of times, it was the worst of times & <escaped> for €5.',
+        'Naïve coöperation of the señor and the Fräulein ended in a smörgåsbord.',
+    ],
+}
+BOOK_KINDS = ('epub', 'mobi')
+
+
+def synthetic_chapters(size, chapters=10, encoding='utf-8', seed=0):
+    """
+    Return [(title, [paragraph, ...]), ...] with about `size` bytes of text
+    once encoded.  The same arguments always give the same chapters.
+    """
+    rng = random.Random(seed)
+    samples = SAMPLE_PARAGRAPHS[encoding.lower()]
+    per_chapter = max(1, size // chapters)
+    result = []
+    for number in range(1, chapters + 1):
+        paragraphs, length = [], 0
+        while length < per_chapter:
+            paragraph = f'{rng.choice(samples)} {number}.{len(paragraphs)}'
+            paragraphs.append(paragraph)
+            length += len(paragraph.encode(encoding))
+        result.append((f'Chapter {number}', paragraphs))
+    return result
+
+
+def synthetic_book(kind, size, chapters=10, encoding='utf-8', seed=0):
+    """Build a PalmDOC MOBI, a KF8 (azw3, UTF-8 only) or an EPUB book of about `size` text bytes."""
+    parts = synthetic_chapters(size, chapters, encoding, seed)
+    if kind == 'epub':
+        return build_epub(parts, encoding=encoding)
+    if kind == 'mobi':
+        html = ''.join(f'<h2>{escape(title)}</h2>' + ''.join(f'<p>{escape(p)}</p>' for p in paragraphs) +
+                       '<mbp:pagebreak/>' for title, paragraphs in parts)
+        return build_mobi(f'<html><body>{html}</body></html>', encoding=encoding)
+    if kind == 'azw3':
+        if encoding.lower() != 'utf-8':
+            raise ValueError("KF8 books are always UTF-8")
+        return build_kf8([f'<html><head><title></title></head><body><h2>{escape(title)}</h2>' +
+                          ''.join(f'<p>{escape(p)}</p>' for p in paragraphs) + '</body></html>'
+                          for title, paragraphs in parts])
+    raise ValueError(f"Unknown book kind: {kind}")
+
+
+def write_corpus(directory, sizes_mb=(1,), chapters=(10,), encodings=('utf-8', 'gb18030', 'cp1252'),
+                 kinds=BOOK_KINDS):
+    """Write one book per combination into directory and return their descriptions."""
+    os.makedirs(directory, exist_ok=True)
+    books = []
+    for kind in kinds:
+        for size_mb in sizes_mb:
+            for chapter_count in chapters:
+                for encoding in encodings:
+                    name = f'{kind}-{size_mb:g}mb-{chapter_count}ch-{encoding}.{kind}'
+                    path = os.path.join(directory, name)
+                    with open(path, 'wb') as f:
+                        f.write(synthetic_book(kind, int(size_mb * 1024 * 1024), chapter_count, encoding))
+                    books.append({'path': path, 'kind': kind, 'size_mb': size_mb,
+                                  'chapters': chapter_count, 'encoding': encoding})
+    return books
+
+
+def write_temp_book(data, suffix):
+    """Write data to book<suffix> in a new temporary directory; returns (book path, book.txt path beside it)."""
+    workdir = tempfile.mkdtemp()
+    input_path = os.path.join(workdir, 'book' + suffix)
+    with open(input_path, 'wb') as f:
+        f.write(data)
+    return input_path, os.path.join(workdir, 'book.txt')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic MOBI/EPUB corpus")
+    parser.add_argument('output_dir')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1], help="text size of each book in MB")
+    parser.add_argument('--chapters', type=int, nargs='+', default=[10])
+    parser.add_argument('--encodings', nargs='+', default=list(SAMPLE_PARAGRAPHS), choices=list(SAMPLE_PARAGRAPHS))
+    parser.add_argument('--kinds', nargs='+', default=list(BOOK_KINDS), choices=list(BOOK_KINDS))
+    args = parser.parse_args()
+    for book in write_corpus(args.output_dir, args.sizes, args.chapters, args.encodings, args.kinds):
+        print(f"{book['path']}  {os.path.getsize(book['path']) / 1024 / 1024:.2f} MB")
@@ -0,0 +1,87 @@
+"""
+Lightweight EPUB reader built on zipfile.
+
+Only META-INF/container.xml and the OPF package document are parsed up
+front.  Chapters are listed in spine (reading) order and each one is opened
+as a stream when it is needed; images, fonts and other members of the
+archive are never decompressed.
+"""
+import posixpath
+import zipfile
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+CONTAINER_PATH = 'META-INF/container.xml'
+HTML_MEDIA_TYPES = frozenset(['application/xhtml+xml', 'text/html'])
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class EpubReader:
+    def __init__(self, filename):
+        self.filename = filename
+        self.title = None
+        self.opf_path = None
+        self.spine = []  # (member name, media type) in reading order
+        self.zip = zipfile.ZipFile(filename)
+        try:
+            self._load_package()
+        except Exception:
+            self.zip.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def _read_xml(self, name):
+        try:
+            data = self.zip.read(name)
+        except KeyError:
+            raise ValueError(f"EPUB is missing {name}")
+        return ElementTree.fromstring(data)
+
+    def _load_package(self):
+        container = self._read_xml(CONTAINER_PATH)
+        self.opf_path = next((element.get('full-path') for element in container.iter()
+                              if _local_name(element.tag) == 'rootfile' and element.get('full-path')), None)
+        if not self.opf_path:
+            raise ValueError("container.xml does not name a package document")
+
+        package = self._read_xml(self.opf_path)
+        base = posixpath.dirname(self.opf_path)
+        manifest = {}
+        itemrefs = []
+        for element in package.iter():
+            name = _local_name(element.tag)
+            if name == 'item' and element.get('id'):
+                manifest[element.get('id')] = (self._resolve(base, element.get('href', '')),
+                                               element.get('media-type', ''))
+            elif name == 'itemref':
+                itemrefs.append(element.get('idref'))
+            elif name == 'title' and self.title is None:
+                self.title = (element.text or '').strip() or None
+
+        self.spine = [manifest[idref] for idref in itemrefs if idref in manifest]
+
+    @staticmethod
+    def _resolve(base, href):
+        # Manifest hrefs are URLs relative to the OPF file
+        path = unquote(href.split('#', 1)[0])
+        return posixpath.normpath(posixpath.join(base, path)) if base else posixpath.normpath(path)
+
+    def documents(self):
+        """Member names of the (X)HTML documents in the spine, in reading order."""
+        members = set(self.zip.namelist())
+        return [name for name, media_type in self.spine if media_type in HTML_MEDIA_TYPES and name in members]
+
+    def open(self, name):
+        """Open an archive member as a binary stream."""
+        return self.zip.open(name)
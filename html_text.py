@@ -0,0 +1,205 @@
+"""
+Streaming HTML-to-text extraction.
+
+HTMLTextExtractor is fed HTML in chunks and hands back the text that is
+complete so far, without building a document tree.  Block-level tags become
+paragraph breaks, <br> becomes a line break, inline tags are dropped without
+splitting the surrounding text, and <script>/<style> content is skipped.
+Whitespace from the markup collapses to one space as a browser would show
+it, and a line break between two CJK characters disappears; <pre> content
+is kept as is.
+"""
+import codecs
+import re
+from html.parser import HTMLParser
+
+SKIP_TAGS = frozenset(['script', 'style'])
+
+BLOCK_TAGS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'body', 'caption', 'center', 'dd', 'div', 'dl', 'dt',
+    'figcaption', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hr', 'html',
+    'li', 'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead',
+    'title', 'tr', 'ul',
+    # MOBI markup
+    'mbp:pagebreak', 'mbp:section',
+])
+
+PARAGRAPH_BREAK = '\n\n'
+LINE_BREAK = '\n'
+# Only markup whitespace is trimmed; full-width and no-break spaces are text
+MARKUP_SPACE = ' \t\n\r\f'
+_CJK = '\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef'
+_NEEDS_COLLAPSE = re.compile('[\t\n\r\f]|  ')
+_CJK_LINE_BREAK = re.compile(f'(?<=[{_CJK}])[ \t\f]*[\r\n][ \t\n\r\f]*(?=[{_CJK}])')
+_SPACE_RUN = re.compile('[ \t\n\r\f]+')
+_IS_CJK = re.compile(f'[{_CJK}]').match
+
+# Markup the parser may hold back waiting for the end of a tag, comment or
+# <script>; past this a tag was left open and every feed() would scan it again
+MAX_PENDING_MARKUP = 8 * 1024 * 1024
+
+# How far into a document the encoding declaration is looked for
+SNIFF_SIZE = 1024
+_XML_ENCODING = re.compile(br'''^<\?xml[^>]*encoding=["']([A-Za-z0-9._-]+)["']''')
+_META_CHARSET = re.compile(br'''<meta[^>]+charset=["']?([A-Za-z0-9._-]+)''', re.I)
+
+
+class HTMLTextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._parts = []
+        self._skip_depth = 0
+        self._has_text = False
+        # Break to emit before the next piece of text
+        self._pending_break = ''
+        # Whitespace at the end of the last text, dropped if a block ends there
+        self._trailing_space = ''
+        self._last_char = ''
+        self._pre_depth = 0
+
+    def get_state(self):
+        """Parser and text state between two feed() calls, as JSON-compatible data for a checkpoint."""
+        # Text is handed out by every feed(), so _parts is empty here; the compiled pattern of the HTMLParser state is rebuilt from cdata_elem
+        return {name: value for name, value in vars(self).items() if isinstance(value, (str, int, bool, type(None)))}
+
+    def set_state(self, state):
+        vars(self).update(state)
+        if self.cdata_elem:
+            self.set_cdata_mode(self.cdata_elem)
+        else:
+            self.clear_cdata_mode()
+
+    def _break(self, separator):
+        if self._has_text and len(separator) > len(self._pending_break):
+            self._pending_break = separator
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == 'br':
+            self._break(LINE_BREAK)
+        elif tag in BLOCK_TAGS:
+            self._break(PARAGRAPH_BREAK)
+            if tag == 'pre':
+                self._pre_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            if self._skip_depth:
+                self._skip_depth -= 1
+        elif tag in BLOCK_TAGS:
+            self._break(PARAGRAPH_BREAK)
+            if tag == 'pre' and self._pre_depth:
+                self._pre_depth -= 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag != 'br':
+            self.handle_endtag(tag)
+
+    def unknown_decl(self, data):
+        # XHTML chapters sometimes wrap text in CDATA sections
+        if data.startswith('CDATA['):
+            self.handle_data(data[6:])
+
+    def handle_data(self, data):
+        if self._skip_depth:
+            return
+
+        if self._pending_break or not self._has_text:
+            data = data.lstrip(MARKUP_SPACE)
+            if not data:
+                return
+            if self._pending_break:
+                self._parts.append(self._pending_break)
+                self._pending_break = ''
+        else:
+            # Text continuing the same block; whitespace between the pieces
+            # may arrive split over several calls
+            text = data.lstrip(MARKUP_SPACE)
+            space = self._trailing_space
+            if len(text) != len(data):
+                space += data[:len(data) - len(text)]
+                if not text:
+                    self._trailing_space = space
+                    return
+                data = text
+            if space:
+                self._parts.append(space if self._pre_depth else self._join_space(space, data[0]))
+
+        text = data.rstrip(MARKUP_SPACE)
+        self._trailing_space = data[len(text):]
+        if not self._pre_depth and _NEEDS_COLLAPSE.search(text):
+            text = _SPACE_RUN.sub(' ', _CJK_LINE_BREAK.sub('', text))
+        self._parts.append(text)
+        self._last_char = text[-1]
+        self._has_text = True
+
+    def _join_space(self, space, next_char):
+        if ('\n' in space or '\r' in space) and _IS_CJK(self._last_char) and _IS_CJK(next_char):
+            return ''
+        return ' '
+
+    def _drain(self):
+        text = ''.join(self._parts)
+        self._parts = []
+        return text
+
+    def feed(self, data):
+        """Parse the next chunk of HTML and return the text completed so far."""
+        super().feed(data)
+        if len(self.rawdata) > MAX_PENDING_MARKUP:
+            raise ValueError("HTML markup left unclosed")
+        return self._drain()
+
+    def close(self):
+        """Flush the parser and return the remaining text."""
+        super().close()
+        return self._drain()
+
+
+def sniff_encoding(head):
+    """Pick the encoding of HTML/XHTML bytes from the BOM, XML declaration or meta charset."""
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if head.startswith(bom):
+            return encoding
+
+    head = head[:SNIFF_SIZE]
+    match = _XML_ENCODING.match(head) or _META_CHARSET.search(head)
+    if match:
+        try:
+            return codecs.lookup(match.group(1).decode('ascii')).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+def decode_html(content):
+    """Decode raw HTML/XHTML bytes."""
+    return content.decode(sniff_encoding(content), errors='replace')
+
+
+def html_to_text(content):
+    """Extract the text of a complete HTML document given as str or bytes."""
+    if isinstance(content, (bytes, bytearray)):
+        content = decode_html(bytes(content))
+    extractor = HTMLTextExtractor()
+    return extractor.feed(content) + extractor.close()
+
+
+def iter_html_text(stream, chunk_size=64 * 1024):
+    """Yield the text of an HTML document read from a binary stream in chunks."""
+    # The encoding declaration has to be in the first chunk
+    data = stream.read(max(chunk_size, SNIFF_SIZE))
+    decoder = codecs.getincrementaldecoder(sniff_encoding(data))(errors='replace')
+    extractor = HTMLTextExtractor()
+    while data:
+        text = extractor.feed(decoder.decode(data))
+        if text:
+            yield text
+        data = stream.read(chunk_size)
+
+    text = extractor.feed(decoder.decode(b'', final=True)) + extractor.close()
+    if text:
+        yield text
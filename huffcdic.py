@@ -0,0 +1,120 @@
+"""
+HUFF/CDIC decompression for MOBI text records (compression type 17480).
+
+The HUFF record holds the Huffman code tables and the CDIC records hold the
+dictionary of phrases the codes refer to.  Both are parsed once into lookup
+tables; a phrase that is itself compressed is expanded the first time it is
+used and cached for every later record.
+
+Nested phrases can double in size at every level, so a few hundred bytes of
+hostile CDIC expand to gigabytes; decompress() takes a limit on the output
+of a record and gives up as soon as a record or phrase grows past it.
+"""
+import struct
+
+HUFF_MAGIC = b'HUFF\x00\x00\x00\x18'
+CDIC_MAGIC = b'CDIC\x00\x00\x00\x10'
+
+# Phrases may reference other compressed phrases; real files nest a few levels
+MAX_DEPTH = 32
+
+_read_window = struct.Struct('>Q').unpack_from
+
+
+class HuffCdicDecoder:
+    def __init__(self, huff, cdics):
+        self._load_huff(huff)
+        self.dictionary = []
+        for cdic in cdics:
+            self._load_cdic(cdic)
+
+    def _load_huff(self, huff):
+        if huff[0:8] != HUFF_MAGIC:
+            raise ValueError("Invalid HUFF record")
+        table_offset, limits_offset = struct.unpack_from('>LL', huff, 8)
+
+        # Code-length table, indexed by the first 8 bits of a code:
+        # (code length, code length is final, largest code of that length)
+        self.code_table = []
+        for value in struct.unpack_from('>256L', huff, table_offset):
+            code_length, terminal, max_code = value & 0x1F, bool(value & 0x80), value >> 8
+            if code_length == 0 or (code_length <= 8 and not terminal):
+                raise ValueError("Invalid HUFF code table")
+            self.code_table.append((code_length, terminal, ((max_code + 1) << (32 - code_length)) - 1))
+
+        # Smallest and largest code for each length, left-aligned to 32 bits
+        limits = struct.unpack_from('>64L', huff, limits_offset)
+        self.min_codes = [code << (32 - length) for length, code in enumerate((0,) + limits[0::2])]
+        self.max_codes = [((code + 1) << (32 - length)) - 1 for length, code in enumerate((0,) + limits[1::2])]
+
+    def _load_cdic(self, cdic):
+        if cdic[0:8] != CDIC_MAGIC:
+            raise ValueError("Invalid CDIC record")
+        phrases, bits = struct.unpack_from('>LL', cdic, 8)
+        count = min(1 << bits, phrases - len(self.dictionary))
+
+        for offset in struct.unpack_from('>%dH' % count, cdic, 16):
+            size, = struct.unpack_from('>H', cdic, 16 + offset)
+            phrase = bytes(cdic[18 + offset:18 + offset + (size & 0x7FFF)])
+            # The high bit marks a phrase that is stored uncompressed
+            self.dictionary.append((phrase, bool(size & 0x8000)))
+
+    def decompress(self, data, max_size=None):
+        """Decompress one text record; raises ValueError if it expands past max_size bytes."""
+        output = bytearray()
+        self._unpack(bytes(data), output, 0, max_size or float('inf'))
+        return output
+
+    def _unpack(self, data, output, depth, limit):
+        if depth > MAX_DEPTH:
+            raise ValueError("HUFF phrase nesting too deep")
+
+        code_table = self.code_table
+        min_codes = self.min_codes
+        max_codes = self.max_codes
+        dictionary = self.dictionary
+
+        bits_left = len(data) * 8
+        data += b'\0' * 8
+        pos = 0
+        window, = _read_window(data, pos)
+        shift = 32
+
+        while True:
+            if shift <= 0:
+                pos += 4
+                window, = _read_window(data, pos)
+                shift += 32
+            code = (window >> shift) & 0xFFFFFFFF
+
+            code_length, terminal, max_code = code_table[code >> 24]
+            if not terminal:
+                while code < min_codes[code_length]:
+                    code_length += 1
+                    if code_length > 32:
+                        raise ValueError("Invalid HUFF code")
+                max_code = max_codes[code_length]
+
+            shift -= code_length
+            bits_left -= code_length
+            if bits_left < 0:
+                break
+
+            index = (max_code - code) >> (32 - code_length)
+            try:
+                entry = dictionary[index]
+            except IndexError:
+                raise ValueError("HUFF code outside the CDIC dictionary")
+            if entry is None:
+                raise ValueError("Recursive CDIC phrase")
+
+            phrase, literal = entry
+            if not literal:
+                dictionary[index] = None
+                expanded = bytearray()
+                self._unpack(phrase, expanded, depth + 1, limit)
+                phrase = bytes(expanded)
+                dictionary[index] = (phrase, True)
+            output += phrase
+            if len(output) > limit:
+                raise ValueError("HUFF record expands past its size limit")
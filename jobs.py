@@ -0,0 +1,271 @@
+"""
+Background conversion jobs.
+
+JobQueue runs Converter.convert_file on a fixed number of worker threads so
+HTTP requests return as soon as the upload is saved.  Each Job keeps its own
+Converter, so the existing pause/resume/stop events work on a running
+conversion, and bumps a version counter on every change so listeners can
+wait for the next update.  An optional on_success hook sees each finished
+conversion before it is reported as done, and each job's future resolves
+once it has ended, however it ended.  Jobs live in the memory of one process: run the
+web app with a single process and several threads.
+
+ConversionPool is for batches: it runs whole conversions on a WorkerPool
+sized to the machine and hands back futures.  A batch reserves its slots
+before any file is saved, so beyond max_pending queued or running
+conversions whole batches are turned away rather than piling up.  The app gives JobQueue a
+converter_factory that makes IsolatedConverters, so single jobs run in
+worker processes too.
+"""
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from converter import Converter
+from workers import WorkerPool
+
+QUEUED = 'queued'
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = frozenset([DONE, FAILED, CANCELLED])
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, input_path, output_path, filename, converter, cache_key=None):
+        self.id = uuid.uuid4().hex
+        self.input_path = input_path
+        self.output_path = output_path
+        self.filename = filename
+        self.cache_key = cache_key
+        self.converter = converter
+        self.status = QUEUED
+        self.started = False
+        self.progress = 0
+        self.message = '等待转换'
+        self.created = time.time()
+        self.updated = self.created
+        self.version = 0
+        # Resolves to (success, message, None) once the job has ended, like a ConversionPool future
+        self.future = Future()
+        self._ended = False
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def _update(self, **fields):
+        if fields.get('status') in FINISHED_STATES:
+            # Resolve the future first, so whoever sees the job finished also sees what its callbacks did
+            with self._changed:
+                ended, self._ended = not self._ended, True
+            if ended:
+                self.future.set_result((fields['status'] == DONE, fields.get('message', self.message), None))
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.updated = time.time()
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait_for_change(self, version, timeout=None):
+        """Block until the job changes after version; returns the current version."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def pause(self):
+        if self.finished:
+            return False
+        self.converter.pause()
+        self._update(status=PAUSED, message='已暂停')
+        return True
+
+    def resume(self):
+        if self.status != PAUSED:
+            return False
+        self.converter.resume()
+        self._update(status=RUNNING if self.started else QUEUED, message='已恢复')
+        return True
+
+    def cancel(self):
+        if self.finished:
+            return False
+        # A cancelled job is not resumed: drop its partial output and checkpoint
+        self.converter.stop(keep_checkpoint=False)
+        # Let a paused conversion wake up and see the stop flag
+        self.converter.resume()
+        if not self.started:
+            self._update(status=CANCELLED, message='已取消')
+        return True
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'status': self.status,
+            'progress': round(self.progress, 1),
+            'message': self.message,
+            'created': self.created,
+            'updated': self.updated,
+        }
+
+
+class JobQueue:
+    def __init__(self, workers=2, max_pending=32, keep_seconds=3600, converter_factory=Converter,
+                 on_success=None):
+        """
+        workers: number of conversions that run at the same time.
+        max_pending: jobs allowed to wait for a worker; submit() raises
+        QueueFullError beyond that.
+        keep_seconds: how long finished jobs stay queryable.
+        on_success: called with each successful job; errors are logged only.
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.keep_seconds = keep_seconds
+        self.converter_factory = converter_factory
+        self.on_success = on_success
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, input_path, output_path, filename, cache_key=None):
+        with self._lock:
+            self._prune()
+            if self._queue.qsize() >= self.max_pending:
+                raise QueueFullError("Too many conversions waiting")
+            job = Job(input_path, output_path, filename, self.converter_factory(), cache_key)
+            self._jobs[job.id] = job
+            self._start_workers()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            states = [job.status for job in self._jobs.values()]
+        return {
+            'workers': self.workers,
+            'pending': self._queue.qsize(),
+            'max_pending': self.max_pending,
+            'running': states.count(RUNNING),
+        }
+
+    def _start_workers(self):
+        # Threads start with the first job so importing the app stays cheap
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f'convert-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and job.updated < cutoff]:
+            del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job):
+        if job.finished:
+            return
+        job._update(started=True)
+        if job.status != PAUSED:
+            job._update(status=RUNNING, message='转换中')
+
+        def report(progress, message):
+            job._update(progress=progress, message=message,
+                        status=PAUSED if job.status == PAUSED else RUNNING)
+
+        try:
+            success, message = job.converter.convert_file(job.input_path, job.output_path, report)
+        except Exception as e:
+            success, message = False, str(e)
+        metrics.observe_conversion(job.converter.timings.to_dict(), job.id)
+
+        if success and self.on_success:
+            try:
+                self.on_success(job)
+            except Exception as e:
+                print(f"on_success hook failed for job {job.id}: {e}")
+
+        if success:
+            job._update(status=DONE, progress=100, message=message)
+        elif job.converter.stop_event.is_set():
+            job._update(status=CANCELLED, message='已取消')
+        else:
+            job._update(status=FAILED, message=message)
+
+
+class ConversionPool:
+    def __init__(self, workers=None, normalize=(), max_pending=200, **limits):
+        """
+        max_pending: conversions that may be queued or running at once.
+        limits: memory_limit, timeout, max_jobs and max_rss for the WorkerPool, see workers.py.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.normalize = normalize
+        self.max_pending = max_pending
+        self.limits = limits
+        self._pool = None
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, count):
+        """Claim count slots for a batch; raises QueueFullError if they would exceed max_pending."""
+        with self._lock:
+            if self._pending + count > self.max_pending:
+                raise QueueFullError("Too many conversions waiting")
+            self._pending += count
+
+    def release(self, count=1):
+        """Give back reserved slots that were not submitted."""
+        with self._lock:
+            self._pending -= count
+
+    def submit(self, input_path, output_path):
+        """
+        Convert in a worker process using a reserved slot, which is freed when the
+        conversion ends; the future resolves to (success, message, timings dict or None).
+        """
+        with self._lock:
+            # Processes start with the first batch so importing the app stays cheap
+            if self._executor is None:
+                self._pool = WorkerPool(self.workers, **self.limits)
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch')
+        future = self._executor.submit(self._pool.run, input_path, output_path, {'normalize': self.normalize})
+        future.add_done_callback(lambda f: self.release())
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'pending': self._pending, 'max_pending': self.max_pending}
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._pool.shutdown()
+                self._executor = self._pool = None
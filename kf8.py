@@ -0,0 +1,215 @@
+"""
+KF8 (MOBI 8, AZW3) structures needed to rebuild the text of a book.
+
+KF8 stores its XHTML files taken apart.  The FDST record splits the
+uncompressed text into flows: flow 0 holds the XHTML, later flows hold CSS
+and SVG.  The skeleton index lists, per file, the outer markup with the body
+cut out, and the fragment index lists the body pieces that follow it and
+where each one is inserted back.  A book may also carry an older MOBI 6
+copy first, in which case EXTH record 121 gives the record number of the
+KF8 header.
+"""
+import struct
+
+NO_INDEX = 0xFFFFFFFF
+
+EXTH_KF8_BOUNDARY = 121
+
+# Fields of the MOBI header (offsets from the start of record 0) used by KF8
+HEADER_FDST = 0xC0
+HEADER_FRAGMENT_INDEX = 0xF8
+HEADER_SKELETON_INDEX = 0xFC
+
+# Index entry tags
+TAG_FRAGMENT_COUNT = 1
+TAG_POSITION = 6
+
+_INDX_FIELDS = struct.Struct('>13L')
+
+
+def exth_records(record0):
+    """Return {type: [data, ...]} for the EXTH block of a MOBI header record, or {} if there is none."""
+    if record0[16:20] != b'MOBI' or len(record0) < 0x84:
+        return {}
+    header_length, = struct.unpack_from('>L', record0, 0x14)
+    flags, = struct.unpack_from('>L', record0, 0x80)
+    start = 16 + header_length
+    if not flags & 0x40 or record0[start:start + 4] != b'EXTH':
+        return {}
+
+    records = {}
+    count, = struct.unpack_from('>L', record0, start + 8)
+    offset = start + 12
+    for _ in range(count):
+        if offset + 8 > len(record0):
+            break
+        kind, length = struct.unpack_from('>LL', record0, offset)
+        if length < 8:
+            break
+        records.setdefault(kind, []).append(bytes(record0[offset + 8:offset + length]))
+        offset += length
+    return records
+
+
+def kf8_boundary(record0):
+    """Record number of the KF8 header in a combined MOBI 6/KF8 book, or None."""
+    values = exth_records(record0).get(EXTH_KF8_BOUNDARY)
+    if not values or len(values[0]) < 4:
+        return None
+    boundary, = struct.unpack_from('>L', values[0])
+    return None if boundary == NO_INDEX else boundary
+
+
+def parse_fdst(record):
+    """Return the (start, end) text offsets of each flow."""
+    if record[0:4] != b'FDST':
+        raise ValueError("Invalid FDST record")
+    start, count = struct.unpack_from('>LL', record, 4)
+    bounds = struct.unpack_from('>%dL' % (2 * count), record, start)
+    return list(zip(bounds[0::2], bounds[1::2]))
+
+
+def _indx_header(data):
+    """(header length, IDXT offset, entry or record count) of an INDX record."""
+    if data[0:4] != b'INDX':
+        raise ValueError("Invalid INDX record")
+    fields = _INDX_FIELDS.unpack_from(data, 4)
+    return fields[0], fields[4], fields[5]
+
+
+def _tag_table(data, start):
+    """Parse the TAGX block: (control byte count, [(tag, values per entry, mask, end flag), ...])."""
+    if data[start:start + 4] != b'TAGX':
+        raise ValueError("Missing TAGX block")
+    length, control_bytes = struct.unpack_from('>LL', data, start + 4)
+    table = [tuple(data[offset:offset + 4]) for offset in range(start + 12, start + length, 4)]
+    return control_bytes, table
+
+
+def _varint(data, offset):
+    """Forward-encoded variable width value: (bytes consumed, value); the last byte has the high bit set."""
+    value = 0
+    consumed = 0
+    while True:
+        byte = data[offset + consumed]
+        consumed += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte & 0x80:
+            return consumed, value
+
+
+def _tag_values(data, start, control_bytes, table):
+    """Decode the tag values of one index entry starting at its control bytes."""
+    found = []
+    control_index = 0
+    position = start + control_bytes
+    for tag, per_entry, mask, end_flag in table:
+        if end_flag:
+            control_index += 1
+            continue
+        value = data[start + control_index] & mask
+        if not value:
+            continue
+        if value == mask and bin(mask).count('1') > 1:
+            # All mask bits set: a byte count of values follows the control bytes
+            consumed, size = _varint(data, position)
+            position += consumed
+            found.append((tag, None, size, per_entry))
+        else:
+            while not mask & 1:
+                mask >>= 1
+                value >>= 1
+            found.append((tag, value, None, per_entry))
+
+    values = {}
+    for tag, count, size, per_entry in found:
+        items = []
+        if count is not None:
+            for _ in range(count * per_entry):
+                consumed, value = _varint(data, position)
+                position += consumed
+                items.append(value)
+        else:
+            end = position + size
+            while position < end:
+                consumed, value = _varint(data, position)
+                position += consumed
+                items.append(value)
+        values[tag] = items
+    return values
+
+
+def read_index(read_record, first):
+    """
+    Read the index whose header is record `first`.
+
+    read_record(number) returns the bytes of a record.  Returns
+    [(entry name, {tag: [values]}), ...] in index order.
+    """
+    primary = read_record(first)
+    header_length, _, record_count = _indx_header(primary)
+    control_bytes, table = _tag_table(primary, header_length)
+
+    entries = []
+    for number in range(first + 1, first + 1 + record_count):
+        data = read_record(number)
+        _, idxt, count = _indx_header(data)
+        if data[idxt:idxt + 4] != b'IDXT':
+            raise ValueError("Missing IDXT block")
+        positions = struct.unpack_from('>%dH' % count, data, idxt + 4)
+        for start in positions:
+            length = data[start]
+            name = bytes(data[start + 1:start + 1 + length])
+            entries.append((name, _tag_values(data, start + 1 + length, control_bytes, table)))
+    return entries
+
+
+def file_layout(skeletons, fragments):
+    """
+    Combine the skeleton and fragment indexes.
+
+    Returns [(start, skeleton length, [(insert offset, fragment length), ...]), ...]
+    per XHTML file in reading order.  A file's skeleton starts at `start` in
+    flow 0 and its fragments follow it back to back; insert offsets are
+    relative to the start of the rebuilt file.
+    """
+    layout = []
+    fragments = iter(fragments)
+    try:
+        for _, tags in skeletons:
+            start, length = tags[TAG_POSITION][:2]
+            inserts = []
+            for _ in range(tags[TAG_FRAGMENT_COUNT][0]):
+                name, fragment_tags = next(fragments)
+                inserts.append((int(name) - start, fragment_tags[TAG_POSITION][1]))
+            layout.append((start, length, inserts))
+    except (KeyError, IndexError, StopIteration, ValueError):
+        raise ValueError("Invalid KF8 skeleton or fragment index")
+    return layout
+
+
+def file_size(skeleton_length, inserts):
+    """Bytes of flow 0 a file occupies: its skeleton plus every fragment."""
+    return skeleton_length + sum(length for _, length in inserts)
+
+
+def assemble(data, skeleton_length, inserts):
+    """Rebuild one XHTML file from its skeleton and fragments (data as laid out in flow 0)."""
+    text = bytearray(data[:skeleton_length])
+    position = skeleton_length
+    for insert, length in inserts:
+        insert = _insert_position(text, insert)
+        text[insert:insert] = data[position:position + length]
+        position += length
+    return bytes(text)
+
+
+def _insert_position(text, insert):
+    # Some converters write insert points that fall inside a tag; move those
+    # to just after the tag so the markup stays intact
+    insert = max(0, min(insert, len(text)))
+    if text.rfind(b'<', 0, insert) > text.rfind(b'>', 0, insert):
+        end = text.find(b'>', insert)
+        if end != -1:
+            insert = end + 1
+    return insert
@@ -0,0 +1,562 @@
+"""
+Load test for the web app under concurrent traffic.
+
+Usage: python loadtest.py [--server threaded|gunicorn|URL] [--concurrency 8] [--rate 4]
+                          [--duration 30] [--mix upload=5,download=4,download_batch=1]
+                          [--book-mb 1] [--books 8] [--cached 0.5] [--json results.json]
+                          [--baseline baseline.json] [--threshold 0.15]
+
+The app is started on a free local port, either on Werkzeug's threaded
+server or under gunicorn (one process, --threads threads, as in the
+Procfile).  Its storage goes to a temporary directory, so the conversion
+cache starts empty.  A URL instead targets a server that is already running.
+
+Synthetic EPUB and MOBI books from corpus.py are uploaded once before the
+run, so every book has an output to download.  The run then sends a random
+mix of requests for --duration seconds from --concurrency client threads:
+
+- upload: POST /upload, then poll the job until it finishes.  'upload' is
+  the time to the 202 (or the cached answer); 'convert' runs until the job
+  is done.  A --cached share of uploads repeats a book as it is and is
+  answered from the conversion cache; the others get a few unique bytes
+  appended (after the ZIP end record or the last MOBI record, where the
+  readers never look), so they are converted again.
+- download: GET /download of a finished book, whole body read.
+- download_batch: POST /download_batch of --batch-files books, the ZIP read
+  to the end.
+
+With --rate, requests arrive as a Poisson process at that many per second
+(an open loop).  Latency counts from the moment a request was due, so time
+spent waiting for a free client thread shows up in it.  Without --rate each
+thread sends its next request as soon as the last one is answered.
+
+The report shows the throughput and p50/p95/p99 latency of each kind of
+request, how many failed or were turned away (429), and the resident memory
+of the server, including its conversion workers, sampled over the run
+(Linux only).  --json saves everything along with the commit and the
+settings; --baseline compares with a saved run, flags kinds whose throughput
+dropped or p95 latency grew by more than --threshold, and exits with 1.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from corpus import synthetic_book
+
+KINDS = ('epub', 'mobi')
+DEFAULT_MIX = 'upload=5,download=4,download_batch=1'
+JOB_POLL_INTERVAL = 0.05
+# Longest a conversion may take before its job counts as failed
+JOB_TIMEOUT = 300
+SERVER_START_TIMEOUT = 30
+PERCENTILES = (50, 95, 99)
+
+# Runs the app on Werkzeug's threaded server in a fresh interpreter
+THREADED_SCRIPT = '''
+import sys
+from werkzeug.serving import make_server
+import app
+make_server('127.0.0.1', int(sys.argv[1]), app.app, threaded=True).serve_forever()
+'''
+
+
+def parse_mix(text):
+    """'upload=5,download=4' -> {'upload': 5.0, 'download': 4.0}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ('upload', 'download', 'download_batch'):
+            raise ValueError(f"unknown request kind: {name}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("the mix has no requests")
+    return mix
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of values, None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind, storage_dir, threads=16):
+    """Start the app in a child process; returns (process, base URL)."""
+    port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, STORAGE_DIR=storage_dir)
+    if kind == 'threaded':
+        command = [sys.executable, '-c', THREADED_SCRIPT, str(port)]
+    elif kind == 'gunicorn':
+        if shutil.which('gunicorn') is None:
+            raise RuntimeError("gunicorn is not installed (pip install gunicorn)")
+        command = ['gunicorn', 'app:app', '--workers', '1', '--threads', str(threads),
+                   '--bind', f'127.0.0.1:{port}', '--log-level', 'warning']
+    else:
+        raise ValueError(f"unknown server: {kind}")
+    process = subprocess.Popen(command, cwd=here, env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            if Client(url).request('GET', '/healthz')[0] == 200:
+                return process, url
+        except OSError:
+            pass
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError(f"{kind} server did not start")
+        time.sleep(0.1)
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class Client:
+    """Keep-alive HTTP connection to the app; one per client thread."""
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request and read the whole response; returns (status, body bytes)."""
+        for attempt in (0, 1):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=JOB_TIMEOUT)
+            try:
+                self.connection.request(method, path, body, headers or {})
+                response = self.connection.getresponse()
+                data = response.read()
+                if response.will_close:
+                    self.close()
+                return response.status, data
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection; try once on a new one
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def multipart(filename, data):
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'.encode(),
+        data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def make_books(count, size_mb):
+    """count synthetic books, alternating EPUB and MOBI: [(file name, bytes)]."""
+    books = []
+    for i in range(count):
+        kind = KINDS[i % len(KINDS)]
+        encoding = 'gb18030' if i % 4 >= 2 else 'utf-8'
+        data = synthetic_book(kind, int(size_mb * 1024 * 1024), chapters=20, encoding=encoding, seed=i)
+        books.append((f'book{i}.{kind}', data))
+    return books
+
+
+class LoadTest:
+    def __init__(self, url, books, mix, batch_files=4, cached=0.5, seed=0):
+        self.url = url
+        self.books = books
+        self.cached = cached
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.batch_files = batch_files
+        self.random = random.Random(seed)
+        # Output file names of converted books, for the download requests
+        self.outputs = []
+        self.samples = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = None
+        self.elapsed = 0.0
+
+    def client(self):
+        if getattr(self.local, 'client', None) is None:
+            self.local.client = Client(self.url)
+        return self.local.client
+
+    def record(self, kind, due, status, size=0, error=None):
+        # Latency counts from when the request was due, not when a thread got to it
+        now = time.perf_counter()
+        with self.lock:
+            self.samples.append({'kind': kind, 'at': now - self.start, 'latency': now - due,
+                                 'status': status, 'bytes': size, 'error': error})
+
+    def upload(self, due):
+        name, data = self.books[self.random.randrange(len(self.books))]
+        if self.random.random() >= self.cached:
+            data += b'loadtest' + uuid.uuid4().bytes
+        body, headers = multipart(name, data)
+        status, answer = self.client().request('POST', '/upload', body, headers)
+        self.record('upload', due, status, len(data))
+        try:
+            result = json.loads(answer)
+        except ValueError:
+            result = {}
+        if status == 200 and result.get('status') == 'done':
+            # Answered from the conversion cache
+            self._add_output(result['filename'])
+            self.record('convert', due, status, len(data))
+            return
+        if status != 202:
+            return
+
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while time.monotonic() < deadline:
+            status, answer = self.client().request('GET', result['status_url'])
+            job = json.loads(answer) if status == 200 else {'status': 'failed', 'error': f'job status {status}'}
+            if job['status'] in ('done', 'failed', 'cancelled'):
+                break
+            time.sleep(JOB_POLL_INTERVAL)
+        else:
+            job = {'status': 'timeout', 'error': 'job did not finish'}
+        if job['status'] == 'done':
+            self._add_output(job['filename'])
+            self.record('convert', due, 200, len(data))
+        else:
+            self.record('convert', due, 500, len(data), job.get('error', job['status']))
+
+    def _add_output(self, filename):
+        with self.lock:
+            if filename not in self.outputs:
+                self.outputs.append(filename)
+
+    def download(self, due):
+        with self.lock:
+            filename = self.random.choice(self.outputs)
+        status, data = self.client().request('GET', '/download/' + urllib.parse.quote(filename),
+                                             headers={'Accept-Encoding': 'gzip'})
+        self.record('download', due, status, len(data))
+
+    def download_batch(self, due):
+        with self.lock:
+            filenames = self.random.sample(self.outputs, min(self.batch_files, len(self.outputs)))
+        body = json.dumps({'filenames': filenames}).encode()
+        status, data = self.client().request('POST', '/download_batch', body, {'Content-Type': 'application/json'})
+        self.record('download_batch', due, status, len(data))
+
+    def send(self, kind, due):
+        try:
+            getattr(self, kind)(due)
+        except Exception as e:
+            self.client().close()
+            self.record(kind, due, None, error=f'{type(e).__name__}: {e}')
+
+    def warm_up(self, concurrency):
+        """Upload every book once so there is something to download."""
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(self._upload_book, range(len(self.books))))
+        if not self.outputs:
+            raise RuntimeError("no book could be converted")
+
+    def _upload_book(self, index):
+        name, data = self.books[index]
+        body, headers = multipart(name, data)
+        status, answer = self.client().request('POST', '/upload', body, headers)
+        result = json.loads(answer)
+        while status in (200, 202) and result.get('status') not in ('done', 'failed', 'cancelled'):
+            time.sleep(JOB_POLL_INTERVAL)
+            status, answer = self.client().request('GET', result['status_url'])
+            result = json.loads(answer)
+        if result.get('status') == 'done':
+            self._add_output(result['filename'])
+
+    def run(self, duration, concurrency, rate=None):
+        """Send requests for duration seconds; returns the samples."""
+        self.start = time.perf_counter()
+        end = self.start + duration
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load') as pool:
+            if rate:
+                # Open loop: Poisson arrivals, however slowly the server answers
+                due = self.start
+                while True:
+                    due += self.random.expovariate(rate)
+                    if due >= end:
+                        break
+                    time.sleep(max(0.0, due - time.perf_counter()))
+                    pool.submit(self.send, self.pick(), due)
+            else:
+                def loop():
+                    while time.perf_counter() < end:
+                        self.send(self.pick(), time.perf_counter())
+                for _ in range(concurrency):
+                    pool.submit(loop)
+        self.elapsed = time.perf_counter() - self.start
+        return self.samples
+
+    def pick(self):
+        with self.lock:
+            return self.random.choices(self.kinds, self.weights)[0]
+
+
+def process_tree_rss(pid):
+    """Resident bytes of pid and all its descendants (Linux), or None."""
+    children = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # The command name may contain spaces; fields after it are fixed
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(name))
+    total = 0
+    found = False
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        try:
+            with open(f'/proc/{current}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+                found = True
+        except (OSError, ValueError):
+            continue
+        todo += children.get(current, [])
+    return total if found else None
+
+
+class RssSampler(threading.Thread):
+    """Samples the server's memory every interval seconds: [[seconds, MB], ...]."""
+
+    def __init__(self, pid, interval=1.0):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._finished = threading.Event()
+
+    def run(self):
+        self._start = time.perf_counter()
+        while True:
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.samples.append([round(time.perf_counter() - self._start, 2), round(rss / (1024 * 1024), 1)])
+            if self._finished.wait(self.interval):
+                return
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+
+
+def summarize(samples, elapsed):
+    """Per request kind: count, throughput, error and rejection rates, latency percentiles in ms."""
+    results = {}
+    for kind in sorted({sample['kind'] for sample in samples}):
+        mine = [sample for sample in samples if sample['kind'] == kind]
+        ok = [sample for sample in mine if sample['status'] is not None and sample['status'] < 400]
+        rejected = sum(1 for sample in mine if sample['status'] == 429)
+        latencies = [sample['latency'] for sample in ok]
+        statuses = {}
+        for sample in mine:
+            key = str(sample['status'] or 'error')
+            statuses[key] = statuses.get(key, 0) + 1
+        result = {
+            'count': len(mine),
+            'ok': len(ok),
+            'per_s': round(len(ok) / elapsed, 3),
+            'mb_per_s': round(sum(sample['bytes'] for sample in ok) / elapsed / (1024 * 1024), 3),
+            'error_rate': round((len(mine) - len(ok) - rejected) / len(mine), 4),
+            'rejected_rate': round(rejected / len(mine), 4),
+            'statuses': statuses,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+            'max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+        }
+        for p in PERCENTILES:
+            value = percentile(latencies, p)
+            result[f'p{p}_ms'] = None if value is None else round(value * 1000, 2)
+        errors = sorted({sample['error'] for sample in mine if sample['error']})
+        if errors:
+            result['errors'] = errors[:5]
+        results[kind] = result
+    return results
+
+
+def print_report(results, elapsed, rss):
+    # 'convert' follows an upload; it is not a request of its own
+    total = sum(result['ok'] for kind, result in results.items() if kind != 'convert')
+    print(f"{total} requests answered in {elapsed:.1f} s ({total / elapsed:.2f}/s)")
+    print(f"{'kind':<16} {'count':>6} {'per s':>7} {'err %':>6} {'429 %':>6} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'MB/s':>7}")
+    for kind, result in results.items():
+        values = [result[f'p{p}_ms'] for p in PERCENTILES]
+        latency = ' '.join('        -' if value is None else f'{value:9.1f}' for value in values)
+        print(f"{kind:<16} {result['count']:>6} {result['per_s']:>7.2f} {result['error_rate'] * 100:>6.1f} "
+              f"{result['rejected_rate'] * 100:>6.1f} {latency} {result['mb_per_s']:>7.2f}")
+        for error in result.get('errors', []):
+            print(f"  {error}")
+    if rss:
+        peak = max(mb for _, mb in rss)
+        print(f"server RSS: start {rss[0][1]:.1f} MB, peak {peak:.1f} MB, end {rss[-1][1]:.1f} MB")
+
+
+def compare(results, baseline, threshold=0.15):
+    """
+    Compare results with a baseline run and print the changes.
+
+    Returns the request kinds whose throughput dropped, or whose p95
+    latency or error rate grew, by more than threshold.
+    """
+    regressions = []
+    for kind, result in results.items():
+        old = baseline.get(kind)
+        if not old:
+            continue
+        flags = []
+        speed = result['per_s'] / old['per_s'] - 1 if old['per_s'] else 0.0
+        if speed < -threshold:
+            flags.append('lower throughput')
+        latency = 0.0
+        if result['p95_ms'] is not None and old['p95_ms']:
+            latency = result['p95_ms'] / old['p95_ms'] - 1
+            if latency > threshold:
+                flags.append('slower p95')
+        if result['error_rate'] > old['error_rate'] + threshold / 10:
+            flags.append('more errors')
+        if flags:
+            regressions.append(kind)
+        print(f"{kind:<16} {old['per_s']:8.2f} -> {result['per_s']:8.2f}/s ({speed:+.0%})  "
+              f"p95 {old['p95_ms'] or 0:9.1f} -> {result['p95_ms'] or 0:9.1f} ms ({latency:+.0%})"
+              f"{'  REGRESSION: ' + ', '.join(flags) if flags else ''}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the web app")
+    parser.add_argument('--server', default='threaded',
+                        help="threaded (Werkzeug), gunicorn, or the URL of a running server")
+    parser.add_argument('--threads', type=int, default=16, help="gunicorn threads")
+    parser.add_argument('--pid', type=int, help="process to sample RSS of when --server is a URL")
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help="client threads")
+    parser.add_argument('-r', '--rate', type=float, help="requests per second (default: as fast as answered)")
+    parser.add_argument('-d', '--duration', type=float, default=30, help="seconds to send requests for")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"relative weights of request kinds ({DEFAULT_MIX})")
+    parser.add_argument('--book-mb', type=float, default=1, help="text size of each synthetic book")
+    parser.add_argument('--books', type=int, default=8, help="distinct books (alternately EPUB and MOBI)")
+    parser.add_argument('--cached', type=float, default=0.5, help="share of uploads the cache can answer")
+    parser.add_argument('--batch-files', type=int, default=4, help="books per /download_batch request")
+    parser.add_argument('--sample', type=float, default=1.0, help="seconds between RSS samples")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="save results to this file")
+    parser.add_argument('--baseline', help="compare with results saved earlier")
+    parser.add_argument('--threshold', type=float, default=0.15, help="allowed change before flagging, 0.15 = 15%%")
+    args = parser.parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f"Building {args.books} books of {args.book_mb} MB...")
+    books = make_books(args.books, args.book_mb)
+    storage = None
+    process = None
+    if args.server.startswith(('http://', 'https://')):
+        url, pid = args.server.rstrip('/'), args.pid
+    else:
+        storage = tempfile.mkdtemp(prefix='loadtest-')
+        process, url = start_server(args.server, storage, args.threads)
+        pid = process.pid
+    sampler = RssSampler(pid, args.sample) if pid else None
+
+    try:
+        test = LoadTest(url, books, mix, args.batch_files, args.cached, args.seed)
+        print(f"Warming up {url}...")
+        test.warm_up(args.concurrency)
+        if sampler:
+            sampler.start()
+        print(f"Running for {args.duration:g} s with {args.concurrency} clients"
+              f"{f' at {args.rate:g} requests/s' if args.rate else ''}...")
+        samples = test.run(args.duration, args.concurrency, args.rate)
+    finally:
+        if sampler and sampler.is_alive():
+            sampler.stop()
+        if process:
+            stop_server(process)
+        if storage:
+            shutil.rmtree(storage, ignore_errors=True)
+
+    results = summarize(samples, test.elapsed)
+    rss = sampler.samples if sampler else []
+    print_report(results, test.elapsed, rss)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created': time.time(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'config': {'server': args.server, 'threads': args.threads, 'concurrency': args.concurrency,
+                           'rate': args.rate, 'duration': args.duration, 'mix': mix, 'book_mb': args.book_mb,
+                           'books': args.books, 'cached': args.cached, 'batch_files': args.batch_files},
+                'elapsed': round(test.elapsed, 3),
+                'results': results,
+                'rss_mb': rss,
+            }, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config', {}).get('server') != args.server:
+            print(f"warning: baseline ran on {baseline.get('config', {}).get('server')}")
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
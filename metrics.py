@@ -0,0 +1,282 @@
+"""
+Per-stage timings and process metrics.
+
+A Timings object collects how long each stage of one conversion took (record
+reading, decompression, encoding detection, decoding, HTML stripping,
+post-processing, writing, checkpoints) along with bytes in and out.  When metrics are
+disabled the readers get NULL_TIMINGS, which has the same interface and
+records nothing, so the instrumented code paths cost a few no-op calls per
+record.
+
+Each record also has the resident memory of the process when the conversion
+finished and how much it grew while it ran.  In a worker process (see
+workers.py) that is the job's own footprint; in the web server it includes
+whatever the other jobs allocated meanwhile.  The process-lifetime peak is
+only served as a gauge on /metrics, as it says nothing about a single job.
+
+Finished conversions are passed to observe_conversion(), which updates the
+counters and histograms served on /metrics and writes one structured log line
+per conversion.
+
+Set EBOOK_METRICS=0 to disable.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+enabled = os.environ.get('EBOOK_METRICS', '1') != '0'
+
+logger = logging.getLogger('ebook.metrics')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def process_peak_rss_bytes():
+    """High-water mark of this process's resident memory since it started, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def rss_bytes():
+    """Current resident memory of this process, or the peak where that is unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return process_peak_rss_bytes()
+
+
+class _Stage:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+
+
+class Timings:
+    enabled = True
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = None
+        self.rss = None
+        self.rss_delta = None
+        self._start = time.perf_counter()
+        self._start_rss = rss_bytes()
+
+    def stage(self, name):
+        """Context manager adding the time spent inside it to stage `name`."""
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def finish(self, **labels):
+        self.labels.update(labels)
+        self.seconds = time.perf_counter() - self._start
+        self.rss = rss_bytes()
+        if self.rss is not None and self._start_rss is not None:
+            self.rss_delta = self.rss - self._start_rss
+
+    def to_dict(self):
+        return dict(
+            self.labels,
+            seconds=round(self.seconds or 0.0, 6),
+            stages={name: round(seconds, 6) for name, seconds in self.stages.items()},
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+            rss=self.rss,
+            rss_delta=self.rss_delta,
+        )
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+class _NullTimings:
+    enabled = False
+    bytes_in = 0
+    bytes_out = 0
+    _stage = _NullStage()
+
+    @property
+    def labels(self):
+        # A fresh dict each time, so label writes are dropped too
+        return {}
+
+    def stage(self, name):
+        return self._stage
+
+    def add(self, name, seconds):
+        pass
+
+    def finish(self, **labels):
+        pass
+
+    def to_dict(self):
+        return None
+
+    def __setattr__(self, name, value):
+        # bytes_in/bytes_out assignments are dropped
+        pass
+
+
+NULL_TIMINGS = _NullTimings()
+
+
+def new_timings(**labels):
+    return Timings(**labels) if enabled else NULL_TIMINGS
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(names, key + (f"{bound:g}",))} {count}')
+                lines.append(f'{self.name}_bucket{_format_labels(names, key + ("+Inf",))} {counts[-2]}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {counts[-2]}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-1]:.6f}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # Callables returning (name, type, help, value) for values read at scrape time
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collect in self.collectors:
+            for name, kind, help_text, value in collect():
+                if value is not None:
+                    lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+conversions = registry.counter(
+    'ebook_conversions_total', 'Finished conversions', ('format', 'status', 'path'))
+conversion_seconds = registry.histogram(
+    'ebook_conversion_seconds', 'Wall time of whole conversions', ('format', 'status'))
+stage_seconds = registry.histogram(
+    'ebook_conversion_stage_seconds', 'Time spent per conversion stage', ('format', 'stage'))
+bytes_in = registry.counter('ebook_conversion_input_bytes_total', 'Bytes of books converted', ('format',))
+bytes_out = registry.counter('ebook_conversion_output_bytes_total', 'Bytes of text written', ('format',))
+http_requests = registry.counter('ebook_http_requests_total', 'HTTP requests', ('endpoint', 'method', 'status'))
+http_seconds = registry.histogram(
+    'ebook_http_request_seconds', 'Time until the response is returned', ('endpoint', 'method'))
+
+registry.collectors.append(lambda: [
+    ('ebook_process_peak_rss_bytes', 'gauge', 'Peak resident memory of this process', process_peak_rss_bytes()),
+])
+
+
+def observe_conversion(record, job_id=None):
+    """Add a Timings.to_dict() record to the metrics and log it as one JSON line."""
+    if not record:
+        return
+    fmt = record.get('format', '')
+    status = record.get('status', '')
+    conversions.inc(format=fmt, status=status, path=record.get('path', ''))
+    conversion_seconds.observe(record['seconds'], format=fmt, status=status)
+    for stage, seconds in record['stages'].items():
+        stage_seconds.observe(seconds, format=fmt, stage=stage)
+    bytes_in.inc(record['bytes_in'], format=fmt)
+    bytes_out.inc(record['bytes_out'], format=fmt)
+    logger.info(json.dumps(dict(record, event='conversion', job=job_id), ensure_ascii=False))
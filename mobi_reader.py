@@ -1,136 +1,689 @@
+import bisect
+import codecs
+import contextlib
+import itertools
+import mmap
+import os
+import re
 import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import kf8
+from huffcdic import HuffCdicDecoder
+from metrics import NULL_TIMINGS
+
+# Text encoding field of the MOBI header
+CODE_PAGES = {65001: 'utf-8', 1252: 'cp1252'}
+
+# Encodings tried on the sample when the header is missing or wrong
+# Prioritize UTF-8 and GB18030 (common for Chinese)
+SAMPLE_ENCODINGS = ('utf-8', 'gb18030')
+# Used with errors='ignore' when no encoding decodes the sample cleanly
+FALLBACK_ENCODING = 'utf-8'
+
+# Encoding detection looks at up to this many text records spread over the
+# book, and at most this many decompressed bytes in total
+ENCODING_SAMPLE_RECORDS = 8
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# Books with fewer text records than this are always decompressed serially
+PARALLEL_MIN_RECORDS = 512
+# Number of consecutive records handed to a worker process at a time
+PARALLEL_BATCH_RECORDS = 64
+
+# A text record holds record_size bytes of text; a HUFF/CDIC record that
+# expands to more than this many times that is corrupt or hostile
+MAX_RECORD_EXPANSION = 2
+# Likewise the whole text may run past the text_length in the header by this
+# factor (plus a record) before the book is refused
+MAX_TEXT_EXPANSION = 2
+
+# In GB18030 (and GBK, Big5, Shift-JIS) a trail byte can look like a lead byte,
+# so a range read starting mid-character decodes garbage.  These bytes are never
+# the trail of a character, so decoding can resync just after one; read_text
+# looks this far back for one before falling back to the start of the text.
+CHARACTER_END = re.compile(rb'[\x00-\x2f\x3a-\x3f]')
+RESYNC_LIMIT = 64 * 1024
+
+COMPRESSION_NONE = 1
+COMPRESSION_PALMDOC = 2
+COMPRESSION_HUFFCDIC = 17480
 
 class MobiReader:
-    def __init__(self, filename):
+    def __init__(self, filename, workers=1, parallel_threshold=PARALLEL_MIN_RECORDS, timings=None, prefer_kf8=True):
+        """
+        workers > 1 decompresses PalmDOC records in that many processes once the
+        book has at least parallel_threshold text records; None uses every CPU.
+        timings: a metrics.Timings that receives the time spent per stage.
+        prefer_kf8: read the KF8 copy of a combined MOBI 6/KF8 book.
+        """
         self.filename = filename
+        self.timings = timings or NULL_TIMINGS
+        self.prefer_kf8 = prefer_kf8
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.parallel_threshold = parallel_threshold
         self.compression = 1
         self.text_length = 0
         self.record_count = 0
         self.record_size = 4096
         self.current_offset = 0
-        
-    def extract_text(self):
+        self.record_info_list = []
+        self.text_encoding = 0
+        self.encoding = None
+        self.encoding_reason = None
+        self.extra_flags = 0
+        self.huff_record = 0
+        self.huff_record_count = 0
+        self._huff_decoder = None
+        # Text decoder of the running iter_text()
+        self._text_decoder = None
+        # Uncompressed start offset of each text record, only built for books
+        # whose records do not all hold exactly record_size bytes
+        self._record_starts = None
+        # Record number of the header in use; record numbers in it are relative to it
+        self.base = 0
+        self.kf8 = False
+        self.fdst_index = self.skeleton_index = self.fragment_index = kf8.NO_INDEX
+        # KF8 only: (start, end) of each flow and the layout of the XHTML files
+        self.flows = None
+        self.files = None
+        self._kf8_loaded = False
+
+    @contextlib.contextmanager
+    def _open_map(self):
         with open(self.filename, 'rb') as f:
-            header = f.read(78)
-            if len(header) < 78:
+            if os.fstat(f.fileno()).st_size < 78:
                 raise ValueError("Invalid file header")
-                
-            # PDB Header
-            num_records = struct.unpack('>H', header[76:78])[0]
-            
-            # Record Info List
-            record_info_list = []
-            for _ in range(num_records):
-                data = f.read(8)
-                offset = struct.unpack('>L', data[:4])[0]
-                record_info_list.append(offset)
-                
-            if not record_info_list:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+    def _read_header(self, data):
+        """Parse the PDB record table and the PalmDOC header from record 0."""
+        # PDB Header
+        num_records = struct.unpack_from('>H', data, 76)[0]
+        if len(data) < 78 + 8 * num_records:
+            raise ValueError("Invalid record table")
+
+        # Record Info List: (offset, attributes/id) pairs, keep the offsets
+        self.record_info_list = list(struct.unpack_from('>%dL' % (2 * num_records), data, 78)[0::2])
+        if not self.record_info_list:
+            return False
+
+        self.base = 0
+        header_data = self._read_record(data, 0)
+        self._parse_header(header_data)
+        if self.prefer_kf8 and not self.kf8:
+            # A combined book keeps its KF8 copy after a BOUNDARY record
+            boundary = kf8.kf8_boundary(header_data)
+            if boundary and boundary < len(self.record_info_list):
+                kf8_header = self._record_at(data, boundary)
+                if kf8_header[16:20] == b'MOBI':
+                    self.base = boundary
+                    self._parse_header(kf8_header)
+        if self.kf8 and not self._kf8_loaded:
+            self._load_kf8(data)
+        return True
+
+    def _parse_header(self, header_data):
+        # PalmDOC Header is at start of Record 0 (Mobi Header)
+        self.compression = struct.unpack('>H', header_data[0:2])[0]
+        self.text_length = struct.unpack('>L', header_data[4:8])[0]
+        self.record_count = struct.unpack('>H', header_data[8:10])[0]
+        self.record_size = struct.unpack('>H', header_data[10:12])[0]
+        self.kf8 = False
+
+        # MOBI Header follows the PalmDOC header
+        if header_data[16:20] == b'MOBI' and len(header_data) >= 0x80:
+            header_length, = struct.unpack_from('>L', header_data, 0x14)
+            self.text_encoding, = struct.unpack_from('>L', header_data, 0x1C)
+            version, = struct.unpack_from('>L', header_data, 0x24)
+            self.huff_record, self.huff_record_count = struct.unpack_from('>LL', header_data, 0x70)
+            # Flags describing the trailing entries appended to each text record
+            self.extra_flags = 0
+            if header_length >= 0xE4 and version >= 5 and len(header_data) >= 0xF4:
+                self.extra_flags, = struct.unpack_from('>H', header_data, 0xF2)
+            self.kf8 = version >= 8 and len(header_data) >= 0x100
+            if self.kf8:
+                self.fdst_index, = struct.unpack_from('>L', header_data, kf8.HEADER_FDST)
+                self.fragment_index, = struct.unpack_from('>L', header_data, kf8.HEADER_FRAGMENT_INDEX)
+                self.skeleton_index, = struct.unpack_from('>L', header_data, kf8.HEADER_SKELETON_INDEX)
+
+    def _load_kf8(self, data):
+        """Read the FDST and the skeleton/fragment indexes of a KF8 book."""
+        self._kf8_loaded = True
+        read = lambda index: self._read_record(data, index)
+        try:
+            if self.fdst_index != kf8.NO_INDEX:
+                self.flows = kf8.parse_fdst(read(self.fdst_index))
+            if kf8.NO_INDEX not in (self.skeleton_index, self.fragment_index):
+                self.files = kf8.file_layout(kf8.read_index(read, self.skeleton_index),
+                                             kf8.read_index(read, self.fragment_index))
+        except (ValueError, IndexError, struct.error):
+            # Without the indexes the XHTML flow is still readable as stored
+            self.files = None
+
+    def _record_bounds(self, index, file_size):
+        index += self.base
+        start = self.record_info_list[index]
+        if index + 1 < len(self.record_info_list):
+            end = self.record_info_list[index + 1]
+        elif index == 0:
+            end = start + 1024
+        else:
+            end = file_size
+        return start, end
+
+    def _read_record(self, data, index):
+        start, end = self._record_bounds(index, len(data))
+        return data[start:end]
+
+    def _record_at(self, data, index):
+        """Record by absolute number, ignoring self.base."""
+        return self._read_record(data, index - self.base)
+
+    @property
+    def chunk_count(self):
+        """Number of chunks iter_text yields: text records, or XHTML files for KF8."""
+        if self.kf8 and self.files is not None:
+            return len(self.files)
+        if self.kf8 and self.flows and self.record_size:
+            return -(-self.flows[0][1] // self.record_size)
+        return self._last_text_record()
+
+    def iter_records(self, data, parallel=True, first=1):
+        """
+        Yield the decompressed bytes of each text record in order, starting with record `first`.
+
+        Raises ValueError once the records add up to far more text than the
+        header declares.
+        """
+        last = self._last_text_record()
+        if parallel and self.compression == COMPRESSION_PALMDOC and self.workers > 1 and \
+                last - first + 1 >= self.parallel_threshold:
+            records = self._iter_records_parallel(data, last, first)
+        else:
+            records = self._iter_records_serial(data, last, first)
+
+        limit = self.text_length * MAX_TEXT_EXPANSION + (self.record_size or 4096) if self.text_length else None
+        total = 0
+        for record in records:
+            total += len(record)
+            if limit is not None and total > limit:
+                records.close()
+                raise ValueError("Text records expand far past the declared text length")
+            yield record
+
+    def _iter_records_serial(self, data, last, first=1):
+        decompress = self._decompressor(data)
+        timings = self.timings
+        for i in range(first, last + 1):
+            with timings.stage('read'):
+                record = strip_trailing_entries(self._read_record(data, i), self.extra_flags)
+            with timings.stage('decompress'):
+                record = decompress(record)
+            yield record
+
+    def _decompressor(self, data):
+        if self.compression == COMPRESSION_HUFFCDIC:
+            decoder = self._load_huff_decoder(data)
+            max_size = (self.record_size or 4096) * MAX_RECORD_EXPANSION
+            return lambda record: decoder.decompress(record, max_size)
+        if self.compression == COMPRESSION_PALMDOC:
+            return self.decompress_palmdoc
+        return bytes
+
+    def _read_text_record(self, data, index, decompress):
+        # Trim trailing entries (multibyte/indexing data) appended to the record
+        return decompress(strip_trailing_entries(self._read_record(data, index), self.extra_flags))
+
+    def _load_huff_decoder(self, data):
+        # The HUFF and CDIC tables are parsed once and shared by every text record
+        if self._huff_decoder is None:
+            first, count = self.huff_record, self.huff_record_count
+            if count < 2 or first + count > len(self.record_info_list):
+                raise ValueError("Missing HUFF/CDIC records")
+            records = [self._read_record(data, i) for i in range(first, first + count)]
+            self._huff_decoder = HuffCdicDecoder(records[0], records[1:])
+        return self._huff_decoder
+
+    def _iter_records_parallel(self, data, last, first=1):
+        # Records are compressed independently, so batches of them can be
+        # decompressed in other processes.  Workers map the file themselves and
+        # only the record offsets are sent; at most two batches per worker are
+        # in flight so memory stays bounded while results are yielded in order.
+        bounds = [self._record_bounds(i, len(data)) for i in range(first, last + 1)]
+        batches = (bounds[i:i + PARALLEL_BATCH_RECORDS] for i in range(0, len(bounds), PARALLEL_BATCH_RECORDS))
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque(
+                pool.submit(_decompress_records, self.filename, batch, self.record_size, self.extra_flags)
+                for batch in itertools.islice(batches, self.workers * 2)
+            )
+            try:
+                while pending:
+                    # Time spent waiting for the workers counts as decompression
+                    with self.timings.stage('decompress'):
+                        records = pending.popleft().result()
+                    batch = next(batches, None)
+                    if batch is not None:
+                        pending.append(pool.submit(_decompress_records, self.filename, batch, self.record_size, self.extra_flags))
+                    yield from records
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def extract_text(self):
+        with self._open_map() as data:
+            if not self._read_header(data):
                 return ""
 
-            # Read Record 0 (Mobi Header)
-            f.seek(record_info_list[0])
-            header_data = f.read(record_info_list[1] - record_info_list[0] if len(record_info_list) > 1 else 1024)
-            
-            # PalmDOC Header is at start of Record 0
-            self.compression = struct.unpack('>H', header_data[0:2])[0]
-            self.text_length = struct.unpack('>L', header_data[4:8])[0]
-            self.record_count = struct.unpack('>H', header_data[8:10])[0]
-            self.record_size = struct.unpack('>H', header_data[10:12])[0]
-            
-            # print(f"Compression: {self.compression}, Records: {self.record_count}")
-            
-            if self.compression == 17480:
-                 raise ValueError("Huff/CDIC compression not supported in basic mode")
-                 
+            with self.timings.stage('detect_encoding'):
+                encoding = self.detect_encoding(data)
+
             # Read Text Records
             text_content = bytearray()
-            for i in range(1, self.record_count + 1):
-                if i >= len(record_info_list):
-                    break
-                start = record_info_list[i]
-                end = record_info_list[i+1] if i+1 < len(record_info_list) else None
-                
-                f.seek(start)
-                if end:
-                    chunk = f.read(end - start)
-                else:
-                    chunk = f.read()
-                
-                # Trim extra bytes if needed (some records have trailing data)
-                # For now, just try to decompress
-                
-                if self.compression == 2:
-                    text_content.extend(self.decompress_palmdoc(chunk))
-                else:
-                    text_content.extend(chunk)
-                    
-            # Try multiple encodings
-            # Prioritize UTF-8 and GB18030 (common for Chinese)
-            # If strict decoding fails, try with error handling BEFORE falling back to Latin1
-            
-            encodings_to_try = [
-                ('utf-8', 'strict'),
-                ('gb18030', 'strict'),
-                ('utf-8', 'ignore'),  # If strict fails, try ignoring errors (likely UTF-8 with some garbage)
-                ('gb18030', 'ignore'),
-                ('cp1252', 'strict'),
-                ('latin1', 'strict')
-            ]
+            for chunk in self._iter_chunks(data):
+                text_content.extend(chunk)
 
-            for encoding, errors in encodings_to_try:
-                try:
-                    decoded_text = text_content.decode(encoding, errors=errors)
-                    # Simple heuristic: If we used 'ignore' or 'replace', we accept it.
-                    # But if we decoded as Latin1/CP1252, we might have garbage if it was actually UTF-8.
-                    # Since we prioritize UTF-8/GB18030 with ignore above Latin1, this should be safer.
-                    return decoded_text
-                except UnicodeDecodeError:
-                    continue
-            
-            # Fallback
-            return text_content.decode('utf-8', errors='ignore')
+        # Decode exactly once
+        with self.timings.stage('decode'):
+            return text_content.decode(encoding, errors='ignore')
 
-    def decompress_palmdoc(self, data):
+    def iter_text(self, encoding=None, start=0, decoder_state=None):
+        """
+        Yield the book text one decoded chunk per text record.
+
+        The file is memory-mapped and only one record is decompressed at a
+        time, so memory use does not grow with the size of the book.  An
+        incremental decoder carries multi-byte characters that are split
+        across records.  If encoding is None it is detected first.
+
+        start skips the first chunks (records, or XHTML files for KF8)
+        without decompressing them; decoder_state, as returned by
+        decoder_state() after chunk start - 1, restores the bytes of a
+        character split across that boundary.
+        """
+        with self._open_map() as data:
+            if not self._read_header(data):
+                return
+
+            if encoding is None:
+                with self.timings.stage('detect_encoding'):
+                    encoding = self.detect_encoding(data)
+            else:
+                self.encoding, self.encoding_reason = encoding, 'caller'
+
+            decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+            if decoder_state:
+                decoder.setstate((bytes.fromhex(decoder_state[0]), decoder_state[1]))
+            self._text_decoder = decoder
+            timings = self.timings
+            for chunk in self._iter_chunks(data, start):
+                with timings.stage('decode'):
+                    text = decoder.decode(chunk)
+                yield text
+
+    def decoder_state(self):
+        """State of the text decoder after the last chunk iter_text yielded, as JSON-compatible data."""
+        buffered, flag = self._text_decoder.getstate()
+        return [buffered.hex(), flag]
+
+    def _iter_chunks(self, data, start=0):
+        if self.kf8:
+            return self._iter_kf8_files(data, start)
+        return self.iter_records(data, first=start + 1)
+
+    def _iter_kf8_files(self, data, skip_files=0):
+        """
+        Yield the XHTML files of a KF8 book in reading order.
+
+        Each file is rebuilt from its skeleton and fragments as soon as the
+        records holding it are decompressed.  Files normally follow each other
+        in the text, so every record is decompressed once; a file stored out
+        of order is read again by random access.  The first skip_files files
+        are left out without decompressing the records before them.
+        """
+        step = self.record_size or 4096
+        # Text offset of the first file wanted, and the record holding it
+        offset = 0
+        if skip_files and self.files is None:
+            offset = skip_files * step
+        elif skip_files:
+            if skip_files >= len(self.files):
+                return
+            offset = self.files[skip_files][0]
+        first, skip = 1, 0
+        if offset:
+            if self._record_starts is None and not self.record_size:
+                self._index_records(data, self._decompressor(data))
+            first, skip = self._locate(offset)
+        records = self.iter_records(data, first=first)
+        window = _ForwardWindow(records, offset - skip)
+        try:
+            if self.files is None:
+                # No skeleton index: the XHTML flow as stored, CSS and SVG flows left out
+                end = self.flows[0][1] if self.flows else self.text_length
+                for begin in range(offset, end, step):
+                    yield window.read(begin, min(begin + step, end))
+                return
+
+            for start, skeleton_length, inserts in self.files[skip_files:]:
+                end = start + kf8.file_size(skeleton_length, inserts)
+                raw = window.read(start, end)
+                if raw is None:
+                    raw = self._read_bytes(data, start, end)
+                yield kf8.assemble(raw, skeleton_length, inserts)
+        finally:
+            records.close()
+
+    def read_bytes(self, start=0, end=None):
+        """
+        Return the uncompressed text bytes [start, end) of the book.
+
+        Only the records that overlap the range are decompressed: text records
+        hold record_size bytes each, so an offset maps straight to a record.
+        Books whose records are not all full are indexed once on first use.
+        For KF8 books the offsets are those of the stored text, before the
+        XHTML files are rebuilt.
+        """
+        with self._open_map() as data:
+            if not self._read_header(data):
+                return b''
+            return self._read_bytes(data, start, end)
+
+    def read_text(self, start=0, end=None, encoding=None):
+        """
+        Decode the text bytes [start, end).
+
+        A character cut by either end of the range is dropped.  If encoding is
+        None it is detected from a sample of the book first.
+
+        UTF-8 resyncs by itself; in other encodings decoding starts just after
+        the last byte before start that ends a character (see CHARACTER_END),
+        and the text before start is dropped.
+        """
+        with self._open_map() as data:
+            if not self._read_header(data):
+                return ''
+            if encoding is None:
+                encoding = self.encoding or self.detect_encoding(data)
+            decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+            cut = False
+            if start > 0 and codecs.lookup(encoding).name != 'utf-8':
+                window = max(start - RESYNC_LIMIT, 0)
+                lead = self._read_bytes(data, window, start)
+                match = CHARACTER_END.search(lead[::-1])
+                if match is None and window > 0:
+                    lead = self._read_bytes(data, 0, start)
+                decoder.decode(lead[len(lead) - match.start():] if match else lead)
+                # Bytes left over belong to a character that start cuts
+                cut = bool(decoder.getstate()[0])
+            raw = self._read_bytes(data, start, end)
+        text = decoder.decode(raw)
+        return text[1:] if cut else text
+
+    def read_chars(self, start=0, count=None, encoding=None):
+        """
+        Return `count` characters starting at character `start`.
+
+        Character offsets depend on everything before them, so records are
+        decoded from the beginning, but only up to the last one needed.
+        """
+        parts = []
+        position = 0
+        end = None if count is None else start + count
+        for chunk in self.iter_text(encoding):
+            next_position = position + len(chunk)
+            if next_position > start:
+                parts.append(chunk[max(start - position, 0):None if end is None else end - position])
+            position = next_position
+            if end is not None and position >= end:
+                break
+        return ''.join(parts)
+
+    def _last_text_record(self):
+        return min(self.record_count, len(self.record_info_list) - 1 - self.base)
+
+    def _locate(self, offset):
+        """Map an uncompressed text offset to (record number, offset inside that record)."""
+        if self._record_starts is None:
+            return 1 + offset // self.record_size, offset % self.record_size
+        index = bisect.bisect_right(self._record_starts, offset) - 1
+        return index + 1, offset - self._record_starts[index]
+
+    def _index_records(self, data, decompress):
+        starts, position = [], 0
+        for i in range(1, self._last_text_record() + 1):
+            starts.append(position)
+            position += len(self._read_text_record(data, i, decompress))
+        self._record_starts = starts
+
+    def _read_bytes(self, data, start, end):
+        if end is None or (self.text_length and end > self.text_length):
+            end = self.text_length or end
+        start = max(start, 0)
+        if end is not None and start >= end:
+            return b''
+
+        decompress = self._decompressor(data)
+        if self._record_starts is None and not self.record_size:
+            self._index_records(data, decompress)
+        last = self._last_text_record()
+        index, skip = self._locate(start)
         output = bytearray()
-        i = 0
-        length = len(data)
-        
-        while i < length:
-            byte = data[i]
-            i += 1
-            
-            if byte == 0x00:
-                output.append(byte)
-            elif 0x01 <= byte <= 0x08:
-                # Copy next 'byte' bytes literally
-                count = byte
-                if i + count > length:
-                    count = length - i
-                output.extend(data[i:i+count])
-                i += count
-            elif 0x09 <= byte <= 0x7F:
-                output.append(byte)
-            elif 0xC0 <= byte <= 0xFF:
-                output.append(0x20)
-                output.append(byte ^ 0x80)
-            else: # 0x80..0xBF - LZ77 pair
-                if i >= length:
+        while index <= last and (end is None or len(output) < end - start + skip):
+            chunk = self._read_text_record(data, index, decompress)
+            if self._record_starts is None and index < last and len(chunk) != self.record_size:
+                # Records of uneven length: index all of them once and retry
+                self._index_records(data, decompress)
+                return self._read_bytes(data, start, end)
+            output += chunk
+            index += 1
+        return bytes(output[skip:None if end is None else skip + end - start])
+
+    def detect_encoding(self, data):
+        """
+        Choose the text encoding and record it in self.encoding.
+
+        self.encoding_reason says why it was chosen:
+        'header'     - the MOBI header encoding, confirmed by the sample
+        'mislabeled' - the header encoding does not fit the sample, which
+                       decodes cleanly as self.encoding instead
+        'sample'     - no usable header encoding, the sample decodes cleanly
+        'fallback'   - nothing decodes the sample cleanly, invalid bytes are dropped
+        """
+        samples = self._encoding_samples(data)
+        declared = CODE_PAGES.get(self.text_encoding)
+        has_non_ascii = not all(sample.isascii() for sample in samples)
+
+        if declared == 'utf-8' and _decodes(samples, 'utf-8'):
+            return self._set_encoding('utf-8', 'header')
+        if declared == 'cp1252':
+            # Many Chinese books are labelled CP1252 by conversion tools; CP1252
+            # accepts nearly any bytes, so only trust it if nothing stricter fits
+            if not has_non_ascii or not any(_decodes(samples, encoding) for encoding in SAMPLE_ENCODINGS):
+                return self._set_encoding('cp1252', 'header')
+
+        for encoding in SAMPLE_ENCODINGS:
+            if _decodes(samples, encoding):
+                return self._set_encoding(encoding, 'mislabeled' if declared else 'sample')
+        return self._set_encoding(FALLBACK_ENCODING, 'fallback')
+
+    def _set_encoding(self, encoding, reason):
+        self.encoding, self.encoding_reason = encoding, reason
+        return encoding
+
+    def _encoding_samples(self, data):
+        # Records spread evenly over the book, so a mostly-ASCII opening
+        # does not hide the encoding of the body text
+        last = self._last_text_record()
+        if last < 1:
+            return []
+        count = min(last, ENCODING_SAMPLE_RECORDS)
+        indexes = sorted({1 + (last - 1) * n // max(count - 1, 1) for n in range(count)})
+
+        decompress = self._decompressor(data)
+        samples = []
+        size = 0
+        for index in indexes:
+            sample = bytes(self._read_text_record(data, index, decompress))
+            samples.append(sample)
+            size += len(sample)
+            if size >= ENCODING_SAMPLE_SIZE:
+                break
+        return samples
+
+    def decompress_palmdoc(self, data):
+        # Text records never expand past record_size; anything beyond that
+        # comes from trailing entries appended to the record.
+        return decompress_palmdoc(data, self.record_size or None)
+
+
+class _ForwardWindow:
+    """Byte ranges of the text, read from records in order for ranges that only move forward."""
+    def __init__(self, records, start=0):
+        self.records = records
+        self.buffer = bytearray()
+        # Text offset of buffer[0]
+        self.start = start
+
+    def read(self, start, end):
+        """Return bytes [start, end), or None if start is before what was already dropped."""
+        if start < self.start:
+            return None
+        while self.start + len(self.buffer) < end:
+            chunk = next(self.records, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data = bytes(self.buffer[start - self.start:end - self.start])
+        drop = min(end - self.start, len(self.buffer))
+        del self.buffer[:drop]
+        self.start += drop
+        return data
+
+
+def _decodes(samples, encoding):
+    """True if every sample decodes strictly, allowing for split characters at the edges."""
+    for position, sample in enumerate(samples):
+        # Records after the first may start inside a multi-byte character
+        for skip in range(4 if position else 1):
+            try:
+                codecs.getincrementaldecoder(encoding)().decode(sample[skip:], final=False)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            return False
+    return True
+
+
+def _decompress_records(filename, bounds, record_size, extra_flags):
+    """Process pool worker: decompress the records at the given (start, end) offsets."""
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return [
+                decompress_palmdoc(strip_trailing_entries(data[start:end], extra_flags), record_size or None)
+                for start, end in bounds
+            ]
+
+
+def strip_trailing_entries(record, flags):
+    """Remove the trailing entries described by the MOBI extra data flags."""
+    if not flags:
+        return record
+
+    size = len(record)
+    trailing = 0
+    # Bits 1-15: variable-width entries whose size is stored backwards at the end
+    test_flags = flags >> 1
+    while test_flags:
+        if test_flags & 1:
+            end = size - trailing
+            value, shift = 0, 0
+            while end > 0:
+                byte = record[end - 1]
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                end -= 1
+                if byte & 0x80 or shift >= 28:
                     break
-                next_byte = data[i]
-                i += 1
-                
-                pair = (byte << 8) | next_byte
-                dist = (pair >> 3) & 0x07FF
-                count = (pair & 0x0007) + 3
-                
+            trailing += value
+        test_flags >>= 1
+    # Bit 0: multibyte character overlap, its size is in the low 2 bits
+    if flags & 1 and size - trailing > 0:
+        trailing += (record[size - trailing - 1] & 0x3) + 1
+
+    if trailing <= 0:
+        return record
+    return record[:max(size - trailing, 0)]
+
+
+# Runs of bytes that PalmDOC emits unchanged (0x00 and 0x09..0x7F)
+_LITERAL_RUN = re.compile(b'[\x00\x09-\x7f]+')
+# 0xC0..0xFF encodes a space followed by (byte ^ 0x80)
+_SPACE_PAIRS = [bytes((0x20, b ^ 0x80)) for b in range(256)]
+
+
+def decompress_palmdoc(data, max_size=None):
+    """
+    Decompress a single PalmDOC (LZ77) record.
+
+    Literal runs and back-references are copied as whole slices.  If
+    max_size is given, the output is cut to that many bytes.
+    """
+    output = bytearray()
+    length = len(data)
+    match_literals = _LITERAL_RUN.match
+    i = 0
+
+    while i < length:
+        byte = data[i]
+
+        if byte < 0x80 and not 0x01 <= byte <= 0x08:
+            end = match_literals(data, i).end()
+            output += data[i:end]
+            i = end
+            continue
+
+        i += 1
+        if byte <= 0x08:
+            # Copy next 'byte' bytes literally
+            output += data[i:i + byte]
+            i += byte
+        elif byte >= 0xC0:
+            output += _SPACE_PAIRS[byte]
+        else: # 0x80..0xBF - LZ77 pair
+            if i >= length:
+                break
+            pair = (byte << 8) | data[i]
+            i += 1
+            dist = (pair >> 3) & 0x07FF
+            count = (pair & 0x0007) + 3
+            size = len(output)
+
+            if 0 < dist <= size:
+                start = size - dist
+                if dist >= count:
+                    output += output[start:start + count]
+                else:
+                    # Overlapping copy: the last 'dist' bytes repeat
+                    chunk = output[start:]
+                    output += (chunk * (count // dist + 1))[:count]
+            else:
+                # Reference before the start of the record, matches the
+                # byte-wise behaviour of the original reader
                 for _ in range(count):
-                    if dist > len(output):
-                         output.append(0)
+                    if dist > len(output) or not output:
+                        output.append(0)
                     else:
-                         output.append(output[-dist])
-                         
-        return output
+                        output.append(output[-dist])
+
+    if max_size is not None and len(output) > max_size:
+        del output[max_size:]
+    return output
+
 
 if __name__ == "__main__":
     import sys
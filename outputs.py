@@ -0,0 +1,197 @@
+"""
+Compressed storage of converted text.
+
+A converted book can be stored as book.txt, book.txt.gz or book.txt.zst.
+The converter writes whichever one its output path names, and download
+and archive code asks for the logical book.txt path and gets back the
+file that actually exists together with its compression.  zstd needs the
+optional `zstandard` package.
+
+Plain and gzip outputs are written by writers that can checkpoint: they
+flush everything written so far to disk and return a small state from which
+the file can be reopened and continued after the process died.  A gzip
+checkpoint ends the deflate stream so far with a full flush, so a new
+compressor can carry on from that byte without the old one's history.
+"""
+import gzip
+import io
+import os
+import struct
+import time
+import zlib
+
+import backends
+
+# Compression name -> file suffix, in the order outputs are looked up
+SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+# Content-Encoding token of each compression
+CONTENT_ENCODINGS = {'gzip': 'gzip', 'zstd': 'zstd'}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def parse_compression(value):
+    """Map a config value ('', 'none', 'gzip', 'zstd') to a compression name or None."""
+    value = (value or '').strip().lower()
+    if value in ('', 'none', 'off', '0'):
+        return None
+    if value in ('gz', 'gzip'):
+        return 'gzip'
+    if value in ('zst', 'zstd'):
+        return 'zstd'
+    raise ValueError(f"Unknown output compression: {value}")
+
+
+def compression_of(path):
+    """Compression implied by the file name."""
+    for compression, suffix in SUFFIXES.items():
+        if compression and path.endswith(suffix):
+            return compression
+    return None
+
+
+def stored_path(path, compression):
+    """Path of the logical text file `path` when stored with `compression`."""
+    return path + SUFFIXES[compression]
+
+
+def find_output(path):
+    """Return (stored path, compression) for the logical text file `path`, or None if none exists."""
+    for compression, suffix in SUFFIXES.items():
+        if os.path.isfile(path + suffix):
+            return path + suffix, compression
+    return None
+
+
+def _zstandard():
+    module = backends.get('zstandard')
+    if module is None:
+        raise ValueError("zstd 压缩需要安装 zstandard 库 (pip install zstandard)")
+    return module
+
+
+def open_text(path, compression=None, resume=None):
+    """
+    Open a UTF-8 text file for writing, compressed as requested.
+
+    resume: a state returned by the writer's checkpoint(); the file is cut
+    back to that point and writing continues there.  zstd outputs cannot be
+    resumed and their checkpoint() returns None.
+    """
+    if compression == 'gzip':
+        return GzipTextWriter(path, resume)
+    if compression == 'zstd':
+        if resume:
+            raise ValueError("zstd outputs cannot be resumed")
+        writer = _zstandard().ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, 'wb'), closefd=True)
+        return _ZstdTextWriter(writer, encoding='utf-8')
+    return PlainTextWriter(path, resume)
+
+
+class _ZstdTextWriter(io.TextIOWrapper):
+    def checkpoint(self):
+        return None
+
+
+class PlainTextWriter:
+    """Text file written as UTF-8 with the platform's line endings, as open(path, 'w') would."""
+
+    def __init__(self, path, resume=None):
+        self.file = _reopen(path, resume)
+
+    def _encode(self, text):
+        if os.linesep != '\n':
+            text = text.replace('\n', os.linesep)
+        return text.encode('utf-8')
+
+    def write(self, text):
+        self.file.write(self._encode(text))
+
+    def checkpoint(self):
+        """Make everything written so far durable and return the state to resume from."""
+        _sync(self.file)
+        return {'offset': self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GzipTextWriter(PlainTextWriter):
+    def __init__(self, path, resume=None, level=GZIP_LEVEL):
+        self.file = _reopen(path, resume)
+        if resume:
+            self.crc, self.size = resume['crc'], resume['size']
+        else:
+            # Minimal gzip header: deflate, no file name, modification time, unknown OS
+            self.file.write(b'\x1f\x8b\x08\x00' + struct.pack('<L', int(time.time())) + b'\x00\xff')
+            self.crc = self.size = 0
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def write(self, text):
+        data = self._encode(text)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.file.write(self._compressor.compress(data))
+
+    def checkpoint(self):
+        # A full flush leaves nothing the rest of the stream depends on
+        self.file.write(self._compressor.flush(zlib.Z_FULL_FLUSH))
+        _sync(self.file)
+        return {'offset': self.file.tell(), 'crc': self.crc, 'size': self.size}
+
+    def close(self):
+        if self._compressor is not None:
+            self.file.write(self._compressor.flush())
+            self.file.write(struct.pack('<LL', self.crc, self.size & 0xFFFFFFFF))
+            self._compressor = None
+        self.file.close()
+
+
+def _reopen(path, resume):
+    if not resume:
+        return open(path, 'wb')
+    f = open(path, 'r+b')
+    try:
+        if os.path.getsize(path) < resume['offset']:
+            raise ValueError("Output is shorter than its checkpoint")
+        # Whatever follows the checkpoint is written again
+        f.truncate(resume['offset'])
+        f.seek(resume['offset'])
+    except Exception:
+        f.close()
+        raise
+    return f
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def open_plain(path, compression=None):
+    """Open a stored output for reading its uncompressed bytes."""
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def plain_size(path, compression=None):
+    """Uncompressed size of a stored output, or None if it cannot be known without reading it all."""
+    if compression is None:
+        return os.path.getsize(path)
+    if compression == 'gzip':
+        # The gzip trailer holds the size modulo 2**32; outputs are far smaller
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            size, = struct.unpack('<I', f.read(4))
+        return size
+    return None
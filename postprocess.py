@@ -0,0 +1,212 @@
+"""
+Streaming clean-up of extracted text before it is written out.
+
+The converter passes every piece of text through a TextPipeline on its way to
+the output file.  Each step takes text in arbitrary chunks through feed() and
+returns what it can already emit; close() returns the rest.  Steps only hold
+back an incomplete line or a few characters, so memory does not depend on
+the size of the book, and feeding a text in one piece or in many gives the
+same result.
+
+Always on:
+  blank lines  trailing whitespace (including no-break and ideographic
+               spaces) is removed from every line, whitespace-only lines
+               count as blank, and runs of blank lines become one.
+Optional (the `normalize` setting):
+  width        full-width ASCII letters and digits become half-width.
+  nfc          Unicode NFC normalization.
+"""
+import re
+import unicodedata
+
+import metrics
+
+NORMALIZE_STEPS = ('width', 'nfc')
+
+LINE_SPACE = ' \t\r\f\v\xa0\u3000'
+_BLANK_LINES = re.compile('\n{3,}')
+
+# Full-width digits and Latin letters; full-width punctuation is left alone
+# because CJK text uses it on purpose
+_WIDTH_TABLE = {code: code - 0xFEE0 for code in (*range(0xFF10, 0xFF1A), *range(0xFF21, 0xFF3B),
+                                                  *range(0xFF41, 0xFF5B))}
+
+# Characters that never combine with what precedes them under NFC, so text
+# may be split before one of them: everything below the combining marks,
+# kana (except the combining voiced sound marks), CJK ideographs and Hangul
+# syllables
+_NFC_STARTER = re.compile('[\x00-\u02ff\u3040-\u3098\u309b-\u9fff\uac00-\ud7a3]')
+# Longest tail held back while waiting for a starter
+NFC_MAX_HOLD = 64 * 1024
+
+
+def parse_normalize(value):
+    """Map a config value ('width,nfc', a list, '' or 'none') to a tuple of step names."""
+    if isinstance(value, str):
+        value = value.replace(',', ' ').split()
+    names = {name.strip().lower() for name in value or ()} - {'', 'none'}
+    unknown = names - set(NORMALIZE_STEPS)
+    if unknown:
+        raise ValueError(f"Unknown text normalization: {', '.join(sorted(unknown))}")
+    return tuple(name for name in NORMALIZE_STEPS if name in names)
+
+
+class BlankLines:
+    def __init__(self):
+        # Line breaks seen since the last emitted text, and whether any text was emitted
+        self._breaks = 0
+        self._started = False
+        # Whitespace at the end of the current line that may still turn out to be trailing
+        self._held = ''
+
+    def feed(self, text):
+        text = self._held + text
+        out = []
+        cut = text.rfind('\n')
+        if cut >= 0:
+            lines = '\n'.join([line.rstrip(LINE_SPACE) for line in text[:cut].split('\n')])
+            content = lines.lstrip('\n')
+            if content:
+                self._emit(len(lines) - len(content), out)
+                if '\n\n\n' in content:
+                    content = _BLANK_LINES.sub('\n\n', content)
+                body = content.rstrip('\n')
+                out.append(body)
+                self._breaks = len(content) - len(body) + 1
+            else:
+                self._breaks += len(lines) + 1
+            text = text[cut + 1:]
+
+        content = text.rstrip(LINE_SPACE)
+        if content:
+            self._emit(0, out)
+            out.append(content)
+            self._breaks = 0
+        self._held = text[len(content):]
+        return ''.join(out)
+
+    def _emit(self, leading_breaks, out):
+        # Line breaks before the next text: none at the start, at most one blank line
+        breaks = self._breaks + leading_breaks
+        if self._started and breaks:
+            out.append('\n\n' if breaks > 1 else '\n')
+        self._started = True
+
+    def close(self):
+        # Trailing whitespace and blank lines at the end are dropped
+        self._held = ''
+        return ''
+
+
+class Width:
+    def feed(self, text):
+        return text.translate(_WIDTH_TABLE)
+
+    def close(self):
+        return ''
+
+
+class NFC:
+    def __init__(self):
+        self._held = ''
+
+    def feed(self, text):
+        text = self._held + text
+        # Hold back the tail from the last starter: what follows may still combine with it
+        for i in range(len(text) - 1, max(-1, len(text) - NFC_MAX_HOLD), -1):
+            if _NFC_STARTER.match(text[i]):
+                split = i
+                break
+        else:
+            split = max(0, len(text) - NFC_MAX_HOLD)
+        self._held = text[split:]
+        return _nfc(text[:split])
+
+    def close(self):
+        text, self._held = self._held, ''
+        return _nfc(text)
+
+
+def _nfc(text):
+    return text if unicodedata.is_normalized('NFC', text) else unicodedata.normalize('NFC', text)
+
+
+STEPS = {'width': Width, 'nfc': NFC}
+
+
+class TextPipeline:
+    def __init__(self, steps):
+        self.steps = steps
+
+    def get_state(self):
+        """What the steps are holding back, as JSON-compatible data for a checkpoint."""
+        return [dict(vars(step)) for step in self.steps]
+
+    def set_state(self, state):
+        if len(state) != len(self.steps):
+            raise ValueError("Checkpoint does not match the text pipeline")
+        for step, values in zip(self.steps, state):
+            vars(step).update(values)
+
+    def feed(self, text):
+        for step in self.steps:
+            text = step.feed(text)
+        return text
+
+    def close(self):
+        text = ''
+        for step in self.steps:
+            text = step.feed(text) + step.close() if text else step.close()
+        return text
+
+
+def build_pipeline(normalize=()):
+    """The blank line step followed by the normalization steps named in `normalize`."""
+    return TextPipeline([BlankLines()] + [STEPS[name]() for name in parse_normalize(normalize)])
+
+
+def clean_text(text, normalize=()):
+    pipeline = build_pipeline(normalize)
+    return pipeline.feed(text) + pipeline.close()
+
+
+class TextWriter:
+    """File-like wrapper passing written text through a pipeline; closing it flushes the pipeline."""
+
+    def __init__(self, f, pipeline, timings=metrics.NULL_TIMINGS):
+        self.file = f
+        self.pipeline = pipeline
+        self.timings = timings
+
+    def write(self, text):
+        with self.timings.stage('postprocess'):
+            text = self.pipeline.feed(text)
+        if text:
+            with self.timings.stage('write'):
+                self.file.write(text)
+
+    def close(self):
+        try:
+            with self.timings.stage('postprocess'):
+                text = self.pipeline.close()
+            if text:
+                with self.timings.stage('write'):
+                    self.file.write(text)
+        finally:
+            self.file.close()
+
+    def checkpoint(self):
+        """Flush the output to disk and return {'output', 'pipeline'} to resume from, or None if it cannot resume."""
+        output = self.file.checkpoint()
+        if output is None:
+            return None
+        return {'output': output, 'pipeline': self.pipeline.get_state()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
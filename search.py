@@ -0,0 +1,305 @@
+"""
+Full-text search over the converted library.
+
+Books are split into passages of about PASSAGE_CHARS characters at line
+breaks.  Each passage is stored zlib-compressed (for snippets) and its
+tokens go into a contentless SQLite FTS5 table, so the index holds only the
+inverted lists.  Tokens are lowercased words for alphabetic scripts and
+overlapping character bigrams for runs of CJK text (天下大势 -> 天下 下大
+大势); a query is tokenized the same way and each query word becomes an FTS5
+phrase, so any substring of two or more CJK characters is found.  A single
+CJK character only matches as the start of a bigram.
+
+Books are added from their finished output, streamed in chunks, and removed
+by cache key when the conversion cache evicts them.  BackgroundIndexer does
+both on a thread of its own so conversions never wait for the index, and
+merges FTS5 segments whenever it runs out of work.
+"""
+import codecs
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import outputs
+from cache import _Connection
+
+PASSAGE_CHARS = 1000
+READ_CHUNK_SIZE = 256 * 1024
+SNIPPET_CHARS = 120
+# Passages fetched per wanted book before grouping hits by book
+PASSAGES_PER_RESULT = 4
+# Pages FTS5 may write per merge() step
+MERGE_PAGES = 256
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_TOKEN = re.compile(f'([{_CJK}]+)|((?:(?![{_CJK}])[^\\W_])+)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    title TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS passages (
+    id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    text BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS passages_book ON passages (book);
+CREATE VIRTUAL TABLE IF NOT EXISTS passage_index USING fts5(tokens, content='', tokenize='unicode61', prefix='1');
+"""
+
+
+def tokenize(text):
+    """Search tokens of text: lowercased words and bigrams of CJK runs (a lone CJK character stays whole)."""
+    tokens = []
+    for cjk, word in _TOKEN.findall(text):
+        if word:
+            tokens.append(word.lower())
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens += [cjk[i:i + 2] for i in range(len(cjk) - 1)]
+    return tokens
+
+
+def match_expression(query):
+    """FTS5 MATCH expression requiring every word of the query, or None if it has no tokens."""
+    phrases = []
+    for term in query.split():
+        tokens = tokenize(term)
+        if len(tokens) == 1 and len(tokens[0]) == 1 and _TOKEN.match(tokens[0]).group(1):
+            # One CJK character: any bigram starting with it
+            phrases.append(f'"{tokens[0]}"*')
+        elif tokens:
+            phrases.append('"' + ' '.join(tokens) + '"')
+    return ' '.join(phrases) or None
+
+
+def iter_passages(chunks, size=PASSAGE_CHARS):
+    """Split streamed text into passages of about `size` characters, at line breaks where possible."""
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while len(buffer) - start >= size:
+            cut = buffer.rfind('\n', start, start + size * 2)
+            if cut < start + size // 2:
+                cut = start + size
+            passage = buffer[start:cut]
+            if passage.strip():
+                yield passage
+            start = cut
+            while start < len(buffer) and buffer[start] == '\n':
+                start += 1
+        buffer = buffer[start:]
+    if buffer.strip():
+        yield buffer
+
+
+def read_output(path, chunk_size=READ_CHUNK_SIZE):
+    """Yield the text of a stored (possibly compressed) output in chunks."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    with outputs.open_plain(path, outputs.compression_of(path)) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
+
+
+def snippet(text, query, width=SNIPPET_CHARS):
+    """Return (snippet, [[start, end], ...]) around the first occurrence of a query word."""
+    folded = text.lower()
+    terms = [term.lower() for term in query.split()]
+    found = [position for position in (folded.find(term) for term in terms) if position >= 0]
+    start = max(0, min(found) - width // 3) if found else 0
+    end = min(len(text), start + width)
+    # Snippets start and end at whole lines when a line break is close
+    line_start = text.rfind('\n', start, min(found) if found else start)
+    if line_start >= 0:
+        start = line_start + 1
+    piece = text[start:end].replace('\n', ' ')
+    highlights = []
+    folded_piece = piece.lower()
+    for term in terms:
+        position = folded_piece.find(term)
+        while position >= 0:
+            highlights.append([position, position + len(term)])
+            position = folded_piece.find(term, position + len(term))
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(text) else ''
+    highlights = [[a + len(prefix), b + len(prefix)] for a, b in sorted(highlights)]
+    return prefix + piece + suffix, highlights
+
+
+class SearchIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Raises sqlite3.OperationalError if SQLite was built without FTS5
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        # WAL stays consistent without a sync per commit; a crash can only lose the last books added
+        db.execute('PRAGMA synchronous=NORMAL')
+        return _Connection(db)
+
+    def add_book(self, key, filename, title, chunks):
+        """Index a book from its text chunks, replacing any earlier entry for key; returns the passage count."""
+        count = 0
+        size = 0
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            self._remove(db, key)
+            book = db.execute('INSERT INTO books (key, filename, title, size, added) VALUES (?, ?, ?, 0, ?)',
+                              (key, filename, title, time.time())).lastrowid
+            for passage in iter_passages(chunks):
+                passage_id = db.execute('INSERT INTO passages (book, text) VALUES (?, ?)',
+                                        (book, zlib.compress(passage.encode('utf-8')))).lastrowid
+                db.execute('INSERT INTO passage_index (rowid, tokens) VALUES (?, ?)',
+                           (passage_id, ' '.join(tokenize(passage))))
+                count += 1
+                size += len(passage)
+            db.execute('UPDATE books SET size = ? WHERE id = ?', (size, book))
+            db.execute('COMMIT')
+        return count
+
+    def add_output(self, key, filename, path):
+        """Index a converted output file; the title is its file name without .txt."""
+        title = os.path.basename(filename)
+        if title.endswith('.txt'):
+            title = title[:-4]
+        return self.add_book(key, filename, title, read_output(path))
+
+    def remove(self, keys):
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            for key in keys:
+                self._remove(db, key)
+            db.execute('COMMIT')
+
+    def _remove(self, db, key):
+        row = db.execute('SELECT id FROM books WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return
+        # A contentless FTS5 table deletes a row given the tokens it was indexed with
+        for passage_id, text in db.execute('SELECT id, text FROM passages WHERE book = ?', row).fetchall():
+            tokens = ' '.join(tokenize(zlib.decompress(text).decode('utf-8')))
+            db.execute("INSERT INTO passage_index (passage_index, rowid, tokens) VALUES ('delete', ?, ?)",
+                       (passage_id, tokens))
+        db.execute('DELETE FROM passages WHERE book = ?', row)
+        db.execute('DELETE FROM books WHERE id = ?', row)
+
+    def search(self, query, limit=20):
+        """
+        Books matching every word of the query, best first.
+
+        Returns [{'key', 'filename', 'title', 'score', 'snippet', 'highlights'}, ...];
+        books are ranked by their best passage (FTS5 bm25, lower is better).
+        """
+        expression = match_expression(query)
+        if expression is None or limit <= 0:
+            return []
+        with self._connect() as db:
+            fetch = limit * PASSAGES_PER_RESULT
+            while True:
+                rows = db.execute(
+                    'SELECT p.book, p.text, f.rank FROM passage_index f JOIN passages p ON p.id = f.rowid '
+                    'WHERE passage_index MATCH ? ORDER BY f.rank LIMIT ?', (expression, fetch)).fetchall()
+                best = {}
+                for book, text, rank in rows:
+                    if book not in best:
+                        best[book] = (rank, text)
+                if len(best) >= limit or len(rows) < fetch:
+                    break
+                fetch *= 4
+
+            results = []
+            for book, (rank, text) in list(best.items())[:limit]:
+                key, filename, title = db.execute('SELECT key, filename, title FROM books WHERE id = ?',
+                                                  (book,)).fetchone()
+                text, highlights = snippet(zlib.decompress(text).decode('utf-8'), query)
+                results.append({'key': key, 'filename': filename, 'title': title, 'score': round(-rank, 4),
+                                'snippet': text, 'highlights': highlights})
+        return results
+
+    def merge(self, pages=MERGE_PAGES, max_steps=64):
+        """Merge index segments in steps of `pages` pages until nothing is left to merge; returns the steps run."""
+        with self._connect() as db:
+            for step in range(max_steps):
+                before = db.total_changes
+                db.execute("INSERT INTO passage_index (passage_index, rank) VALUES ('merge', ?)", (pages,))
+                # Per the FTS5 docs, fewer than two changes means there was no merge work left
+                if db.total_changes - before < 2:
+                    return step
+        return max_steps
+
+    def optimize(self):
+        """Merge every segment into one (slow on a large index)."""
+        with self._connect() as db:
+            db.execute("INSERT INTO passage_index (passage_index) VALUES ('optimize')")
+
+    def stats(self):
+        with self._connect() as db:
+            books, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM books').fetchone()
+            passages = db.execute('SELECT COUNT(*) FROM passages').fetchone()[0]
+        return {'books': books, 'passages': passages, 'chars': size,
+                'bytes': os.path.getsize(self.db_path)}
+
+
+class BackgroundIndexer:
+    """Applies adds and removals to a SearchIndex in order on a daemon thread."""
+
+    def __init__(self, index):
+        self.index = index
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add_output(self, key, filename, path):
+        self._put(('add', key, filename, path))
+
+    def remove(self, keys):
+        self._put(('remove', list(keys)))
+
+    def join(self):
+        """Wait until everything queued so far is done."""
+        self._queue.join()
+
+    def _put(self, task):
+        with self._lock:
+            # The thread starts with the first book, not when the app starts
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='search-indexer', daemon=True)
+                self._thread.start()
+        self._queue.put(task)
+
+    def _run(self):
+        merge_pending = False
+        while True:
+            task = self._queue.get()
+            try:
+                if task[0] == 'add':
+                    self.index.add_output(*task[1:])
+                    merge_pending = True
+                else:
+                    self.index.remove(task[1])
+                if merge_pending and self._queue.empty():
+                    self.index.merge()
+                    merge_pending = False
+            except Exception as e:
+                print(f"Search index {task[0]} failed: {e}")
+            finally:
+                self._queue.task_done()
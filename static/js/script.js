@@ -16,6 +16,11 @@ document.addEventListener('DOMContentLoaded', () => {
     let isPaused = false;
     let isProcessing = false;
 
+    // Files sent per /upload_batch request; the total stays under the server's upload limit.
+    // Pausing takes effect between requests: a batch already sent is converted to the end.
+    const BATCH_MAX_FILES = 20;
+    const BATCH_MAX_BYTES = 40 * 1024 * 1024;
+
     // Drag & Drop events
     function handleDragEnter(e) {
         e.preventDefault();
@@ -169,9 +174,9 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
 
-        const nextItem = conversionQueue.find(item => item.status === 'pending');
+        const batch = nextBatch();
         
-        if (!nextItem) {
+        if (batch.length === 0) {
             isProcessing = false;
             toggleButtons(false);
             queueStatus.textContent = '所有任务已完成';
@@ -179,18 +184,128 @@ document.addEventListener('DOMContentLoaded', () => {
         }
         
         updateQueueStatus();
-        processItem(nextItem).then(() => {
+        // A single file goes through /upload so it gets live progress
+        const done = batch.length === 1 ? processItem(batch[0]) : processBatch(batch);
+        done.then(() => {
             processNextInQueue();
         });
     }
 
+    function nextBatch() {
+        const batch = [];
+        let bytes = 0;
+        for (const item of conversionQueue) {
+            if (item.status !== 'pending') continue;
+            if (batch.length > 0 && (batch.length >= BATCH_MAX_FILES || bytes + item.file.size > BATCH_MAX_BYTES)) break;
+            batch.push(item);
+            bytes += item.file.size;
+        }
+        return batch;
+    }
+
+    // Upload several files in one request; the server answers with one JSON line per file as each finishes
+    function processBatch(items) {
+        const formData = new FormData();
+        items.forEach(item => {
+            item.status = 'converting';
+            setItemStatus(item, '上传中...', 'status converting');
+            formData.append('files', item.file);
+        });
+
+        const handleResult = (result) => {
+            const item = items[result.index];
+            if (!item) return;
+            if (result.status === 'done') {
+                item.status = 'done';
+                moveToCompleted(item, result);
+            } else {
+                item.status = 'error';
+                setItemStatus(item, '失败: ' + (result.error || '未知错误'), 'status error');
+            }
+            updateQueueStatus();
+        };
+
+        return fetch('/upload_batch', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => {
+            if (response.status === 429) {
+                // Server is busy: put the files back and retry shortly, as processItem does
+                items.forEach(item => {
+                    item.status = 'pending';
+                    setItemStatus(item, '服务器繁忙，稍后重试...', 'status');
+                });
+                return waitToRetry(response);
+            }
+            if (!response.ok) {
+                return response.json().then(data => { throw new Error(data.error || '未知错误'); });
+            }
+            items.forEach(item => setItemStatus(item, '转换中...', 'status converting'));
+            return readLines(response, line => handleResult(JSON.parse(line)));
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            items.forEach(item => {
+                if (item.status === 'converting') {
+                    item.status = 'error';
+                    setItemStatus(item, '失败: ' + error.message, 'status error');
+                }
+            });
+        })
+        .finally(() => {
+            // Anything the server never reported counts as failed
+            items.forEach(item => {
+                if (item.status === 'converting') {
+                    item.status = 'error';
+                    setItemStatus(item, '失败: 连接中断', 'status error');
+                }
+            });
+        });
+    }
+
+    // Resolves after the Retry-After of a 429 response (5 seconds if it has none)
+    function waitToRetry(response) {
+        const seconds = parseInt(response.headers.get('Retry-After'), 10);
+        return new Promise(retry => setTimeout(retry, (seconds > 0 ? seconds : 5) * 1000));
+    }
+
+    function readLines(response, onLine) {
+        if (!response.body || !window.TextDecoder) {
+            return response.text().then(text => text.split('\n').filter(Boolean).forEach(onLine));
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        const pump = () => reader.read().then(({ done, value }) => {
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.filter(Boolean).forEach(onLine);
+            if (done) {
+                if (buffer) onLine(buffer);
+                return;
+            }
+            return pump();
+        });
+        return pump();
+    }
+
+    function setItemStatus(item, text, className) {
+        const statusEl = document.getElementById(`status-${item.id}`);
+        if (statusEl) {
+            statusEl.textContent = text;
+            statusEl.className = className;
+        }
+    }
+
     function processItem(item) {
         return new Promise((resolve) => {
             item.status = 'converting';
             const statusEl = document.getElementById(`status-${item.id}`);
             
             if (statusEl) {
-                statusEl.textContent = '转换中...';
+                statusEl.textContent = '上传中...';
                 statusEl.className = 'status converting';
             }
             
@@ -201,14 +316,33 @@ document.addEventListener('DOMContentLoaded', () => {
                 method: 'POST',
                 body: formData
             })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    item.status = 'done';
-                    moveToCompleted(item, data);
-                } else {
-                    throw new Error(data.error || '未知错误');
+            .then(response => {
+                if (response.status === 429) {
+                    return response;
+                }
+                return response.json().then(data => {
+                    if (!response.ok || !(data.job_id || data.download_url)) {
+                        throw new Error(data.error || '未知错误');
+                    }
+                    return data;
+                });
+            })
+            .then(job => {
+                if (job instanceof Response) {
+                    // Server queue is full: put the file back and retry shortly
+                    item.status = 'pending';
+                    if (statusEl) {
+                        statusEl.textContent = '服务器繁忙，稍后重试...';
+                        statusEl.className = 'status';
+                    }
+                    return waitToRetry(job);
                 }
+                // A cached conversion comes back already finished
+                const finished = job.status === 'done' ? Promise.resolve(job) : watchJob(item, job);
+                return finished.then(result => {
+                    item.status = 'done';
+                    moveToCompleted(item, result);
+                });
             })
             .catch(error => {
                 item.status = 'error';
@@ -224,6 +358,63 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // Follow a conversion job until it finishes, using server-sent progress events
+    function watchJob(item, job) {
+        return new Promise((resolve, reject) => {
+            const finish = (status) => {
+                if (status.status === 'done') {
+                    resolve(status);
+                } else {
+                    reject(new Error(status.error || status.message || '未知错误'));
+                }
+            };
+
+            if (!window.EventSource) {
+                pollJob(item, job.status_url).then(finish, reject);
+                return;
+            }
+
+            const source = new EventSource(job.events_url);
+            source.onmessage = (event) => {
+                const status = JSON.parse(event.data);
+                showJobProgress(item, status);
+                if (['done', 'failed', 'cancelled'].includes(status.status)) {
+                    source.close();
+                    finish(status);
+                }
+            };
+            source.onerror = () => {
+                // Stream dropped (proxy timeout etc.): fall back to polling
+                source.close();
+                pollJob(item, job.status_url).then(finish, reject);
+            };
+        });
+    }
+
+    function pollJob(item, statusUrl) {
+        return fetch(statusUrl)
+            .then(response => response.json())
+            .then(status => {
+                showJobProgress(item, status);
+                if (['done', 'failed', 'cancelled'].includes(status.status) || !status.status) {
+                    return status;
+                }
+                return new Promise(wait => setTimeout(wait, 1000)).then(() => pollJob(item, statusUrl));
+            });
+    }
+
+    function showJobProgress(item, status) {
+        const statusEl = document.getElementById(`status-${item.id}`);
+        if (!statusEl || !status.status) return;
+        if (status.status === 'queued') {
+            statusEl.textContent = '排队中...';
+        } else if (status.status === 'paused') {
+            statusEl.textContent = '已暂停';
+        } else if (status.status === 'running') {
+            statusEl.textContent = `转换中 ${Math.round(status.progress)}%`;
+        }
+    }
+
     function moveToCompleted(item, data) {
         // Move DOM element to completed list
         const element = document.getElementById(`item-${item.id}`);
@@ -236,7 +427,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 <div class="file-info">
                     <input type="checkbox" class="file-checkbox" id="cb-${item.id}" data-filename="${data.filename}" checked style="margin-right: 15px; transform: scale(1.2);">
                     <div class="file-icon">✅</div>
-                    <div class="file-name" title="${data.filename}">${data.filename}</div> <!-- Use converted filename -->
+                    <div class="file-name" title="${data.display_name || data.filename}">${data.display_name || data.filename}</div> <!-- Use converted filename -->
                 </div>
                 <div style="display: flex; align-items: center; gap: 10px;">
                      <div class="status success">完成</div>
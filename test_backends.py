@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import backends
+
+
+def test_app_starts_without_loading_backends():
+    script = (
+        "import json, sys\n"
+        "import app\n"
+        "app.app.test_client().get('/healthz')\n"
+        "sys.__stdout__.write(json.dumps(sorted(m for m in ('epub_reader', 'mobi_reader', 'html_text', 'mobi')"
+        " if m in sys.modules)))\n"
+    )
+    proc = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert proc.returncode == 0, proc.stderr
+    assert json.loads(proc.stdout) == []
+
+
+def test_optional_and_required_backends():
+    backends.register('test_missing_optional', 'no_such_module_here', optional=True)
+    backends.register('test_missing_required', 'no_such_module_here')
+    try:
+        assert backends.get('test_missing_optional') is None
+        assert not backends.available('test_missing_optional')
+        with pytest.raises(ImportError):
+            backends.get('test_missing_required')
+    finally:
+        del backends._backends['test_missing_optional']
+        del backends._backends['test_missing_required']
+
+    from epub_reader import EpubReader
+    assert backends.warm_up(['.epub']) == {'epub_reader': True, 'html_text': True}
+    assert backends.get('epub_reader') is EpubReader
+    assert 'epub_reader' in backends.loaded()
@@ -0,0 +1,19 @@
+import re
+
+from benchmarks import compare
+
+
+def test_compare_flags_regressions(capsys):
+    baseline = {
+        'palmdoc': {'mb_per_s': 10.0, 'peak_rss_mb': 20.0},
+        'upload': {'mb_per_s': 10.0, 'peak_rss_mb': 20.0},
+        'extract_text[utf-8]': {'mb_per_s': 10.0, 'peak_rss_mb': 20.0},
+    }
+    results = {
+        'palmdoc': {'mb_per_s': 9.5, 'peak_rss_mb': 21.0},
+        'upload': {'mb_per_s': 7.0, 'peak_rss_mb': 20.0},
+        'extract_text[utf-8]': {'mb_per_s': 12.0, 'peak_rss_mb': 30.0},
+        'new': {'mb_per_s': 1.0, 'peak_rss_mb': None},
+    }
+    assert compare(results, baseline, threshold=0.15) == ['upload', 'extract_text[utf-8]']
+    assert re.search(r'REGRESSION: slower\n.*REGRESSION: more memory', capsys.readouterr().out, re.S)
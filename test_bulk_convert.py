@@ -0,0 +1,92 @@
+import gzip
+import json
+import os
+import time
+
+import bulk_convert
+from corpus import build_epub, build_mobi
+
+
+def make_library(root):
+    (root / 'a').mkdir(parents=True)
+    (root / 'a' / 'one.epub').write_bytes(build_epub([('第一章', ['一号书正文'])]))
+    (root / 'a' / 'two.EPUB').write_bytes(build_epub([('Chapter', ['Book two text'])]))
+    (root / 'three.mobi').write_bytes(build_mobi('<p>Book three text</p>'.encode('utf-8') * 50))
+    (root / 'broken.epub').write_bytes(b'not a zip')
+    (root / 'notes.txt').write_text('ignored')
+
+
+def read_manifest(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_bulk_convert_and_resume(tmp_path, capsys):
+    library, out = tmp_path / 'library', tmp_path / 'out'
+    make_library(library)
+    args = [str(library), '-o', str(out), '-w', '2', '-q']
+
+    assert bulk_convert.main(args) == 1
+    assert 'Book two text' in (out / 'a' / 'two.txt').read_text(encoding='utf-8')
+    assert 'Book three text' in (out / 'three.txt').read_text(encoding='utf-8')
+    records = read_manifest(out / bulk_convert.MANIFEST_NAME)
+    assert sorted(r['status'] for r in records) == ['done', 'done', 'done', 'failed']
+    assert not os.path.exists(out / 'broken.txt') and not os.path.exists(out / 'broken.txt.part')
+    assert '吞吐量' in capsys.readouterr().out
+
+    # Second run: everything converted is up to date, only the broken book is retried
+    os.remove(library / 'broken.epub')
+    assert bulk_convert.main(args) == 0
+    assert len(read_manifest(out / bulk_convert.MANIFEST_NAME)) == 4
+
+    # A newer input is converted again
+    later = time.time() + 10
+    os.utime(library / 'a' / 'one.epub', (later, later))
+    assert bulk_convert.main(args) == 0
+    records = read_manifest(out / bulk_convert.MANIFEST_NAME)
+    assert len(records) == 5 and records[-1]['input'].endswith('one.epub')
+
+
+def test_hash_check_uses_manifest(tmp_path):
+    library, out = tmp_path / 'library', tmp_path / 'out'
+    make_library(library)
+    os.remove(library / 'broken.epub')
+    args = [str(library), '-o', str(out), '-w', '1', '-q', '--check', 'hash']
+
+    assert bulk_convert.main(args) == 0
+    assert bulk_convert.main(args) == 0
+    records = read_manifest(out / bulk_convert.MANIFEST_NAME)
+    assert [r['status'] for r in records[3:]] == ['skipped'] * 3
+
+    # Touching a file does not matter in hash mode; changing it does
+    (library / 'three.mobi').write_bytes(build_mobi(b'<p>Changed</p>'))
+    assert bulk_convert.main(args) == 0
+    assert 'Changed' in (out / 'three.txt').read_text(encoding='utf-8')
+
+
+def test_compressed_outputs(tmp_path):
+    library, out = tmp_path / 'library', tmp_path / 'out'
+    make_library(library)
+    os.remove(library / 'broken.epub')
+
+    assert bulk_convert.main([str(library), '-o', str(out), '-q', '--compress', 'gzip']) == 0
+    with gzip.open(out / 'three.txt.gz', 'rt', encoding='utf-8') as f:
+        assert 'Book three text' in f.read()
+    assert not os.path.exists(out / 'three.txt')
+    assert read_manifest(out / bulk_convert.MANIFEST_NAME)[0]['output'].endswith('.txt.gz')
+
+
+def test_books_differing_only_in_extension(tmp_path):
+    library, out = tmp_path / 'library', tmp_path / 'out'
+    library.mkdir()
+    (library / 'a.epub').write_bytes(build_epub([('Chapter', ['EPUB edition'])]))
+    (library / 'a.mobi').write_bytes(build_mobi(b'<p>MOBI edition</p>'))
+    (library / 'b.mobi').write_bytes(build_mobi(b'<p>Only edition</p>'))
+
+    tasks, _ = bulk_convert.plan([str(library), str(library / 'b.mobi')], str(out), {}, 'mtime', False)
+    assert sorted(os.path.basename(task[1]) for task in tasks) == ['a.epub.txt', 'a.mobi.txt', 'b.txt']
+
+    assert bulk_convert.main([str(library), '-o', str(out), '-q']) == 0
+    assert 'EPUB edition' in (out / 'a.epub.txt').read_text(encoding='utf-8')
+    assert 'MOBI edition' in (out / 'a.mobi.txt').read_text(encoding='utf-8')
+    assert not os.path.exists(out / 'a.txt')
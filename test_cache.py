@@ -0,0 +1,89 @@
+import io
+import os
+import time
+
+from cache import ConversionCache, save_with_hash
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_save_with_hash(tmp_path):
+    import hashlib
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    temp_path, digest = save_with_hash(io.BytesIO(data), str(tmp_path), '.epub')
+    assert digest == hashlib.sha256(data).hexdigest()
+    with open(temp_path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_keys_depend_on_version_and_options():
+    key = ConversionCache.make_key('abc', '.epub')
+    assert key == ConversionCache.make_key('abc', '.EPUB')
+    assert key != ConversionCache.make_key('abc', '.mobi')
+    assert key != ConversionCache.make_key('abc', '.epub', {'normalize': True})
+
+
+def test_lookup_store_and_lru_eviction(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), max_bytes=250)
+    assert cache.lookup('a') is None
+
+    for key in 'abc':
+        cache.store(key, write(str(tmp_path / f'{key}.txt'), key.encode() * 100))
+        time.sleep(0.01)
+    # Three 100-byte entries do not fit in 250 bytes: the oldest goes
+    assert cache.lookup('a') is None
+    with open(cache.lookup('b'), 'rb') as f:
+        assert f.read() == b'b' * 100
+
+    # 'b' was just used, so adding 'd' evicts 'c'
+    cache.store('d', write(str(tmp_path / 'd.txt'), b'd' * 100))
+    assert cache.lookup('c') is None
+    assert cache.lookup('b') and cache.lookup('d')
+
+    # A second instance on the same directory shares the index and counters
+    stats = ConversionCache(str(tmp_path / 'cache'), max_bytes=250).stats()
+    assert stats['entries'] == 2 and stats['bytes'] == 200
+    assert stats['hits'] == 3 and stats['misses'] == 3 and stats['evictions'] == 2
+
+
+def test_expired_entries_are_dropped(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), max_age=0)
+    path = cache.store('a', write(str(tmp_path / 'a.txt'), b'text'))
+    time.sleep(0.01)
+    assert cache.lookup('a') is None
+    cache.evict()
+    assert not os.path.exists(path)
+
+
+def disk_bytes(directory):
+    """Bytes of .txt files under directory, counting hard-linked files once."""
+    inodes = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.txt'):
+                stat = os.stat(os.path.join(root, name))
+                inodes[stat.st_dev, stat.st_ino] = stat.st_size
+    return sum(inodes.values())
+
+
+def test_eviction_frees_downloads(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), max_bytes=2500)
+    downloads = tmp_path / 'downloads'
+    for i, key in enumerate('abcde'):
+        os.makedirs(downloads / key)
+        cache.store(key, write(str(downloads / key / 'book.txt'), key.encode() * 1000))
+        # A repeated upload gets a link to the cached output under another name
+        assert cache.link(key, str(downloads / key / 'again.txt'))
+        time.sleep(0.01)
+        assert disk_bytes(tmp_path) == min(i + 1, 2) * 1000
+    # Evicted books leave no download behind, not even their folder
+    assert sorted(os.listdir(downloads)) == ['d', 'e']
+    assert cache.stats()['bytes'] == 2000
+    assert not cache.link('a', str(downloads / 'a.txt'))
+
+    cache.remove('e')
+    assert os.listdir(downloads) == ['d'] and disk_bytes(tmp_path) == 1000
@@ -0,0 +1,145 @@
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import signal
+
+import pytest
+
+import postprocess
+from converter import Converter
+from corpus import synthetic_book
+
+BOOKS = [('epub', 'utf-8', ''), ('epub', 'gb18030', '.gz'), ('mobi', 'gb18030', ''), ('mobi', 'utf-8', '.gz'),
+         ('azw3', 'utf-8', '')]
+
+
+def write_book(tmp_path, kind, encoding, size=200 * 1024, chapters=12):
+    input_path = str(tmp_path / f'book.{kind}')
+    with open(input_path, 'wb') as f:
+        f.write(synthetic_book(kind, size, chapters=chapters, encoding=encoding))
+    return input_path
+
+
+def read_output(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        return f.read()
+
+
+def reference(tmp_path, input_path, suffix):
+    path = str(tmp_path / ('reference.txt' + suffix))
+    success, message = Converter().convert_file(input_path, path)
+    assert success, message
+    return read_output(path)
+
+
+def convert_and_die(input_path, output_path, kill_at):
+    """Child process: convert, SIGKILLing itself at output write or file rename number kill_at."""
+    count = [0]
+
+    def tick():
+        count[0] += 1
+        if count[0] == kill_at:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+    write, replace = postprocess.TextWriter.write, os.replace
+    postprocess.TextWriter.write = lambda self, text: (tick(), write(self, text))
+    # Checkpoints and the finished output are put in place by os.replace
+    os.replace = lambda src, dst: (tick(), replace(src, dst))
+    success, message = Converter(checkpoint_interval=0).convert_file(input_path, output_path)
+    os._exit(0 if success else 1)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+@pytest.mark.parametrize('kind, encoding, suffix', BOOKS)
+def test_resume_after_kill_at_random_points(tmp_path, kind, encoding, suffix):
+    input_path = write_book(tmp_path, kind, encoding)
+    expected = reference(tmp_path, input_path, suffix)
+    output_path = str(tmp_path / ('book.txt' + suffix))
+    rng = random.Random(f'{kind} {encoding} {suffix}')
+    context = multiprocessing.get_context('fork')
+
+    positions = []
+    for attempt in range(200):
+        process = context.Process(target=convert_and_die, args=(input_path, output_path, rng.randint(1, 20)))
+        process.start()
+        process.join()
+        if process.exitcode == 0:
+            break
+        assert process.exitcode == -signal.SIGKILL
+        if os.path.exists(output_path + '.checkpoint'):
+            with open(output_path + '.checkpoint', encoding='utf-8') as f:
+                state = json.load(f)['state']
+            positions.append(state.get('chapters', state.get('chunks')))
+    else:
+        pytest.fail("conversion never finished")
+
+    assert read_output(output_path) == expected
+    assert not os.path.exists(output_path + '.part') and not os.path.exists(output_path + '.checkpoint')
+    # Killed runs left checkpoints behind and later runs carried on from them
+    assert attempt >= 1 and positions and positions == sorted(positions) and positions[-1] > 0
+
+
+@pytest.mark.parametrize('kind, workers', [('epub', 1), ('epub', 2), ('mobi', 1), ('azw3', 1)])
+def test_stop_and_resume(tmp_path, kind, workers):
+    input_path = write_book(tmp_path, kind, 'utf-8')
+    expected = reference(tmp_path, input_path, '')
+    output_path = str(tmp_path / 'book.txt')
+
+    converter = Converter(workers=workers, checkpoint_interval=3600)
+    calls = []
+
+    def stop_halfway(progress, message):
+        calls.append(progress)
+        if len(calls) == 6:
+            converter.stop()
+
+    success, message = converter.convert_file(input_path, output_path, stop_halfway)
+    assert not success and message == "用户已停止"
+    # Stopping saves a checkpoint even though the interval has not passed
+    assert not os.path.exists(output_path)
+    assert os.path.exists(output_path + '.part') and os.path.exists(output_path + '.checkpoint')
+
+    progress = []
+    converter = Converter(workers=workers)
+    success, message = converter.convert_file(input_path, output_path, lambda p, m: progress.append(p))
+    assert success, message
+    assert read_output(output_path) == expected
+    assert not os.path.exists(output_path + '.part') and not os.path.exists(output_path + '.checkpoint')
+    # The resumed run reports progress only for what was left (10 is the MOBI reader's opening message)
+    assert progress[-1] == 100 and min(p for p in progress if p != 10) > calls[-1]
+
+
+@pytest.mark.parametrize('kind', ['epub', 'mobi'])
+def test_cancel_discards_checkpoint(tmp_path, kind):
+    input_path = write_book(tmp_path, kind, 'utf-8')
+    output_path = str(tmp_path / 'book.txt')
+    converter = Converter(checkpoint_interval=0)
+
+    def cancel_halfway(progress, message):
+        if progress > 20:
+            converter.stop(keep_checkpoint=False)
+
+    success, message = converter.convert_file(input_path, output_path, cancel_halfway)
+    assert not success and message == "用户已停止"
+    assert os.listdir(tmp_path) == [os.path.basename(input_path)]
+
+
+def test_stale_checkpoint_is_ignored(tmp_path):
+    input_path = write_book(tmp_path, 'mobi', 'utf-8')
+    output_path = str(tmp_path / 'book.txt')
+    converter = Converter()
+    converter.stop()
+    assert not converter.convert_file(input_path, output_path)[0]
+    assert os.path.exists(output_path + '.checkpoint')
+
+    # Other options produce other text: the checkpoint cannot be used
+    converter = Converter(normalize='width')
+    assert converter.convert_file(input_path, output_path)[0]
+    assert 'resumed' not in converter.timings.labels
+    fresh_path = str(tmp_path / 'fresh.txt')
+    assert Converter(normalize='width').convert_file(input_path, fresh_path)[0]
+    assert read_output(output_path) == read_output(fresh_path)
+    assert not os.path.exists(output_path + '.checkpoint')
@@ -0,0 +1,173 @@
+import gzip
+import os
+import tempfile
+import types
+
+import pytest
+
+import backends
+from converter import Converter, preview_file
+from corpus import (build_epub, build_kf8, build_mobi, synthetic_book, synthetic_chapters,
+                    write_temp_book)
+from epub_reader import EpubReader
+
+
+def test_convert_mobi_streams_builtin_reader():
+    html = '<html><head><style>p {color: red}</style></head><body>' + \
+        '<p>第一章 &amp; 开始</p><script>var x = 1;</script>' * 2000 + '</body></html>'
+    input_path, output_path = write_temp_book(build_mobi(html), '.mobi')
+
+    progress = []
+    success, msg = Converter()._convert_mobi_builtin(input_path, output_path, lambda p, m: progress.append(p))
+
+    assert success, msg
+    with open(output_path, encoding='utf-8') as f:
+        text = f.read()
+    assert text.count('第一章 & 开始') == 2000
+    assert 'color' not in text and 'var x' not in text
+    assert progress[-1] == 100
+
+
+def test_convert_epub_follows_spine_and_skips_images(monkeypatch):
+    chapters = [(f'第{n}章', [f'第{n}章 正文 {i}' for i in range(3)]) for n in range(1, 6)]
+    input_path, output_path = write_temp_book(build_epub(chapters, images=3), '.epub')
+
+    opened = []
+    original_open = EpubReader.open
+    monkeypatch.setattr(EpubReader, 'open', lambda self, name: opened.append(name) or original_open(self, name))
+    progress = []
+    success, msg = Converter().convert_file(input_path, output_path, lambda p, m: progress.append(p))
+
+    assert success, msg
+    with open(output_path, encoding='utf-8') as f:
+        text = f.read()
+    positions = [text.index(f'第{n}章 正文 0') for n in range(1, 6)]
+    assert positions == sorted(positions)
+    assert opened == [f'OEBPS/Text/chapter{n:04d}.xhtml' for n in range(5)]
+    assert progress[-1] == 100
+
+
+def test_convert_epub_stops_between_chapters():
+    chapters = [(f'Chapter {n}', ['text']) for n in range(3)]
+    input_path, output_path = write_temp_book(build_epub(chapters), '.epub')
+    converter = Converter()
+
+    def stop_after_first(progress, message):
+        converter.stop()
+
+    success, msg = converter.convert_file(input_path, output_path, stop_after_first)
+    assert not success and msg == "用户已停止"
+
+
+def test_parallel_epub_matches_serial():
+    chapters = [(f'Chapter {n}', [f'Paragraph {n}.{i} ' * 20 for i in range(30)]) for n in range(12)]
+    input_path, output_path = write_temp_book(build_epub(chapters), '.epub')
+
+    outputs = []
+    for workers in (1, 2):
+        progress = []
+        success, msg = Converter(workers=workers).convert_file(input_path, output_path, lambda p, m: progress.append(p))
+        assert success, msg
+        assert len(progress) == len(chapters) and progress[-1] == 100
+        with open(output_path, encoding='utf-8') as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize('kind', ['epub', 'mobi'])
+@pytest.mark.parametrize('encoding', ['utf-8', 'gb18030', 'cp1252'])
+def test_synthetic_corpus_converts(kind, encoding):
+    chapters = synthetic_chapters(64 * 1024, 4, encoding)
+    input_path, output_path = write_temp_book(synthetic_book(kind, 64 * 1024, 4, encoding), '.' + kind)
+
+    success, msg = Converter().convert_file(input_path, output_path)
+
+    assert success, msg
+    with open(output_path, encoding='utf-8') as f:
+        text = f.read()
+    for title, paragraphs in chapters:
+        assert title in text and paragraphs[-1] in text
+
+
+@pytest.mark.parametrize('kind', ['epub', 'mobi'])
+def test_preview_returns_start_of_book(kind):
+    chapters = synthetic_chapters(256 * 1024, 8, 'utf-8')
+    input_path, output_path = write_temp_book(synthetic_book(kind, 256 * 1024, 8, 'utf-8'), '.' + kind)
+    success, msg = Converter().convert_file(input_path, output_path)
+    assert success, msg
+    with open(output_path, encoding='utf-8') as f:
+        text = f.read()
+
+    preview = preview_file(input_path, 500)
+    assert preview['truncated'] and len(preview['text']) == 500
+    assert preview['text'] == text[:500]
+    assert chapters[0][0] in preview['text']
+
+    whole = preview_file(input_path, len(text) * 2)
+    assert whole['text'] == text and not whole['truncated']
+
+
+def test_convert_azw3_with_builtin_reader():
+    files = [f'<html><head><title></title></head><body><h2>Chapter {n}</h2><p>Text of chapter {n}.</p></body></html>'
+             for n in range(3)]
+    input_path, output_path = write_temp_book(build_kf8(files), '.azw3')
+
+    success, msg = Converter().convert_file(input_path, output_path)
+
+    assert success, msg
+    with open(output_path, encoding='utf-8') as f:
+        text = f.read()
+    assert text.index('Chapter 0') < text.index('Text of chapter 0.') < text.index('Chapter 1')
+    assert 'margin' not in text
+
+
+def test_mobi_library_is_only_a_cleaned_up_fallback(monkeypatch):
+    calls = []
+
+    def extract(path):
+        temp_dir = tempfile.mkdtemp()
+        html_path = os.path.join(temp_dir, 'book.html')
+        with open(html_path, 'w', encoding='utf-8') as f:
+            f.write('<p>From the library</p>')
+        calls.append(temp_dir)
+        return temp_dir, html_path
+
+    get = backends.get
+    monkeypatch.setattr(backends, 'get', lambda name: types.SimpleNamespace(extract=extract) if name == 'mobi' else get(name))
+
+    input_path, output_path = write_temp_book(build_mobi('<p>Built in</p>'), '.mobi')
+    assert Converter().convert_file(input_path, output_path)[0]
+    assert not calls
+
+    input_path, output_path = write_temp_book(b'BOOKMOBI' * 20, '.mobi')
+    success, msg = Converter().convert_file(input_path, output_path)
+    assert success, msg
+    with open(output_path, encoding='utf-8') as f:
+        assert f.read() == 'From the library'
+    assert len(calls) == 1 and not os.path.exists(calls[0])
+
+
+def test_convert_to_gzip_output():
+    input_path, output_path = write_temp_book(build_epub([('Chapter 1', ['Compressed text'])]), '.epub')
+
+    success, msg = Converter().convert_file(input_path, output_path + '.gz')
+
+    assert success, msg
+    assert not os.path.exists(output_path)
+    with gzip.open(output_path + '.gz', 'rt', encoding='utf-8') as f:
+        assert 'Compressed text' in f.read()
+
+
+def test_output_is_cleaned_up_and_normalized():
+    html = '<p>\n  Ｃｈａｐｔｅｒ　１\n</p><p>&nbsp;</p><p>　</p><p>天下\n  <b>大势</b>，分久必合。</p>'
+    input_path, output_path = write_temp_book(build_mobi(html * 50), '.mobi')
+
+    converter = Converter(normalize='width')
+    success, msg = converter.convert_file(input_path, output_path)
+
+    assert success, msg
+    with open(output_path, encoding='utf-8') as f:
+        text = f.read()
+    assert text == '\n\n'.join(['Chapter　1\n\n天下大势，分久必合。'] * 50)
+    if converter.timings.enabled:
+        assert 'postprocess' in converter.timings.stages
@@ -0,0 +1,66 @@
+import glob
+import os
+
+import pytest
+
+from html_text import HTMLTextExtractor, html_to_text
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'html_text')
+GOLDEN_FILES = sorted(glob.glob(os.path.join(GOLDEN_DIR, '*.html')))
+
+
+def read_golden(html_path):
+    with open(html_path, 'rb') as f:
+        html = f.read()
+    with open(os.path.splitext(html_path)[0] + '.txt', encoding='utf-8', newline='') as f:
+        expected = f.read()
+    return html, expected
+
+
+@pytest.mark.parametrize('html_path', GOLDEN_FILES, ids=os.path.basename)
+def test_golden_output(html_path):
+    html, expected = read_golden(html_path)
+    assert html_to_text(html) == expected
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 4096])
+@pytest.mark.parametrize('html_path', GOLDEN_FILES, ids=os.path.basename)
+def test_chunked_input_matches_whole_document(html_path, chunk_size):
+    html, expected = read_golden(html_path)
+    text = html.decode('utf-8')
+    extractor = HTMLTextExtractor()
+    output = [extractor.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    output.append(extractor.close())
+    assert ''.join(output) == expected
+
+
+@pytest.mark.parametrize('html_path', GOLDEN_FILES, ids=os.path.basename)
+def test_same_text_as_beautifulsoup(html_path):
+    # Only whitespace differs: BeautifulSoup puts a separator around every text node
+    bs4 = pytest.importorskip('bs4')
+    html, expected = read_golden(html_path)
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    for tag in soup(['script', 'style']):
+        tag.decompose()
+    assert ''.join(expected.split()) == ''.join(soup.get_text(separator='\n\n').split())
+
+
+def test_iter_html_text_decodes_declared_encoding_across_chunks():
+    import io
+    from corpus import build_chapter
+    from html_text import iter_html_text
+
+    paragraphs = ['滚滚长江东逝水，浪花淘尽英雄。'] * 20
+    for encoding in ('utf-8', 'gb18030'):
+        stream = io.BytesIO(build_chapter('第一回', paragraphs, encoding))
+        text = ''.join(iter_html_text(stream, chunk_size=5))
+        assert text == '\n\n'.join(['第一回'] + paragraphs)
+
+
+def test_unclosed_markup_is_refused(monkeypatch):
+    import html_text
+    monkeypatch.setattr(html_text, 'MAX_PENDING_MARKUP', 1000)
+    extractor = HTMLTextExtractor()
+    assert extractor.feed('<p>text</p><!-- ' + 'x' * 900) == 'text'
+    with pytest.raises(ValueError):
+        extractor.feed('x' * 200)
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from converter import Converter
+from corpus import synthetic_book
+from jobs import CANCELLED, DONE, PAUSED, ConversionPool, JobQueue, QueueFullError
+
+
+class SlowConverter(Converter):
+    """Reports progress until release is set, honouring pause/stop like the real converter."""
+    release = threading.Event()
+
+    def convert_file(self, input_path, output_path=None, update_callback=None):
+        step = 0
+        while not self.release.wait(0.01):
+            if self._wait_if_paused():
+                return False, "用户已停止"
+            step += 1
+            update_callback(min(step, 99), f"step {step}")
+        return True, "成功"
+
+
+def wait_for(job, predicate, timeout=5):
+    deadline = time.time() + timeout
+    version = job.version
+    while not predicate(job):
+        assert time.time() < deadline, job.to_dict()
+        version = job.wait_for_change(version, 0.1)
+
+
+def test_queue_admission_pause_resume_cancel():
+    SlowConverter.release.clear()
+    jobs = JobQueue(workers=1, max_pending=1, converter_factory=SlowConverter)
+    running = jobs.submit('a.epub', 'a.txt', 'a.txt')
+    wait_for(running, lambda job: job.progress > 0)
+    queued = jobs.submit('b.epub', 'b.txt', 'b.txt')
+
+    # One job running and one waiting: the queue is full
+    with pytest.raises(QueueFullError):
+        jobs.submit('c.epub', 'c.txt', 'c.txt')
+
+    assert running.pause() and running.status == PAUSED
+    paused_at = running.progress
+    assert running.wait_for_change(running.version, 0.2) == running.version
+    assert running.progress == paused_at
+    assert running.resume()
+    wait_for(running, lambda job: job.progress > paused_at)
+
+    # Cancelling a job that has not started finishes it immediately
+    assert queued.cancel() and queued.status == CANCELLED
+    assert not queued.resume()
+    assert queued.future.result(5) == (False, '已取消', None)
+
+    SlowConverter.release.set()
+    wait_for(running, lambda job: job.finished)
+    assert running.status == DONE and running.progress == 100
+    assert running.future.result(5) == (True, '成功', None)
+    assert jobs.get(running.id) is running
+
+
+def test_cancel_running_job():
+    SlowConverter.release.clear()
+    jobs = JobQueue(workers=1, converter_factory=SlowConverter)
+    job = jobs.submit('a.epub', 'a.txt', 'a.txt')
+    wait_for(job, lambda job: job.progress > 0)
+    assert job.pause() and job.cancel()
+    wait_for(job, lambda job: job.finished)
+    assert job.status == CANCELLED
+    # Unlike a pause, a cancelled job keeps no checkpoint to resume from
+    assert not job.converter.keep_checkpoint
+
+
+def test_conversion_pool_admission(tmp_path):
+    input_path = str(tmp_path / 'book.epub')
+    with open(input_path, 'wb') as f:
+        f.write(synthetic_book('epub', 16 * 1024, chapters=2))
+    pool = ConversionPool(workers=1, max_pending=2)
+    try:
+        pool.reserve(2)
+        with pytest.raises(QueueFullError):
+            pool.reserve(1)
+        # One slot was not needed after all
+        pool.release(1)
+        future = pool.submit(input_path, str(tmp_path / 'book.txt'))
+        with pytest.raises(QueueFullError):
+            pool.reserve(2)
+        assert future.result()[0]
+    finally:
+        pool.shutdown()
+    # The finished conversion gave its slot back
+    assert pool.stats()['pending'] == 0
+    pool.reserve(2)
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from loadtest import compare, main, parse_mix, percentile, summarize
+
+
+def test_percentile_and_mix():
+    values = list(range(1, 101))
+    assert [percentile(values, p) for p in (50, 95, 99, 100)] == [50, 95, 99, 100]
+    assert percentile([3.0], 99) == 3.0 and percentile([], 50) is None
+    assert parse_mix('upload=2,download') == {'upload': 2.0, 'download': 1.0}
+    with pytest.raises(ValueError):
+        parse_mix('upload=1,delete=1')
+
+
+def test_summarize_counts_errors_and_rejections():
+    samples = [{'kind': 'upload', 'latency': 0.01 * i, 'status': 202, 'bytes': 1024 * 1024, 'error': None}
+               for i in range(1, 9)]
+    samples.append({'kind': 'upload', 'latency': 0.5, 'status': 429, 'bytes': 0, 'error': None})
+    samples.append({'kind': 'upload', 'latency': 0.5, 'status': None, 'bytes': 0, 'error': 'timeout'})
+    result = summarize(samples, elapsed=2.0)['upload']
+    assert result['count'] == 10 and result['ok'] == 8 and result['per_s'] == 4.0
+    assert result['error_rate'] == 0.1 and result['rejected_rate'] == 0.1
+    assert result['p50_ms'] == 40.0 and result['p99_ms'] == 80.0
+    assert result['statuses'] == {'202': 8, '429': 1, 'error': 1} and result['errors'] == ['timeout']
+
+
+def test_compare_flags_regressions(capsys):
+    baseline = {'upload': {'per_s': 10.0, 'p95_ms': 100.0, 'error_rate': 0.0},
+                'download': {'per_s': 10.0, 'p95_ms': 100.0, 'error_rate': 0.0}}
+    results = {'upload': {'per_s': 9.5, 'p95_ms': 150.0, 'error_rate': 0.0},
+               'download': {'per_s': 10.5, 'p95_ms': 90.0, 'error_rate': 0.0},
+               'download_batch': {'per_s': 1.0, 'p95_ms': 10.0, 'error_rate': 0.0}}
+    assert compare(results, baseline) == ['upload']
+    assert 'REGRESSION: slower p95' in capsys.readouterr().out
+
+
+def test_short_run_against_threaded_server(tmp_path, capsys):
+    path = str(tmp_path / 'results.json')
+    assert main(['--duration', '1', '--concurrency', '2', '--book-mb', '0.05', '--books', '2',
+                 '--sample', '0.2', '--json', path]) == 0
+    with open(path, encoding='utf-8') as f:
+        saved = json.load(f)
+    results = saved['results']
+    assert {'upload', 'convert', 'download', 'download_batch'} >= set(results) >= {'upload', 'convert'}
+    assert all(result['error_rate'] == 0 for result in results.values())
+    assert results['upload']['p50_ms'] <= results['upload']['p99_ms']
+    assert saved['config']['server'] == 'threaded'
+    assert 'p95 ms' in capsys.readouterr().out
@@ -0,0 +1,55 @@
+import json
+import logging
+
+import metrics
+from converter import Converter
+from corpus import synthetic_book, write_temp_book
+from mobi_reader import MobiReader
+
+
+def test_converter_records_stages(monkeypatch):
+    monkeypatch.setattr(metrics, 'enabled', True)
+    input_path, output_path = write_temp_book(synthetic_book('mobi', 256 * 1024, 4, 'gb18030'), '.mobi')
+    converter = Converter()
+    assert converter.convert_file(input_path, output_path)[0]
+
+    record = converter.timings.to_dict()
+    assert record['format'] == 'mobi' and record['status'] == 'success' and record['path'] == 'builtin'
+    assert {'read', 'decompress', 'detect_encoding', 'decode', 'html_to_text', 'write'} <= set(record['stages'])
+    assert record['bytes_in'] > 0 and record['bytes_out'] > 0
+    assert sum(record['stages'].values()) <= record['seconds']
+    assert record['rss'] > 0 and record['rss_delta'] is not None and 'peak_rss' not in record
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, 'enabled', False)
+    input_path, output_path = write_temp_book(synthetic_book('epub', 64 * 1024, 4), '.epub')
+    converter = Converter()
+    assert converter.convert_file(input_path, output_path)[0]
+    assert converter.timings is metrics.NULL_TIMINGS and converter.timings.to_dict() is None
+    assert MobiReader(input_path).timings.labels == {}
+
+
+def test_observe_conversion_renders_prometheus_text(caplog):
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test counter', ('format', 'status'))
+    histogram = registry.histogram('test_seconds', 'Test histogram', ('stage',), buckets=(0.1, 1))
+    counter.inc(format='mobi', status='success')
+    counter.inc(2, format='mobi', status='success')
+    histogram.observe(0.5, stage='decode')
+    registry.collectors.append(lambda: [('test_gauge', 'gauge', 'Test gauge', 7)])
+    text = registry.render()
+    assert 'test_total{format="mobi",status="success"} 3' in text
+    assert 'test_seconds_bucket{stage="decode",le="0.1"} 0' in text
+    assert 'test_seconds_bucket{stage="decode",le="1"} 1' in text
+    assert 'test_seconds_bucket{stage="decode",le="+Inf"} 1' in text
+    assert 'test_gauge 7' in text
+
+    timings = metrics.Timings(format='epub', path='epub')
+    timings.add('write', 0.25)
+    timings.finish(status='success')
+    with caplog.at_level(logging.INFO, logger='ebook.metrics'):
+        metrics.observe_conversion(timings.to_dict(), job_id='abc')
+    line = json.loads(caplog.records[-1].getMessage())
+    assert line['event'] == 'conversion' and line['job'] == 'abc' and line['stages'] == {'write': 0.25}
+    assert 'ebook_conversions_total{format="epub",status="success",path="epub"}' in metrics.registry.render()
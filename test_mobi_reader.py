@@ -0,0 +1,284 @@
+import os
+import random
+import struct
+import tempfile
+
+import pytest
+
+from corpus import build_kf8, build_mobi, compress_palmdoc, reference_decompress_palmdoc, split_records
+from mobi_reader import MobiReader, decompress_palmdoc
+
+SAMPLE_EN = ("It was the best of times, it was the worst of times, it was the age of wisdom, "
+             "it was the age of foolishness... <p>Chapter\tOne</p>\n") * 200
+SAMPLE_ZH = "第一章 天下大势，分久必合，合久必分。周末七国分争，并入于秦。\n" * 300
+
+
+def write_temp_mobi(text, **kwargs):
+    fd, path = tempfile.mkstemp(suffix='.mobi')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(build_mobi(text, **kwargs))
+    return path
+
+
+def test_palmdoc_matches_reference_on_generated_records():
+    for text, encoding in ((SAMPLE_EN, 'utf-8'), (SAMPLE_ZH, 'utf-8'), (SAMPLE_ZH, 'gb18030')):
+        for chunk in split_records(text.encode(encoding)):
+            record = compress_palmdoc(chunk)
+            expected = reference_decompress_palmdoc(record)
+            assert bytes(expected) == chunk
+            assert decompress_palmdoc(record) == expected
+
+
+def test_palmdoc_matches_reference_on_random_records():
+    rng = random.Random(1234)
+    for _ in range(300):
+        record = bytes(rng.randrange(256) for _ in range(rng.randrange(1, 600)))
+        try:
+            expected = reference_decompress_palmdoc(record)
+        except IndexError:
+            # The original reader crashes on a zero-distance pair at the start
+            continue
+        assert decompress_palmdoc(record) == expected
+
+
+def test_palmdoc_overlapping_copy_and_space_pairs():
+    # 'ab' followed by a pair with distance 2 and length 10 repeats the run
+    record = b'ab' + (0x8000 | (2 << 3) | 7).to_bytes(2, 'big') + b'\xc1'
+    assert decompress_palmdoc(record) == b'ab' + b'ab' * 5 + b' A'
+
+
+def test_palmdoc_output_is_capped_at_record_size():
+    record = compress_palmdoc(b'x' * 100) + b'\x01\x02'
+    assert len(decompress_palmdoc(record, max_size=100)) == 100
+
+
+def test_extract_text_roundtrip():
+    path = write_temp_mobi(SAMPLE_ZH)
+    try:
+        assert MobiReader(path).extract_text() == SAMPLE_ZH
+    finally:
+        os.remove(path)
+
+
+def test_iter_text_decodes_characters_split_across_records():
+    for encoding in ('utf-8', 'gb18030'):
+        # 3-byte UTF-8 and 2-byte GB18030 characters straddle the 4096-byte record boundaries
+        text = 'a' + SAMPLE_ZH
+        path = write_temp_mobi(text, encoding=encoding)
+        try:
+            reader = MobiReader(path)
+            chunks = list(reader.iter_text())
+            assert len(chunks) == reader.record_count > 1
+            assert ''.join(chunks) == text
+        finally:
+            os.remove(path)
+
+
+def test_parallel_records_match_serial():
+    text = (SAMPLE_ZH + SAMPLE_EN) * 3
+    path = write_temp_mobi(text)
+    try:
+        reader = MobiReader(path, workers=2, parallel_threshold=2)
+        assert ''.join(reader.iter_text()) == text
+        assert reader.extract_text() == text
+    finally:
+        os.remove(path)
+
+
+def test_huffcdic_roundtrip():
+    for text, encoding in ((SAMPLE_EN, 'utf-8'), (SAMPLE_ZH, 'gb18030')):
+        path = write_temp_mobi(text, encoding=encoding, compression=17480, trailing_entries=True)
+        try:
+            reader = MobiReader(path)
+            assert reader.extract_text() == text
+            assert reader.compression == 17480
+            # The decoder and its phrase cache are built once per reader
+            decoder = reader._huff_decoder
+            assert ''.join(reader.iter_text()) == text
+            assert reader._huff_decoder is decoder
+        finally:
+            os.remove(path)
+
+
+def test_trailing_entries_are_stripped():
+    path = write_temp_mobi(SAMPLE_ZH, trailing_entries=True)
+    try:
+        assert MobiReader(path).extract_text() == SAMPLE_ZH
+        assert ''.join(MobiReader(path, workers=2, parallel_threshold=2).iter_text()) == SAMPLE_ZH
+    finally:
+        os.remove(path)
+
+
+def test_encoding_detection_reports_choice_and_reason():
+    western = "Café crème, naïve façade — déjà vu.\n" * 300
+    cases = [
+        (SAMPLE_ZH, 'utf-8', None, 'utf-8', 'header'),
+        (SAMPLE_ZH, 'gb18030', None, 'gb18030', 'sample'),
+        (SAMPLE_ZH, 'gb18030', 1252, 'gb18030', 'mislabeled'),
+        (SAMPLE_ZH, 'utf-8', 1252, 'utf-8', 'mislabeled'),
+        (western, 'cp1252', None, 'cp1252', 'header'),
+    ]
+    for text, encoding, code_page, expected, reason in cases:
+        path = write_temp_mobi(text, encoding=encoding, code_page=code_page)
+        try:
+            reader = MobiReader(path)
+            assert reader.extract_text() == text
+            assert (reader.encoding, reader.encoding_reason) == (expected, reason)
+        finally:
+            os.remove(path)
+
+
+def test_range_reads_match_full_text():
+    text = SAMPLE_EN + SAMPLE_ZH
+    raw = text.encode('utf-8')
+    path = write_temp_mobi(text)
+    try:
+        reader = MobiReader(path)
+        for start, end in ((0, 10), (4090, 4200), (5000, 13000), (len(raw) - 50, None), (len(raw), None)):
+            assert reader.read_bytes(start, end) == raw[start:end]
+        assert reader.read_text(0, 100) == text[:100]
+        assert reader.read_chars(len(SAMPLE_EN), 30) == SAMPLE_ZH[:30]
+        assert reader.read_chars(10) == text[10:]
+    finally:
+        os.remove(path)
+
+
+
+def test_range_reads_resync_gb18030():
+    text = (SAMPLE_ZH + '\n') * 20
+    path = write_temp_mobi(text, encoding='gb18030')
+
+    def within(start, end):
+        # The characters whose bytes all lie in [start, end)
+        chars, position = [], 0
+        for char in text:
+            size = len(char.encode('gb18030'))
+            if position >= start and position + size <= end:
+                chars.append(char)
+            position += size
+        return ''.join(chars)
+
+    try:
+        reader = MobiReader(path)
+        raw = text.encode('gb18030')
+        # Offsets inside a run of two-byte characters, where a trail byte pairs with the next lead byte
+        starts = [raw.index('分久必合'.encode('gb18030'), offset) + 1 for offset in (0, 4000, 9000)]
+        for start in starts:
+            assert reader.read_text(start, start + 300, 'gb18030') == within(start, start + 300)
+        assert reader.read_text(starts[-1], None, 'gb18030') == within(starts[-1], len(raw))
+    finally:
+        os.remove(path)
+
+
+def test_range_reads_index_uneven_records(monkeypatch):
+    import corpus
+
+    def uneven(data, record_size=4096):
+        # Alternate full and short records, as some converters write them
+        records, i = [], 0
+        while i < len(data):
+            size = record_size if len(records) % 2 == 0 else 1000
+            records.append(data[i:i + size])
+            i += size
+        return records
+
+    monkeypatch.setattr(corpus, 'split_records', uneven)
+    raw = SAMPLE_EN.encode('utf-8')
+    path = write_temp_mobi(raw, compression=1)
+    try:
+        reader = MobiReader(path)
+        assert reader.read_bytes(5000, 9000) == raw[5000:9000]
+        assert reader._record_starts[:3] == [0, 4096, 5096]
+        assert reader.read_bytes(len(raw) - 10) == raw[-10:]
+    finally:
+        os.remove(path)
+
+
+def kf8_files(count=4):
+    return [f'<?xml version="1.0"?><html><head><title></title></head><body><h2>第{n}章</h2>' +
+            ''.join(f'<p>段落 {n}.{i} {SAMPLE_ZH[:20]}</p>' for i in range(300)) + '</body></html>'
+            for n in range(count)]
+
+
+def write_temp_kf8(files, **kwargs):
+    fd, path = tempfile.mkstemp(suffix='.azw3')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(build_kf8(files, **kwargs))
+    return path
+
+
+def test_kf8_files_are_rebuilt_from_skeletons_and_fragments():
+    files = kf8_files()
+    for kwargs in ({}, {'compression': 1}, {'mobi6_text': '<p>MOBI 6 copy</p>'}):
+        path = write_temp_kf8(files, **kwargs)
+        try:
+            reader = MobiReader(path)
+            assert list(reader.iter_text()) == files
+            assert reader.kf8 and reader.chunk_count == len(files)
+            # The CSS flow is not part of the text
+            assert reader.extract_text() == ''.join(files)
+            assert reader.read_chars(0, 30) == files[0][:30]
+        finally:
+            os.remove(path)
+
+
+def test_combined_book_can_use_mobi6_copy():
+    path = write_temp_kf8(kf8_files(2), mobi6_text='<p>MOBI 6 copy</p>')
+    try:
+        reader = MobiReader(path, prefer_kf8=False)
+        assert reader.extract_text() == '<p>MOBI 6 copy</p>'
+        assert not reader.kf8 and reader.base == 0
+    finally:
+        os.remove(path)
+
+
+def test_kf8_without_indexes_reads_the_xhtml_flow(monkeypatch):
+    import kf8
+    files = kf8_files(2)
+
+    def broken_index(read_record, first):
+        raise ValueError("Invalid INDX record")
+
+    monkeypatch.setattr(kf8, 'read_index', broken_index)
+    path = write_temp_kf8(files, css='p { color: red }')
+    try:
+        text = MobiReader(path).extract_text()
+        # Stored skeleton-first, so the markup is out of order, but all the text is there
+        assert 'color: red' not in text
+        assert sorted(text) == sorted(''.join(files))
+    finally:
+        os.remove(path)
+
+
+def test_huffcdic_phrase_bomb_is_refused():
+    from corpus import _pack_codes, compress_huffcdic
+    from huffcdic import HuffCdicDecoder
+
+    decoder = HuffCdicDecoder(*compress_huffcdic([b'ab'])[:2])
+    max_code = len(decoder.dictionary) - 1
+    code_length = max(9, max_code.bit_length())
+
+    def encode(indexes):
+        return _pack_codes([max_code - index for index in indexes], code_length)
+
+    # Each phrase is the one before twice over: one code of phrase 30 is 1 GB of text
+    decoder.dictionary[1] = (b'x', True)
+    for index in range(2, 31):
+        decoder.dictionary[index] = (encode([index - 1, index - 1]), False)
+    assert decoder.decompress(encode([5]), 4096) == b'x' * 16
+    with pytest.raises(ValueError):
+        decoder.decompress(encode([30]), 4096)
+
+
+def test_text_past_declared_length_is_refused():
+    data = bytearray(build_mobi(SAMPLE_EN))
+    record0 = struct.unpack_from('>L', data, 78)[0]
+    struct.pack_into('>L', data, record0 + 4, 1000)
+    fd, path = tempfile.mkstemp(suffix='.mobi')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    try:
+        with pytest.raises(ValueError):
+            MobiReader(path).extract_text()
+    finally:
+        os.remove(path)
@@ -0,0 +1,43 @@
+import gzip
+import os
+
+import pytest
+
+import backends
+import outputs
+
+
+def test_parse_compression():
+    assert outputs.parse_compression(None) is None
+    assert outputs.parse_compression('none') is None
+    assert outputs.parse_compression('GZIP') == 'gzip'
+    assert outputs.parse_compression('zst') == 'zstd'
+    with pytest.raises(ValueError):
+        outputs.parse_compression('brotli')
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'zstd'])
+def test_round_trip_and_lookup(tmp_path, compression):
+    if compression == 'zstd' and not backends.available('zstandard'):
+        pytest.skip('zstandard is not installed')
+    text = '第一章 天下大势，分久必合。\n' * 5000
+    logical = str(tmp_path / 'book.txt')
+    path = outputs.stored_path(logical, compression)
+    with outputs.open_text(path, compression) as f:
+        f.write(text)
+
+    assert outputs.compression_of(path) == compression
+    assert outputs.find_output(logical) == (path, compression)
+    with outputs.open_plain(path, compression) as f:
+        assert f.read().decode('utf-8') == text
+    if compression:
+        assert os.path.getsize(path) < len(text.encode('utf-8')) // 3
+    if compression != 'zstd':
+        assert outputs.plain_size(path, compression) == len(text.encode('utf-8'))
+
+
+def test_missing_output(tmp_path):
+    assert outputs.find_output(str(tmp_path / 'missing.txt')) is None
+    with gzip.open(tmp_path / 'only.txt.gz', 'wb') as f:
+        f.write(b'x')
+    assert outputs.find_output(str(tmp_path / 'only.txt'))[1] == 'gzip'
@@ -0,0 +1,59 @@
+import random
+import unicodedata
+
+import pytest
+
+import postprocess
+from postprocess import build_pipeline, clean_text
+
+SAMPLE = (
+    '\n\n　　第一章  \n\n\n\xa0\n　\n天下大势，分久必合。　\n\n\n\n'
+    '--------------------\n\n\n'
+    'Ｃｈａｐｔｅｒ　１２，ｐａｒｔ Ａ\ncafé é́ 각 が\n \n'
+)
+
+
+def test_parse_normalize():
+    assert postprocess.parse_normalize(None) == ()
+    assert postprocess.parse_normalize('none') == ()
+    assert postprocess.parse_normalize('NFC, width') == ('width', 'nfc')
+    assert postprocess.parse_normalize(['nfc']) == ('nfc',)
+    with pytest.raises(ValueError):
+        postprocess.parse_normalize('nfkc')
+
+
+def test_blank_lines_and_trailing_whitespace():
+    assert clean_text(SAMPLE).split('\n')[:7] == [
+        '　　第一章', '', '天下大势，分久必合。', '', '--------------------', '', 'Ｃｈａｐｔｅｒ　１２，ｐａｒｔ Ａ',
+    ]
+    assert clean_text('a\nb\n\nc') == 'a\nb\n\nc'
+    assert clean_text(' \n\xa0\n') == ''
+
+
+def test_width_and_nfc():
+    text = clean_text(SAMPLE, ('width', 'nfc'))
+    assert 'Chapter　12，part A' in text
+    assert text.endswith(unicodedata.normalize('NFC', 'café é́ 각 が'))
+
+
+@pytest.mark.parametrize('normalize', [(), ('width', 'nfc')])
+def test_chunked_input_matches_whole_text(normalize):
+    expected = clean_text(SAMPLE, normalize)
+    rng = random.Random(0)
+    for _ in range(200):
+        pipeline = build_pipeline(normalize)
+        output, i = [], 0
+        while i < len(SAMPLE):
+            size = rng.randint(1, 6)
+            output.append(pipeline.feed(SAMPLE[i:i + size]))
+            i += size
+        output.append(pipeline.close())
+        assert ''.join(output) == expected
+
+
+def test_pipeline_holds_back_little():
+    # Only the trailing whitespace of the current line and the tail after the last starter wait
+    pipeline = build_pipeline(('width', 'nfc'))
+    line = '滚滚长江东逝水，浪花淘尽英雄。\n\n\n'
+    emitted = sum(len(pipeline.feed(line)) for _ in range(10000))
+    assert emitted >= (len(line) - 2) * 9999
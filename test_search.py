@@ -0,0 +1,62 @@
+import gzip
+
+from cache import ConversionCache
+from search import SearchIndex, iter_passages, match_expression, snippet, tokenize
+
+
+def test_tokenize_words_and_cjk_bigrams():
+    assert tokenize('天下大势，It was the BEST 2 times 天') == \
+        ['天下', '下大', '大势', 'it', 'was', 'the', 'best', '2', 'times', '天']
+    assert match_expression('天下大势 Best') == '"天下 下大 大势" "best"'
+    assert match_expression('天') == '"天"*'
+    assert match_expression(' ，。 ') is None
+
+
+def test_passages_split_at_line_breaks():
+    text = ''.join(f'第{i}段 ' + '字' * 40 + '\n' for i in range(200))
+    chunks = [text[i:i + 333] for i in range(0, len(text), 333)]
+    passages = list(iter_passages(chunks, size=200))
+    assert all(passage.endswith('字') and len(passage) < 400 for passage in passages)
+    assert '\n'.join(passages) + '\n' == text
+
+
+def test_snippet_highlights_query():
+    text, highlights = snippet('前言\n' + '无关内容。' * 50 + '\n滚滚长江东逝水，浪花淘尽英雄。', '长江 英雄', width=40)
+    assert text.startswith('…滚滚长江')
+    assert [text[a:b] for a, b in highlights] == ['长江', '英雄']
+
+
+def test_add_search_and_remove(tmp_path):
+    index = SearchIndex(str(tmp_path / 'search.db'))
+    index.add_book('k1', 'a/三国.txt', '三国', ['滚滚长江东逝水。\n' * 300, '天下大势，分久必合。\nThe best of times.'])
+    index.add_book('k2', 'b/tale.txt', 'tale', ['It was the best of times, the worst of times.\n' * 10])
+
+    assert [hit['key'] for hit in index.search('天下大势')] == ['k1']
+    assert [hit['key'] for hit in index.search('分')] == ['k1']
+    assert {hit['key'] for hit in index.search('BEST times')} == {'k1', 'k2'}
+    assert index.search('长江 worst') == []
+    assert index.search('天下大势')[0]['snippet'].startswith('…天下大势')
+
+    # Adding a key again replaces the book
+    index.add_book('k2', 'b/tale.txt', 'tale', ['Call me Ishmael.'])
+    assert index.search('worst') == [] and [hit['key'] for hit in index.search('ishmael')] == ['k2']
+
+    index.remove(['k1'])
+    assert index.search('天下') == [] and index.stats()['books'] == 1
+    index.merge()
+    index.optimize()
+    assert [hit['key'] for hit in index.search('ishmael')] == ['k2']
+
+
+def test_index_output_and_cache_eviction(tmp_path):
+    index = SearchIndex(str(tmp_path / 'search.db'))
+    output = tmp_path / 'book.txt.gz'
+    with gzip.open(output, 'wt', encoding='utf-8') as f:
+        f.write('压缩存储的输出也能检索。\n' * 100)
+    index.add_output('key', 'abc/book.txt', str(output))
+    assert index.search('检索')[0]['title'] == 'book'
+
+    cache = ConversionCache(str(tmp_path / 'cache'), on_remove=index.remove)
+    cache.store('key', str(output))
+    cache.remove('key')
+    assert index.search('检索') == []
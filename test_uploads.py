@@ -0,0 +1,87 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from corpus import build_epub, build_mobi
+from uploads import PrefixedStream, UploadError, UploadStore, matches_extension, sniff_format
+
+
+class DroppedStream(io.BytesIO):
+    """A request body whose connection drops after `limit` bytes."""
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.tell() >= self.limit:
+            raise ConnectionResetError('connection dropped')
+        return super().read(min(size, self.limit - self.tell()))
+
+
+def send(store, upload, data):
+    for index in range(upload.next_chunk, upload.chunk_count):
+        chunk = data[index * upload.chunk_size:(index + 1) * upload.chunk_size]
+        store.write_chunk(upload, index, io.BytesIO(chunk), len(chunk))
+
+
+def test_sniff_format():
+    assert sniff_format(build_epub([('Chapter', ['text'])])) == '.epub'
+    mobi = build_mobi('<p>text</p>')
+    assert sniff_format(mobi) == '.mobi'
+    assert matches_extension(mobi, '.AZW3') and not matches_extension(mobi, '.epub')
+    assert sniff_format(b'dummy content' * 10) is None
+    assert PrefixedStream(b'abc', io.BytesIO(b'def')).read(2) == b'ab'
+
+
+def test_resume_after_dropped_chunk_and_restart(tmp_path):
+    data = build_epub([('Chapter', [os.urandom(20000).hex()])])
+    store = UploadStore(str(tmp_path), max_size=10 ** 7, chunk_size=4096)
+    upload = store.create('book.epub', len(data))
+    assert upload.chunk_count > 3
+
+    store.write_chunk(upload, 0, io.BytesIO(data[:4096]), 4096)
+    with pytest.raises(ConnectionResetError):
+        store.write_chunk(upload, 1, DroppedStream(data[4096:8192], 1000), 4096)
+    assert upload.received == 4096 and os.path.getsize(upload.data_path) == 4096
+    with pytest.raises(UploadError) as error:
+        store.write_chunk(upload, 2, io.BytesIO(data[8192:12288]), 4096)
+    assert error.value.status == 409
+    # A repeated chunk is acknowledged without being written twice
+    store.write_chunk(upload, 0, io.BytesIO(data[:4096]), 4096)
+    store.write_chunk(upload, 1, io.BytesIO(data[4096:8192]), 4096)
+
+    # A new store (a restarted server) picks the upload up from disk
+    store = UploadStore(str(tmp_path), max_size=10 ** 7, chunk_size=4096)
+    upload = store.get(upload.id)
+    assert upload.next_chunk == 2
+    send(store, upload, data)
+    with pytest.raises(UploadError):
+        store.get('0' * 32)
+
+    path, digest = store.finish(upload)
+    assert digest == hashlib.sha256(data).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(upload.state_path)
+
+
+def test_rejects_wrong_content_and_sizes(tmp_path):
+    store = UploadStore(str(tmp_path), max_size=1000, chunk_size=100)
+    with pytest.raises(UploadError) as error:
+        store.create('big.epub', 1001)
+    assert error.value.status == 413
+
+    upload = store.create('fake.mobi', 500)
+    with pytest.raises(UploadError) as error:
+        store.write_chunk(upload, 0, io.BytesIO(b'PK\x03\x04' + b'x' * 96), 100)
+    assert error.value.status == 415 and upload.received == 0
+    with pytest.raises(UploadError) as error:
+        store.write_chunk(upload, 0, io.BytesIO(b'x' * 50), 50)
+    assert error.value.status == 400
+    with pytest.raises(UploadError) as error:
+        store.finish(upload)
+    assert error.value.status == 409
+    store.cancel(upload)
+    assert os.listdir(str(tmp_path)) == []
@@ -1,79 +1,243 @@
-import requests
+import io
+import json
 import os
 import threading
 import time
-from flask import Flask
-from werkzeug.serving import make_server
+import zipfile
 
-# Import the app to test
 from app import app
+from corpus import build_epub, synthetic_book
 
-class ServerThread(threading.Thread):
-    def __init__(self, app):
-        threading.Thread.__init__(self)
-        self.server = make_server('127.0.0.1', 5001, app)
-        self.ctx = app.app_context()
-        self.ctx.push()
 
-    def run(self):
-        print('Starting mock server...')
-        self.server.serve_forever()
+def wait_for_job(client, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f'/jobs/{job_id}').get_json()
+        if status['status'] in ('done', 'failed', 'cancelled'):
+            return status
+        time.sleep(0.1)
+    raise AssertionError(f"Job {job_id} did not finish")
 
-    def shutdown(self):
-        print('Stopping mock server...')
-        self.server.shutdown()
 
-def test_endpoints():
-    # Start server in background
-    server = ServerThread(app)
-    server.start()
-    time.sleep(1) # Wait for start
+def upload(client, data, filename, path='/upload'):
+    return client.post(path, data={'file': (io.BytesIO(data), filename)}, content_type='multipart/form-data')
 
+
+def test_index():
+    assert app.test_client().get('/').status_code == 200
+
+
+def test_upload_sniffs_and_reports_failures():
+    client = app.test_client()
+    # Not a ZIP: rejected from its first bytes, before anything is converted
+    assert upload(client, b'dummy content', 'test_dummy.epub').status_code == 415
+
+    # A ZIP header is accepted and converted in the background, where it fails
+    r = upload(client, b'PK\x03\x04' + b'dummy content' * 10, 'test_dummy.epub')
+    assert r.status_code == 202
+    status = wait_for_job(client, r.get_json()['job_id'])
+    assert status['status'] == 'failed' and "转换失败" in status['error']
+
+    assert client.get('/jobs/missing').status_code == 404
+
+
+def test_job_events_metrics_and_cache():
+    client = app.test_client()
+    # A fresh paragraph per run so the first upload is not a cache hit
+    epub_bytes = build_epub([('Chapter 1', ['Hello web test.', f'Run {time.time()}'])])
+    r = upload(client, epub_bytes, 'test_web_book.epub')
+    assert r.status_code == 202
+
+    # Follow the job over server-sent events until it finishes
+    events = client.get(r.get_json()['events_url'])
+    assert events.headers['Content-Type'].startswith('text/event-stream')
+    last = [json.loads(line[len('data: '):]) for line in events.get_data(as_text=True).splitlines()
+            if line.startswith('data: ')][-1]
+    assert last['status'] == 'done'
+    assert 'Hello web test.' in client.get(last['download_url']).get_data(as_text=True)
+    # The upload is deleted once it is converted
+    assert not [name for name in os.listdir(app.config['UPLOAD_FOLDER']) if name.endswith('.epub')]
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'ebook_conversions_total{format="epub",status="success",path="epub"}' in text
+    assert 'ebook_http_requests_total{endpoint="/upload",method="POST",status="202"}' in text
+
+    # The same book again is answered from the conversion cache
+    r = upload(client, epub_bytes, 'again.epub')
+    assert r.status_code == 200 and r.get_json()['cached']
+    assert 'Hello web test.' in client.get(r.get_json()['download_url']).get_data(as_text=True)
+    assert client.get('/cache/stats').get_json()['hits'] >= 1
+
+    # Batch download streams a ZIP and rejects names outside the download folder
+    r = client.post('/download_batch', json={'filenames': [last['filename'], 'missing.txt']})
+    assert r.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert 'Hello web test.' in zf.read('test_web_book.txt').decode('utf-8')
+    assert client.post('/download_batch', json={'filenames': ['../app.py']}).status_code == 400
+
+    # Preview the first pages of an upload and of a job
+    r = client.post('/preview', data={'chars': '10', 'file': (io.BytesIO(epub_bytes), 'preview.epub')},
+                    content_type='multipart/form-data')
+    assert r.status_code == 200
+    assert r.get_json()['text'] == 'Chapter 1\n' and r.get_json()['truncated']
+    assert 'Hello web test.' in client.get(f"/jobs/{last['job_id']}/preview").get_json()['text']
+
+
+def test_batch_upload():
+    client = app.test_client()
+    files = [(io.BytesIO(build_epub([('Chapter 1', [f'Batch book {i}', f'Run {time.time()}'])])), f'batch{i}.epub')
+             for i in range(2)]
+    files.append((io.BytesIO(b'plain text'), 'notes.txt'))
+    r = client.post('/upload_batch', data={'files': files}, content_type='multipart/form-data')
+    assert r.headers['Content-Type'].startswith('application/x-ndjson')
+    # One NDJSON line per file, in completion order
+    results = {}
+    for line in r.get_data(as_text=True).splitlines():
+        result = json.loads(line)
+        results[result['index']] = result
+    assert results[2]['status'] == 'failed'
+    for i in range(2):
+        assert results[i]['status'] == 'done', results[i]
+        assert f'Batch book {i}' in client.get(results[i]['download_url']).get_data(as_text=True)
+
+
+def test_compressed_download():
+    client = app.test_client()
+    app.config['OUTPUT_COMPRESSION'] = 'gzip'
+    try:
+        epub_bytes = build_epub([('Chapter 1', ['Stored compressed. ' * 500, f'Run {time.time()}'])])
+        r = client.post('/upload', data={'file': (io.BytesIO(epub_bytes), 'gz_book.epub')},
+                        content_type='multipart/form-data')
+        status = wait_for_job(client, r.get_json()['job_id'])
+        assert status['status'] == 'done'
+    finally:
+        app.config['OUTPUT_COMPRESSION'] = None
+    url = status['download_url']
+    stored = os.path.join(app.config['DOWNLOAD_FOLDER'], status['filename'] + '.gz')
+    assert os.path.exists(stored) and not os.path.exists(stored[:-3])
+    with open(stored, 'rb') as f:
+        compressed = f.read()
+
+    # Clients that accept gzip get the stored bytes
+    r = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert r.headers['Content-Encoding'] == 'gzip' and 'Accept-Encoding' in r.headers['Vary']
+    assert r.data == compressed
+    r = client.get(url, headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=10-19'})
+    assert r.status_code == 206 and r.data == compressed[10:20]
+
+    # Others get it decompressed, with ranges over the decompressed text
+    r = client.get(url, headers={'Accept-Encoding': 'identity'})
+    text = r.data
+    assert 'Content-Encoding' not in r.headers and b'Stored compressed.' in text
+    assert r.headers['Content-Length'] == str(len(text))
+    r = client.get(url, headers={'Accept-Encoding': 'identity', 'Range': f'bytes={len(text) - 100}-'})
+    assert r.status_code == 206 and r.data == text[-100:]
+    assert r.headers['Content-Range'] == f'bytes {len(text) - 100}-{len(text) - 1}/{len(text)}'
+    etag = r.headers['ETag']
+    r = client.get(url, headers={'Accept-Encoding': 'identity', 'Range': 'bytes=0-9', 'If-Range': etag})
+    assert r.status_code == 206 and r.data == text[:10]
+    r = client.get(url, headers={'Accept-Encoding': 'identity', 'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert r.status_code == 200 and r.data == text
+
+    # Batch downloads take the deflate data straight from the .gz
+    r = client.post('/download_batch', json={'filenames': [status['filename']]})
+    assert r.headers.get('Content-Length') == str(len(r.data))
+    with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+        assert zf.read(os.path.basename(status['filename'])) == text
+
+    assert client.get('/download/missing/none.txt').status_code == 404
+
+
+def test_search():
+    import app as web
+    client = app.test_client()
+    run_id = str(time.time_ns())
+    epub_bytes = build_epub([('第一回', ['宴桃园豪杰三结义，斩黄巾英雄首立功。', f'Search run {run_id}'])])
+    r = client.post('/upload', data={'file': (io.BytesIO(epub_bytes), 'search_book.epub')},
+                    content_type='multipart/form-data')
+    assert wait_for_job(client, r.get_json()['job_id'])['status'] == 'done'
+    web.search_indexer.join()
+
+    r = client.get(f'/search?q=桃园豪杰 {run_id}')
+    hits = r.get_json()['results']
+    assert [hit['display_name'] for hit in hits] == ['search_book.txt']
+    assert '桃园豪杰' in hits[0]['snippet'] and hits[0]['download_url'].endswith('/search_book.txt')
+    assert client.get('/search?q=').status_code == 400
+
+
+def test_identical_uploads_share_one_conversion(monkeypatch):
+    import app as web
+    client = app.test_client()
+    # Hold the first conversion just before it finishes, so the second upload surely finds it in flight
+    release = threading.Event()
+    cache_output = web.job_queue.on_success
+    monkeypatch.setattr(web.job_queue, 'on_success', lambda job: release.wait(10) and cache_output(job))
+    epub_bytes = synthetic_book('epub', 2 * 1024 * 1024, seed=time.time_ns())
+    first = upload(client, epub_bytes, 'twice.epub').get_json()
+    r = upload(client, epub_bytes, 'twice_again.epub')
+    release.set()
+    assert r.status_code == 202 and r.get_json()['job_id'] == first['job_id']
+    status = wait_for_job(client, first['job_id'])
+    assert status['status'] == 'done'
+    assert len(client.get(status['download_url']).data) > 1024 * 1024
+
+    # Within a batch too: both files are reported from one conversion
+    epub_bytes = build_epub([('Chapter 1', ['Batched twice.', f'Run {time.time()}'])])
+    files = [(io.BytesIO(epub_bytes), 'one.epub'), (io.BytesIO(epub_bytes), 'two.epub')]
+    r = client.post('/upload_batch', data={'files': files}, content_type='multipart/form-data')
+    results = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert [result['status'] for result in results] == ['done', 'done']
+    assert results[0]['filename'] == results[1]['filename']
+
+
+def test_batch_upload_rejected_when_pool_is_full():
+    import app as web
+    client = app.test_client()
+    # Earlier batches may still be finishing: their callbacks run after their results are sent
+    uploads = set(os.listdir(app.config['UPLOAD_FOLDER']))
+    pending = web.conversion_pool.stats()['pending']
+    limit = web.conversion_pool.max_pending
+    web.conversion_pool.max_pending = 1
     try:
-        base_url = "http://127.0.0.1:5001"
-        
-        # 1. Test Index
-        print("Testing Index Page...")
-        r = requests.get(base_url + '/')
-        assert r.status_code == 200
-        print("Index OK.")
-
-        # 2. Test Upload (Mock File)
-        print("Testing Upload...")
-        # Create a dummy file
-        with open('test_dummy.epub', 'w') as f:
-            f.write('dummy content')
-            
-        files = {'file': ('test_dummy.epub', open('test_dummy.epub', 'rb'))}
-        
-        # Note: The actual conversion might fail because it's a dummy file, 
-        # but we want to check if the server accepts it and tries to convert.
-        # Our converter logic catches exceptions and returns 500 if format invalid.
-        # Or 400 if extension invalid.
-        
-        r = requests.post(base_url + '/upload', files=files)
-        
-        # It might return 500 because ebooklib can't read "dummy content", but that proves the route works.
-        # Or it might succeed if we mocked the converter. 
-        # Since we are using the real converter, it will likely return 500 with "EPUB Error".
-        
-        print(f"Upload Status: {r.status_code}")
-        if r.status_code == 200:
-            print("Upload Success (Unexpected for dummy file but route is working)")
-        elif r.status_code == 500:
-            print("Upload Handled (Expected failure for dummy content)")
-            assert "转换失败" in r.json()['error'] or "Error" in r.json()['error']
-        else:
-            print(f"Unexpected status: {r.status_code}")
-
-        # Clean up
-        if os.path.exists('test_dummy.epub'):
-            os.remove('test_dummy.epub')
-
-    except Exception as e:
-        print(f"Test Failed: {e}")
+        files = [(io.BytesIO(build_epub([('Chapter 1', [f'Full pool {i}'])])), f'full{i}.epub') for i in range(2)]
+        r = client.post('/upload_batch', data={'files': files}, content_type='multipart/form-data')
     finally:
-        server.shutdown()
+        web.conversion_pool.max_pending = limit
+    assert r.status_code == 429 and r.headers['Retry-After'] == '5'
+    # Nothing was saved or reserved
+    assert set(os.listdir(app.config['UPLOAD_FOLDER'])) <= uploads
+    assert web.conversion_pool.stats()['pending'] <= pending
+
+
+def test_chunked_upload():
+    client = app.test_client()
+    epub_bytes = build_epub([('Chapter 1', ['Sent in chunks.', os.urandom(20000).hex()])])
+    r = client.post('/uploads', json={'filename': 'chunked.epub', 'size': len(epub_bytes)})
+    assert r.status_code == 201
+    upload = r.get_json()
+    chunk_size = upload['chunk_size']
+    chunks = [epub_bytes[i:i + chunk_size] for i in range(0, len(epub_bytes), chunk_size)]
+
+    for index, chunk in enumerate(chunks):
+        r = client.put(upload['chunk_url'].format(index=index), data=chunk)
+        assert r.status_code == 200 and r.get_json()['next_chunk'] == index + 1
+    # Resending a chunk whose answer was lost is harmless
+    assert client.put(upload['chunk_url'].format(index=0), data=chunks[0]).status_code == 200
+    assert client.get(f"/uploads/{upload['upload_id']}").get_json()['complete']
+
+    r = client.post(upload['complete_url'])
+    assert r.status_code in (200, 202)
+    result = r.get_json()
+    if r.status_code == 202:
+        result = wait_for_job(client, result['job_id'])
+        assert result['status'] == 'done'
+    assert b'Sent in chunks.' in client.get(result['download_url']).data
+    assert client.get(f"/uploads/{upload['upload_id']}").status_code == 404
 
-if __name__ == "__main__":
-    test_endpoints()
+    # A file that is not what its name says is refused on its first chunk
+    r = client.post('/uploads', json={'filename': 'fake.mobi', 'size': len(epub_bytes)})
+    upload = r.get_json()
+    r = client.put(upload['chunk_url'].format(index=0), data=epub_bytes[:upload['chunk_size']])
+    assert r.status_code == 415
+    assert client.get(f"/uploads/{upload['upload_id']}").status_code == 404
+    assert client.post('/uploads', json={'filename': 'notes.txt', 'size': 100}).status_code == 400
@@ -0,0 +1,130 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from converter import Converter
+from corpus import synthetic_book
+from workers import CRASH_MESSAGE, TIMEOUT_MESSAGE, IsolatedConverter, WorkerPool
+
+
+class PidConverter(Converter):
+    """Reports the worker's pid, then behaves as the input file name says."""
+
+    def convert_file(self, input_path, output_path=None, update_callback=None):
+        update_callback(50, str(os.getpid()))
+        name = os.path.basename(input_path)
+        if name == 'hang':
+            while True:
+                pass
+        if name == 'grow':
+            blocks = []
+            while True:
+                blocks.append(bytearray(64 * 1024 * 1024))
+        if name == 'crash-always' or name == 'crash' and not os.path.exists(output_path):
+            # 'crash' dies once; the retry finds the marker
+            open(output_path, 'w').close()
+            os._exit(1)
+        if name == 'wait':
+            while not self._wait_if_paused():
+                time.sleep(0.01)
+            return False, "用户已停止"
+        return True, str(os.getpid())
+
+
+def run(pool, tmp_path, name, control=None):
+    progress = []
+    success, message, _ = pool.run(str(tmp_path / name), str(tmp_path / (name + '.txt')), {},
+                                   lambda p, m: progress.append(m), control)
+    return success, message, progress
+
+
+def test_progress_and_recycling(tmp_path):
+    pool = WorkerPool(workers=1, converter_class=PidConverter, max_jobs=2)
+    try:
+        pids = [run(pool, tmp_path, 'book') for _ in range(3)]
+    finally:
+        pool.shutdown()
+    assert all(success and progress == [message] for success, message, progress in pids)
+    assert pids[0][1] != str(os.getpid())
+    # The worker is replaced after two jobs
+    assert pids[0][1] == pids[1][1] != pids[2][1]
+
+
+def test_timeout_kills_the_worker(tmp_path):
+    pool = WorkerPool(workers=1, converter_class=PidConverter, timeout=0.5)
+    try:
+        start = time.monotonic()
+        success, message, progress = run(pool, tmp_path, 'hang')
+        assert not success and message == TIMEOUT_MESSAGE
+        assert time.monotonic() - start < 5
+        # The next job gets a fresh worker
+        success, message, _ = run(pool, tmp_path, 'book')
+        assert success and message != progress[0]
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='RLIMIT_DATA is enforced on Linux')
+def test_memory_limit_fails_the_job_only(tmp_path):
+    pool = WorkerPool(workers=1, converter_class=PidConverter, memory_limit=256 * 1024 * 1024)
+    try:
+        success, message, progress = run(pool, tmp_path, 'grow')
+        assert not success and message == "转换所需内存超出限制"
+        assert run(pool, tmp_path, 'book')[0]
+    finally:
+        pool.shutdown()
+
+
+def test_crashed_job_is_retried_once(tmp_path):
+    pool = WorkerPool(workers=1, converter_class=PidConverter)
+    try:
+        success, message, progress = run(pool, tmp_path, 'crash')
+        assert success and len(set(progress)) == 2
+    finally:
+        pool.shutdown()
+
+    pool = WorkerPool(workers=1, converter_class=PidConverter)
+    try:
+        success, message, progress = run(pool, tmp_path, 'crash-always')
+        assert not success and message == CRASH_MESSAGE and len(set(progress)) == 2
+        assert run(pool, tmp_path, 'book')[0]
+    finally:
+        pool.shutdown()
+
+
+def test_pause_and_stop_reach_the_worker(tmp_path):
+    # Time spent paused does not count towards the timeout
+    pool = WorkerPool(workers=1, converter_class=PidConverter, timeout=0.3)
+    control = Converter()
+    control.pause()
+    try:
+        threading.Timer(1.0, control.stop).start()
+        success, message, _ = run(pool, tmp_path, 'wait', control)
+        assert not success and message == "用户已停止"
+    finally:
+        pool.shutdown()
+
+
+def test_isolated_converter(tmp_path):
+    input_path = str(tmp_path / 'book.epub')
+    with open(input_path, 'wb') as f:
+        f.write(synthetic_book('epub', 64 * 1024, chapters=4))
+    expected_path = str(tmp_path / 'expected.txt')
+    assert Converter(normalize='width').convert_file(input_path, expected_path)[0]
+
+    pool = WorkerPool(workers=1)
+    try:
+        converter = IsolatedConverter(pool, normalize='width')
+        progress = []
+        success, message = converter.convert_file(input_path, None, lambda p, m: progress.append(p))
+    finally:
+        pool.shutdown()
+    assert success, message
+    assert progress and progress[-1] == 100
+    with open(str(tmp_path / 'book.txt'), 'rb') as f, open(expected_path, 'rb') as g:
+        assert f.read() == g.read()
+    record = converter.timings.to_dict()
+    assert record is None or record['status'] == 'success'
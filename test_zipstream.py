@@ -0,0 +1,107 @@
+import gzip
+import io
+import os
+import zipfile
+
+import zipstream
+from zipstream import ZipStream
+
+
+def make_files(tmp_path, count=5):
+    files = []
+    for i in range(count):
+        path = tmp_path / f'book{i}.txt'
+        path.write_bytes(('第%d章 天下大势，分久必合。\n' % i).encode('utf-8') * (2000 * (i + 1)) + os.urandom(i * 100))
+        files.append((f'书 {i}.txt', str(path)))
+    return files
+
+
+def check_archive(data, files):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [arcname for arcname, _ in files]
+        for arcname, path in files:
+            with open(path, 'rb') as f:
+                assert zf.read(arcname) == f.read()
+
+
+def test_stream_matches_files(tmp_path):
+    files = make_files(tmp_path)
+    archive = ZipStream(files, threads=3)
+    # Entries are compressed while streaming, so the size is not known up front
+    assert archive.content_length() is None
+    check_archive(b''.join(archive), files)
+
+
+def test_gzip_copies_are_reused(tmp_path):
+    files = make_files(tmp_path, 3)
+    for _, path in files:
+        with open(path, 'rb') as f, gzip.open(path + '.gz', 'wb') as gz:
+            gz.write(f.read())
+
+    archive = ZipStream(files)
+    length = archive.content_length()
+    data = b''.join(archive)
+    assert length == len(data)
+    check_archive(data, files)
+
+
+def test_mismatched_gzip_is_ignored(tmp_path):
+    files = make_files(tmp_path, 1)
+    path = files[0][1]
+    with gzip.open(path + '.gz', 'wb') as gz:
+        gz.write(b'old text')
+    assert ZipStream(files).content_length() is None
+    check_archive(b''.join(ZipStream(files)), files)
+
+
+def test_zip64_end_record(tmp_path, monkeypatch):
+    monkeypatch.setattr(zipstream, 'ZIP64_COUNT_LIMIT', 2)
+    files = make_files(tmp_path, 3)
+    check_archive(b''.join(ZipStream(files)), files)
+
+
+def test_gzip_only_outputs(tmp_path):
+    files = make_files(tmp_path, 2)
+    for _, path in files:
+        with open(path, 'rb') as f, gzip.open(path + '.gz', 'wb') as gz:
+            gz.write(f.read())
+    expected = {arcname: open(path, 'rb').read() for arcname, path in files}
+    for _, path in files:
+        os.remove(path)
+
+    archive = ZipStream(files)
+    data = b''.join(archive)
+    assert archive.content_length() == len(data)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert {name: zf.read(name) for name in zf.namelist()} == expected
+
+
+def test_entries_stream_in_bounded_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(zipstream, 'READ_SIZE', 4096)
+    monkeypatch.setattr(zipstream, 'CHUNKS_AHEAD', 1)
+    path = tmp_path / 'big.txt'
+    path.write_bytes(os.urandom(300 * 1024))
+    files = make_files(tmp_path, 3) + [('big.txt', str(path))]
+    archive = ZipStream(files, threads=2)
+    chunks = list(archive)
+    # Deflated data is sent as it comes: no chunk holds a whole entry
+    assert max(len(chunk) for chunk in chunks) < 64 * 1024
+    data = b''.join(chunks)
+    assert archive.content_length() == len(data)
+    check_archive(data, files)
+
+
+def test_closing_the_stream_stops_compression(tmp_path, monkeypatch):
+    monkeypatch.setattr(zipstream, 'READ_SIZE', 4096)
+    monkeypatch.setattr(zipstream, 'CHUNKS_AHEAD', 1)
+    files = []
+    for i in range(4):
+        path = tmp_path / f'big{i}.txt'
+        path.write_bytes(os.urandom(200 * 1024))
+        files.append((f'big{i}.txt', str(path)))
+    stream = iter(ZipStream(files, threads=2))
+    next(stream)
+    next(stream)
+    # Producers blocked on full queues are let go instead of keeping the pool open
+    stream.close()
@@ -0,0 +1,293 @@
+"""
+Chunked, resumable uploads.
+
+A client starts an upload with the file name and size, then sends the file
+in chunks of the agreed size, in order, and finally completes it.  Each
+chunk is streamed straight into <upload folder>/sessions/<id>.part and
+hashed on the way, so completing an upload needs neither another copy nor
+another read of the file.  The session state is kept in <id>.json next to
+it: after a dropped connection the client asks for the status and carries
+on from the next chunk, and after a server restart the hash is rebuilt once
+from the bytes already on disk.
+
+The first chunk is sniffed: an EPUB must start with a ZIP local file header
+and a MOBI/AZW3 must have BOOKMOBI at offset 60 of its PDB header, so a
+mislabelled file is rejected before the rest of it is sent.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+HASH_CHUNK_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+# Unfinished uploads are dropped after this many seconds without a chunk
+DEFAULT_MAX_AGE = 24 * 3600
+
+ZIP_SIGNATURE = b'PK\x03\x04'
+MOBI_SIGNATURE = b'BOOKMOBI'
+MOBI_SIGNATURE_OFFSET = 60
+# Bytes of the first chunk needed to sniff the format
+SNIFF_BYTES = MOBI_SIGNATURE_OFFSET + len(MOBI_SIGNATURE)
+
+
+class UploadError(ValueError):
+    """A rejected upload request; status is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, upload=None):
+        super().__init__(message)
+        self.status = status
+        self.upload = upload
+
+
+def sniff_format(head):
+    """Format ('.epub' or '.mobi') the first bytes of a file belong to, or None."""
+    if head.startswith(ZIP_SIGNATURE):
+        return '.epub'
+    if head[MOBI_SIGNATURE_OFFSET:SNIFF_BYTES] == MOBI_SIGNATURE:
+        return '.mobi'
+    return None
+
+
+def matches_extension(head, extension):
+    """True if the first bytes look like a book of the given extension (.azw3 is a MOBI container)."""
+    expected = '.mobi' if extension.lower() in ('.mobi', '.azw3') else extension.lower()
+    return sniff_format(head) == expected
+
+
+class PrefixedStream:
+    """A stream whose first bytes were already read for sniffing; read() gives them back first."""
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.head:
+            data = self.head if size < 0 else self.head[:size]
+            self.head = self.head[len(data):]
+            return data
+        return self.stream.read(size)
+
+
+class Upload:
+    def __init__(self, directory, upload_id, filename, size, chunk_size, received=0, created=None, updated=None):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.received = received
+        self.created = created or time.time()
+        self.updated = updated or self.created
+        self.data_path = os.path.join(directory, upload_id + '.part')
+        self.state_path = os.path.join(directory, upload_id + '.json')
+        # None until rebuilt from the file after a restart
+        self.hash = None
+        self.lock = threading.Lock()
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def next_chunk(self):
+        # The last chunk may be short, so a complete upload is past all of them
+        if self.complete:
+            return self.chunk_count
+        return self.received // self.chunk_size
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'filename': self.filename,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunk_count': self.chunk_count,
+            'received': self.received,
+            'next_chunk': self.next_chunk,
+            'complete': self.complete,
+        }
+
+    def save_state(self):
+        state = {'filename': self.filename, 'size': self.size, 'chunk_size': self.chunk_size,
+                 'received': self.received, 'created': self.created, 'updated': self.updated}
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(temp_path, self.state_path)
+
+    def rebuild_hash(self):
+        digest = hashlib.sha256()
+        with open(self.data_path, 'rb') as f:
+            remaining = self.received
+            while remaining:
+                data = f.read(min(HASH_CHUNK_SIZE, remaining))
+                if not data:
+                    raise UploadError('上传数据已损坏，请重新上传', 410)
+                digest.update(data)
+                remaining -= len(data)
+        self.hash = digest
+
+
+class UploadStore:
+    def __init__(self, directory, max_size, chunk_size=DEFAULT_CHUNK_SIZE, max_age=DEFAULT_MAX_AGE):
+        """
+        directory: where unfinished uploads are kept; must be on the same file system
+        as the upload folder so completed files can be renamed into place.
+        max_size: largest file accepted.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        # The whole signature has to be in the first chunk
+        self.chunk_size = max(chunk_size, SNIFF_BYTES)
+        self.max_age = max_age
+        self._uploads = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, filename, size):
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('文件大小无效')
+        if size > self.max_size:
+            raise UploadError(f'文件超过 {self.max_size // (1024 * 1024)} MB 的上限', 413)
+        if size < SNIFF_BYTES:
+            raise UploadError('文件不是有效的电子书', 415)
+        self.prune()
+
+        upload = Upload(self.directory, uuid.uuid4().hex, filename, size, self.chunk_size)
+        upload.hash = hashlib.sha256()
+        open(upload.data_path, 'wb').close()
+        upload.save_state()
+        with self._lock:
+            self._uploads[upload.id] = upload
+        return upload
+
+    def get(self, upload_id):
+        """Return the upload, loading it from disk after a restart, or raise UploadError (404)."""
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is None and all(c in '0123456789abcdef' for c in upload_id) and len(upload_id) == 32:
+                upload = self._load(upload_id)
+                if upload:
+                    self._uploads[upload_id] = upload
+        if upload is None:
+            raise UploadError('上传不存在或已过期', 404)
+        return upload
+
+    def _load(self, upload_id):
+        try:
+            with open(os.path.join(self.directory, upload_id + '.json'), encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        upload = Upload(self.directory, upload_id, **state)
+        if not os.path.exists(upload.data_path):
+            return None
+        # Bytes past the last acknowledged chunk belong to a chunk that was cut off
+        if os.path.getsize(upload.data_path) != upload.received:
+            with open(upload.data_path, 'r+b') as f:
+                f.truncate(upload.received)
+        return upload
+
+    def write_chunk(self, upload, index, stream, length):
+        """
+        Append chunk `index` read from stream.  A chunk that was already
+        received is acknowledged again without being written; a chunk ahead
+        of the next expected one is refused with 409.
+        """
+        with upload.lock:
+            if index < upload.next_chunk or upload.complete:
+                return upload
+            if index != upload.next_chunk:
+                raise UploadError(f'应上传第 {upload.next_chunk} 块', 409, upload)
+            expected = upload.chunk_length(index)
+            if length is not None and length != expected:
+                raise UploadError(f'第 {index} 块应为 {expected} 字节', 400, upload)
+            if upload.hash is None:
+                upload.rebuild_hash()
+
+            # Hash a copy so a chunk cut off halfway leaves the upload as it was
+            digest = upload.hash.copy()
+            written = 0
+            head = b''
+            try:
+                with open(upload.data_path, 'r+b') as f:
+                    f.seek(upload.received)
+                    while written < expected:
+                        data = stream.read(min(COPY_BUFFER_SIZE, expected - written))
+                        if not data:
+                            break
+                        if index == 0 and len(head) < SNIFF_BYTES:
+                            head += data[:SNIFF_BYTES - len(head)]
+                            if len(head) == SNIFF_BYTES and not matches_extension(head, upload_extension(upload)):
+                                raise UploadError('文件内容与扩展名不符，不是有效的电子书', 415)
+                        digest.update(data)
+                        f.write(data)
+                        written += len(data)
+                    if written != expected or stream.read(1):
+                        raise UploadError(f'第 {index} 块应为 {expected} 字节', 400, upload)
+            except Exception:
+                with open(upload.data_path, 'r+b') as f:
+                    f.truncate(upload.received)
+                raise
+
+            upload.hash = digest
+            upload.received += written
+            upload.updated = time.time()
+            upload.save_state()
+            return upload
+
+    def finish(self, upload):
+        """Close a fully received upload: returns (data path, sha256 hex digest); the caller moves the file."""
+        with upload.lock:
+            if not upload.complete:
+                raise UploadError(f'上传未完成：已收到 {upload.received}/{upload.size} 字节', 409, upload)
+            if upload.hash is None:
+                upload.rebuild_hash()
+            self._forget(upload)
+            return upload.data_path, upload.hash.hexdigest()
+
+    def cancel(self, upload):
+        with upload.lock:
+            self._forget(upload)
+            _remove_file(upload.data_path)
+
+    def _forget(self, upload):
+        with self._lock:
+            self._uploads.pop(upload.id, None)
+        _remove_file(upload.state_path)
+
+    def prune(self):
+        """Drop unfinished uploads that have not received a chunk for max_age seconds."""
+        cutoff = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            for upload_id in [u.id for u in self._uploads.values() if u.updated < cutoff]:
+                del self._uploads[upload_id]
+
+
+def upload_extension(upload):
+    return os.path.splitext(upload.filename)[1].lower()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,317 @@
+"""
+Conversions in supervised worker processes.
+
+A malformed book can make a conversion allocate without bound or spin
+forever, and inside the web server that takes unrelated requests down with
+it.  WorkerPool runs each conversion in a child process instead:
+
+- every worker caps its own memory with setrlimit (RLIMIT_DATA on Linux,
+  which leaves the memory-mapped input out, RLIMIT_AS elsewhere), so a
+  runaway allocation raises MemoryError in the child and only that job fails;
+- the parent kills a worker whose job has run longer than the timeout (time
+  spent paused does not count) and starts a new one;
+- a worker is replaced after max_jobs conversions, or after any job that
+  leaves its resident memory above max_rss;
+- a worker that dies mid-job (the OOM killer, a crash in a C extension) is
+  replaced and the job is tried once more, carrying on from its checkpoint.
+
+Each worker has a Pipe to the parent.  The parent sends ('convert', input,
+output, options) and then 'pause', 'resume' or ('stop', keep_checkpoint) as
+the job is controlled; the worker answers with ('progress', percent, message) as it
+goes and one ('result', success, message, timings, rss) at the end.
+
+Workers are started with forkserver (spawn where that is missing) rather
+than fork, so they never inherit locks held by the server's other threads.
+The fork server imports this module and the converter once and every worker
+is forked from it; the server's __main__ is left out of the preload, as it
+may be the whole web app.  Without the resource module (Windows) there is no
+memory cap; the timeout and recycling still apply.  Workers are daemon
+processes, so the converter inside runs with workers=1.
+"""
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import metrics
+import outputs
+from checkpoint import CHECKPOINT_SUFFIX, PARTIAL_SUFFIX
+from converter import Converter, _error_text
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_MEMORY_LIMIT = 1024 * 1024 * 1024
+DEFAULT_TIMEOUT = 600
+DEFAULT_MAX_JOBS = 50
+DEFAULT_MAX_RSS = 512 * 1024 * 1024
+# Seconds between checks of the timeout and of pause/stop requests
+POLL_INTERVAL = 0.1
+# Fresh workers a job is given after the one running it died
+CRASH_RETRIES = 1
+# Seconds a retiring worker gets to exit before it is killed
+EXIT_TIMEOUT = 5
+
+TIMEOUT_MESSAGE = "转换超时"
+CRASH_MESSAGE = "转换进程异常退出"
+STOPPED_MESSAGE = "用户已停止"
+
+
+def limit_memory(limit):
+    """Cap the memory of this process at limit bytes; returns False if that is not possible here."""
+    if resource is None or not limit:
+        return False
+    kind = resource.RLIMIT_DATA if sys.platform.startswith('linux') else resource.RLIMIT_AS
+    try:
+        soft, hard = resource.getrlimit(kind)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(kind, (limit, hard))
+    except (ValueError, OSError):
+        return False
+    return True
+
+
+def _context():
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['workers', 'converter'])
+    return context
+
+
+def _worker_main(conn, converter_class, memory_limit):
+    """Worker process: run conversions sent over conn until told to exit or the parent goes away."""
+    limit_memory(memory_limit)
+    jobs = queue.Queue()
+    send_lock = threading.Lock()
+    current = [None]
+
+    def send(message):
+        # Progress of a parallel EPUB conversion comes from its writer thread
+        with send_lock:
+            conn.send(message)
+
+    def read():
+        # The only reader of the pipe, so pause/stop reach a job while it runs
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = ('exit',)
+            command = message[0]
+            if command == 'convert':
+                current[0] = converter_class(**message[3])
+                jobs.put((current[0], message[1], message[2]))
+            elif command == 'exit':
+                if current[0] is not None:
+                    current[0].stop()
+                    current[0].resume()
+                jobs.put(None)
+                return
+            elif current[0] is not None:
+                getattr(current[0], command)(*message[1:])
+
+    threading.Thread(target=read, name='worker-control', daemon=True).start()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        converter, input_path, output_path = job
+        try:
+            success, message = converter.convert_file(input_path, output_path,
+                                                      lambda progress, text: send(('progress', progress, text)))
+        except Exception as e:
+            success, message = False, _error_text(e)
+        try:
+            send(('result', success, message, converter.timings.to_dict(), metrics.rss_bytes()))
+        except (OSError, ValueError):
+            break
+
+
+class _Worker:
+    def __init__(self, context, converter_class, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, converter_class, memory_limit),
+                                       name='convert-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def retire(self):
+        try:
+            self.conn.send(('exit',))
+        except OSError:
+            pass
+        self.process.join(EXIT_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class _WorkerDied(Exception):
+    pass
+
+
+class WorkerPool:
+    def __init__(self, workers=2, converter_class=Converter, memory_limit=DEFAULT_MEMORY_LIMIT,
+                 timeout=DEFAULT_TIMEOUT, max_jobs=DEFAULT_MAX_JOBS, max_rss=DEFAULT_MAX_RSS):
+        """
+        workers: conversions that run at the same time; run() blocks for a free worker beyond that.
+        converter_class: instantiated in the worker with the options of each job.
+        memory_limit: bytes each worker may allocate, None for no limit.
+        timeout: seconds a job may run (not counting pauses), None for no limit.
+        max_jobs, max_rss: a worker is replaced after this many jobs, or
+        after a job that leaves it using more than max_rss bytes.
+        """
+        self.workers = workers
+        self.converter_class = converter_class
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self._slots = threading.BoundedSemaphore(workers)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._context = None
+
+    def run(self, input_path, output_path, options=None, callback=None, control=None):
+        """
+        Convert in a worker process; returns (success, message, timings dict or None).
+
+        options: keyword arguments for converter_class.
+        callback(progress, message) receives the progress of the worker.
+        control: a Converter (or anything with its stop_event and pause_event)
+        whose pause/resume/stop requests are passed on to the worker.
+        """
+        request = ('convert', input_path, output_path, options or {})
+        with self._slots:
+            for attempt in range(CRASH_RETRIES + 1):
+                worker = self._acquire()
+                try:
+                    result = self._follow(worker, request, callback, control)
+                except _WorkerDied:
+                    worker.kill()
+                    if control is not None and control.stop_event.is_set():
+                        if not getattr(control, 'keep_checkpoint', True):
+                            _discard_partial(output_path)
+                        return False, STOPPED_MESSAGE, None
+                    continue
+                if result is None:
+                    worker.kill()
+                    _discard_partial(output_path)
+                    return False, TIMEOUT_MESSAGE, None
+                success, message, timings, rss = result
+                worker.jobs += 1
+                self._release(worker, rss)
+                return success, message, timings
+        _discard_partial(output_path)
+        return False, CRASH_MESSAGE, None
+
+    def _follow(self, worker, request, callback, control):
+        """Send a job to worker and relay its progress until the result; None if it timed out."""
+        stopped = paused = False
+        elapsed = 0.0
+        last = time.monotonic()
+        try:
+            worker.conn.send(request)
+            while True:
+                if control is not None:
+                    if control.stop_event.is_set() and not stopped:
+                        stopped = True
+                        worker.conn.send(('stop', getattr(control, 'keep_checkpoint', True)))
+                    if control.pause_event.is_set() == paused:
+                        paused = not paused
+                        worker.conn.send(('pause',) if paused else ('resume',))
+                now = time.monotonic()
+                if not paused:
+                    elapsed += now - last
+                last = now
+                if self.timeout and elapsed > self.timeout:
+                    return None
+                if worker.conn.poll(POLL_INTERVAL):
+                    message = worker.conn.recv()
+                    if message[0] == 'result':
+                        return message[1:]
+                    if callback:
+                        callback(*message[1:])
+                elif not worker.process.is_alive():
+                    raise _WorkerDied()
+        except (EOFError, OSError):
+            raise _WorkerDied()
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.process.is_alive():
+                    return worker
+                worker.conn.close()
+            if self._context is None:
+                self._context = _context()
+        return _Worker(self._context, self.converter_class, self.memory_limit)
+
+    def _release(self, worker, rss):
+        if worker.jobs >= self.max_jobs or (self.max_rss and rss and rss > self.max_rss):
+            worker.retire()
+            return
+        with self._lock:
+            self._idle.append(worker)
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.retire()
+
+
+def _discard_partial(output_path):
+    # A job that timed out, kept crashing or was cancelled is not resumed: drop what it wrote
+    for path in (output_path + PARTIAL_SUFFIX, output_path + CHECKPOINT_SUFFIX):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _ReceivedTimings:
+    """Stands in for the worker's Timings: to_dict() gives back the record the worker sent."""
+    enabled = True
+
+    def __init__(self, record):
+        self.record = record
+        self.labels = dict(record)
+
+    def to_dict(self):
+        return self.record
+
+
+class IsolatedConverter(Converter):
+    """
+    A Converter whose conversions run in a WorkerPool.
+
+    Pause, resume and stop work as on a Converter; timings holds the stages
+    the worker measured.
+    """
+
+    def __init__(self, pool, **options):
+        super().__init__(**options)
+        self.pool = pool
+        self.options = options
+
+    def convert_file(self, input_path, output_path=None, update_callback=None):
+        if output_path is None:
+            output_path = outputs.stored_path(os.path.splitext(input_path)[0] + ".txt", self.compression)
+        success, message, record = self.pool.run(input_path, output_path, self.options, update_callback, self)
+        self.timings = _ReceivedTimings(record) if record else metrics.NULL_TIMINGS
+        return success, message
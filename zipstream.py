@@ -0,0 +1,328 @@
+"""
+ZIP archives generated on the fly.
+
+ZipStream yields an archive chunk by chunk so /download_batch never holds the
+whole ZIP in memory.  Entries are deflated on a small thread pool (zlib
+releases the GIL) a few entries ahead of the one being sent.  Deflated data
+is sent as it is produced, with the CRC and sizes in a data descriptor after
+it (general purpose flag bit 3), so each entry keeps at most CHUNKS_AHEAD
+chunks waiting: memory stays around threads * 2 * CHUNKS_AHEAD * READ_SIZE
+whatever the size of the books.  Outputs stored as gzip (book.txt.gz, alone
+or next to an older-or-same book.txt) are not compressed again: the deflate
+stream inside the gzip member is copied into the archive as is, with its
+sizes in the local header.  Outputs stored as zstd are decompressed and
+deflated.  ZIP64 records are added only when sizes, offsets or the entry
+count need them.
+"""
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Queue
+from threading import Event
+
+import outputs
+
+READ_SIZE = 256 * 1024
+# Deflated chunks an entry may have waiting to be sent
+CHUNKS_AHEAD = 4
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+_ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+_ZIP64_LOCATOR = struct.Struct('<IIQI')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_ZIP64_DATA_DESCRIPTOR = struct.Struct('<IIQQ')
+
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+METHOD_DEFLATED = 8
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+_GZIP_FEXTRA, _GZIP_FNAME, _GZIP_FCOMMENT, _GZIP_FHCRC = 4, 8, 16, 2
+
+
+def gzip_deflate_span(gz_path, size):
+    """
+    Locate the raw deflate data in a single-member gzip file.
+
+    Returns (offset, length, crc) or None if the file does not look like a
+    gzip copy of `size` bytes.
+    """
+    with open(gz_path, 'rb') as f:
+        head = f.read(10)
+        if len(head) < 10 or not head.startswith(GZIP_MAGIC):
+            return None
+        flags = head[3]
+        if flags & _GZIP_FEXTRA:
+            extra_len, = struct.unpack('<H', f.read(2))
+            f.seek(extra_len, os.SEEK_CUR)
+        for flag in (_GZIP_FNAME, _GZIP_FCOMMENT):
+            if flags & flag:
+                while f.read(1) not in (b'\0', b''):
+                    pass
+        if flags & _GZIP_FHCRC:
+            f.seek(2, os.SEEK_CUR)
+        offset = f.tell()
+
+        total = os.fstat(f.fileno()).st_size
+        if total < offset + 8:
+            return None
+        f.seek(total - 8)
+        crc, isize = struct.unpack('<II', f.read(8))
+    if isize != size & 0xFFFFFFFF:
+        return None
+    return offset, total - 8 - offset, crc
+
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class _Entry:
+    def __init__(self, arcname, path):
+        """path: the logical text file; it may be stored compressed (see outputs)."""
+        self.arcname = arcname.encode('utf-8')
+        self.path, self.compression = outputs.find_output(path) or (path, None)
+        stat = os.stat(self.path)
+        # Unknown for zstd until the entry is compressed
+        self.size = outputs.plain_size(self.path, self.compression)
+        self.dos_time, self.dos_date = _dos_time(stat.st_mtime)
+        self.crc = None
+        self.compressed_size = None
+        self.gzip_path = None
+        self.gzip_span = None
+        self.offset = None
+
+        if self.compression == 'gzip':
+            self.gzip_path = self.path
+        elif self.compression is None:
+            try:
+                if os.stat(path + '.gz').st_mtime >= stat.st_mtime:
+                    self.gzip_path = path + '.gz'
+            except OSError:
+                pass
+        if self.gzip_path:
+            self.gzip_span = gzip_deflate_span(self.gzip_path, self.size)
+        if self.gzip_span:
+            _, self.compressed_size, self.crc = self.gzip_span
+            self.flags = FLAG_UTF8
+            self.zip64 = self.size >= ZIP64_LIMIT or self.compressed_size >= ZIP64_LIMIT
+        else:
+            # Sizes follow the data; decide on ZIP64 before knowing them (deflate grows data by far less than 1/1024)
+            self.flags = FLAG_UTF8 | FLAG_DATA_DESCRIPTOR
+            self.zip64 = self.size is None or self.size + (self.size >> 10) + 1024 >= ZIP64_LIMIT
+
+    def local_header(self):
+        extra = b''
+        size, compressed_size, crc = self.size, self.compressed_size, self.crc
+        if self.flags & FLAG_DATA_DESCRIPTOR:
+            size = compressed_size = crc = 0
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, size, compressed_size)
+            size = compressed_size = ZIP64_LIMIT
+        return _LOCAL_HEADER.pack(
+            0x04034b50, VERSION_ZIP64 if extra else VERSION_DEFAULT, self.flags, METHOD_DEFLATED,
+            self.dos_time, self.dos_date, crc, compressed_size, size, len(self.arcname), len(extra),
+        ) + self.arcname + extra
+
+    def data_descriptor(self):
+        record = _ZIP64_DATA_DESCRIPTOR if self.zip64 else _DATA_DESCRIPTOR
+        return record.pack(0x08074b50, self.crc, self.compressed_size, self.size)
+
+    def descriptor_size(self):
+        if not self.flags & FLAG_DATA_DESCRIPTOR:
+            return 0
+        return (_ZIP64_DATA_DESCRIPTOR if self.zip64 else _DATA_DESCRIPTOR).size
+
+    def central_header(self):
+        fields = []
+        size, compressed_size, offset = self.size, self.compressed_size, self.offset
+        if size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT:
+            fields += [size, compressed_size]
+            size = compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields), *fields) if fields else b''
+        version = VERSION_ZIP64 if extra or self.zip64 else VERSION_DEFAULT
+        return _CENTRAL_HEADER.pack(
+            0x02014b50, version, version, self.flags, METHOD_DEFLATED, self.dos_time, self.dos_date,
+            self.crc, compressed_size, size, len(self.arcname), len(extra), 0, 0, 0, 0, offset,
+        ) + self.arcname + extra
+
+    def header_size(self):
+        return _LOCAL_HEADER.size + len(self.arcname) + (20 if self.zip64 else 0)
+
+    def central_size(self, offset):
+        extra = 16 if self.size >= ZIP64_LIMIT or self.compressed_size >= ZIP64_LIMIT else 0
+        if offset >= ZIP64_LIMIT:
+            extra += 8
+        return _CENTRAL_HEADER.size + len(self.arcname) + (extra + 4 if extra else 0)
+
+    def compress(self, level, chunks, stop):
+        """
+        Deflate the file into the chunks queue and record its CRC and sizes.
+
+        The queue gets None at the end, or the exception that stopped the
+        compression.  Gives up quietly once stop is set.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        try:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            crc = 0
+            size = 0
+            compressed_size = 0
+            with outputs.open_plain(self.path, self.compression) as f:
+                while not stop.is_set():
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        break
+                    size += len(data)
+                    crc = zlib.crc32(data, crc)
+                    chunk = compressor.compress(data)
+                    compressed_size += len(chunk)
+                    if chunk and not put(chunk):
+                        return
+            chunk = compressor.flush()
+            self.size = size
+            self.crc = crc
+            self.compressed_size = compressed_size + len(chunk)
+            put(chunk)
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    @staticmethod
+    def read_chunks(chunks):
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def read_gzip(self):
+        offset, length, _ = self.gzip_span
+        with open(self.gzip_path, 'rb') as f:
+            f.seek(offset)
+            while length:
+                data = f.read(min(READ_SIZE, length))
+                if not data:
+                    raise IOError(f"{self.gzip_path} is shorter than expected")
+                length -= len(data)
+                yield data
+
+
+class ZipStream:
+    def __init__(self, files, threads=4, compresslevel=6):
+        """
+        files: (name in the archive, path on disk) pairs, in archive order.
+        threads: entries compressed at the same time.
+        """
+        self.entries = [_Entry(arcname, path) for arcname, path in files]
+        self.threads = threads
+        self.compresslevel = compresslevel
+
+    def content_length(self):
+        """Size of the archive, or None if some entry still has to be compressed."""
+        if any(entry.compressed_size is None for entry in self.entries):
+            return None
+        offset = 0
+        central_size = 0
+        for entry in self.entries:
+            central_size += entry.central_size(offset)
+            offset += entry.header_size() + entry.compressed_size + entry.descriptor_size()
+        return offset + central_size + self._end_size(offset, central_size)
+
+    def _end_size(self, central_offset, central_size):
+        size = _END_RECORD.size
+        if self._needs_zip64_end(central_offset, central_size):
+            size += _ZIP64_END_RECORD.size + _ZIP64_LOCATOR.size
+        return size
+
+    def _needs_zip64_end(self, central_offset, central_size):
+        return (len(self.entries) >= ZIP64_COUNT_LIMIT or central_offset >= ZIP64_LIMIT
+                or central_size >= ZIP64_LIMIT)
+
+    def _entry_data(self):
+        """
+        Yield (entry, chunks) in order while later entries compress on the pool.
+
+        At most threads * 2 entries are started, each with up to CHUNKS_AHEAD
+        deflated chunks queued; a producer waits for the stream to catch up.
+        """
+        stop = Event()
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            try:
+                pending = deque()
+                entries = iter(self.entries)
+                while True:
+                    while len(pending) < self.threads * 2:
+                        entry = next(entries, None)
+                        if entry is None:
+                            break
+                        if entry.gzip_span:
+                            pending.append((entry, None))
+                        else:
+                            chunks = Queue(CHUNKS_AHEAD)
+                            pool.submit(entry.compress, self.compresslevel, chunks, stop)
+                            pending.append((entry, chunks))
+                    if not pending:
+                        return
+                    entry, chunks = pending.popleft()
+                    yield entry, entry.read_gzip() if chunks is None else entry.read_chunks(chunks)
+            finally:
+                # The client went away or a read failed: let blocked producers go
+                stop.set()
+
+    def __iter__(self):
+        offset = 0
+        for entry, chunks in self._entry_data():
+            entry.offset = offset
+            header = entry.local_header()
+            yield header
+            offset += len(header)
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+                    offset += len(chunk)
+            if entry.flags & FLAG_DATA_DESCRIPTOR:
+                descriptor = entry.data_descriptor()
+                yield descriptor
+                offset += len(descriptor)
+
+        central_offset = offset
+        central = [entry.central_header() for entry in self.entries]
+        central_size = sum(len(record) for record in central)
+        yield b''.join(central)
+
+        count = len(self.entries)
+        if self._needs_zip64_end(central_offset, central_size):
+            zip64_end_offset = central_offset + central_size
+            yield _ZIP64_END_RECORD.pack(0x06064b50, _ZIP64_END_RECORD.size - 12, VERSION_ZIP64, VERSION_ZIP64,
+                                         0, 0, count, count, central_size, central_offset)
+            yield _ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+        yield _END_RECORD.pack(0x06054b50, 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+                               min(central_size, ZIP64_LIMIT), min(central_offset, ZIP64_LIMIT), 0)